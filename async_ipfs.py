@@ -0,0 +1,144 @@
+import json
+import asyncio
+import logging
+from urllib.parse import urlencode
+from ipfs_client import IpfsError, read_api_address, _cli_command
+import metrics
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+DEFAULT_CALL_TIMEOUT = 30
+
+
+class AsyncIpfsClient:
+    # Неблокирующий клиент для корутин: RPC API через asyncio.open_connection,
+    # при недоступном API — CLI через asyncio.create_subprocess_exec.
+    # У каждого вызова есть таймаут; при таймауте или отмене задачи соединение
+    # закрывается, а дочерний процесс убивается.
+    def __init__(self, ipfs_path, logger=None, host=None, port=None, timeout=DEFAULT_CALL_TIMEOUT):
+        self.ipfs_path = ipfs_path
+        self.logger = logger or logging.getLogger(__name__)
+        if host is None or port is None:
+            api_host, api_port = read_api_address()
+            host = host or api_host
+            port = port or api_port
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    async def _http(self, command, args=(), params=None):
+        query = [('arg', a) for a in args]
+        for key, value in (params or {}).items():
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            query.append((key, str(value)))
+        url = f"/api/v0/{command}" + ('?' + urlencode(query) if query else '')
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write((f"POST {url} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                          f"Content-Length: 0\r\nConnection: close\r\n\r\n").encode('ascii'))
+            await writer.drain()
+            status_line = await reader.readline()
+            parts = status_line.decode('latin-1').split(' ', 2)
+            if len(parts) < 2:
+                raise IpfsError(f"{command}: некорректный ответ HTTP API")
+            status = int(parts[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            if headers.get('transfer-encoding', '').lower() == 'chunked':
+                body = bytearray()
+                while True:
+                    size = int((await reader.readline()).split(b';')[0].strip() or b'0', 16)
+                    if size == 0:
+                        break
+                    body += await reader.readexactly(size)
+                    await reader.readline()
+            elif 'content-length' in headers:
+                body = await reader.readexactly(int(headers['content-length']))
+            else:
+                body = await reader.read()
+        finally:
+            writer.close()
+        text = bytes(body).decode('utf-8', 'replace')
+        if status != 200:
+            try:
+                text = json.loads(text).get('Message', text)
+            except (ValueError, AttributeError):
+                pass
+            raise IpfsError(f"{command}: {text}", stderr=text)
+        return text
+
+    async def _cli(self, args):
+        metrics.inc('ipfs_cli_calls_total', command=_cli_command(args))
+        process = await asyncio.create_subprocess_exec(
+            self.ipfs_path, *args,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            stderr = stderr.decode('utf-8', 'replace')
+            raise IpfsError(f"ipfs {' '.join(args)}: {stderr}", stderr=stderr)
+        return stdout.decode('utf-8', 'replace')
+
+    async def call(self, command, args=(), params=None, cli_args=None, timeout=None):
+        # Возвращает текст ответа HTTP API или, если API недоступен, stdout CLI (cli_args)
+        timeout = self.timeout if timeout is None else timeout
+
+        async def run():
+            try:
+                return await self._http(command, args, params), True
+            except OSError:
+                if cli_args is None:
+                    raise IpfsError(f"{command}: HTTP API {self.host}:{self.port} недоступен")
+                return await self._cli(cli_args), False
+        with metrics.timer('ipfs_call', op=command.replace('/', '_')):
+            try:
+                return await asyncio.wait_for(run(), timeout)
+            except asyncio.TimeoutError:
+                raise IpfsError(f"{command}: таймаут {timeout} с")
+
+    async def id(self, timeout=None):
+        text, _ = await self.call('id', cli_args=['id'], timeout=timeout)
+        return json.loads(text)
+
+    async def swarm_peers(self, timeout=None):
+        text, from_http = await self.call('swarm/peers', cli_args=['swarm', 'peers'], timeout=timeout)
+        if not from_http:
+            return text.splitlines()
+        peers = json.loads(text).get('Peers') or []
+        return [f"{p['Addr']}/p2p/{p['Peer']}" for p in peers]
+
+    async def swarm_connect(self, multiaddr, timeout=None):
+        await self.call('swarm/connect', [multiaddr], cli_args=['swarm', 'connect', multiaddr], timeout=timeout)
+
+    async def dht_findpeer(self, peer_id, timeout=None):
+        text, from_http = await self.call('dht/findpeer', [peer_id], cli_args=['dht', 'findpeer', peer_id],
+                                          timeout=timeout)
+        if not from_http:
+            return text.splitlines()
+        addrs = []
+        for line in text.splitlines():
+            if line.strip():
+                for response in json.loads(line).get('Responses') or []:
+                    addrs.extend(response.get('Addrs') or [])
+        return addrs
+
+
+async def run_blocking(func, *args, timeout=None, **kwargs):
+    # Запуск синхронной функции (ingest, sync) в пуле потоков, чтобы не блокировать цикл событий.
+    # По таймауту корутина прекращает ожидание; сам поток доработает в фоне.
+    call = asyncio.to_thread(func, *args, **kwargs)
+    if timeout is None:
+        return await call
+    return await asyncio.wait_for(call, timeout)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import hashlib
+
+# Фейковый исполняемый файл ipfs для бенчмарков CLI-пути. Состояние (пины) хранится
+# в каталоге FAKE_IPFS_STATE, каждый запуск дописывает строку в calls.log,
+# FAKE_IPFS_LATENCY_MS добавляет задержку к каждому вызову.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_kubo import fake_cid, fake_content, block_cid, DEFAULT_CONTENT_SIZE  # noqa: E402
+
+STATE_DIR = os.environ.get('FAKE_IPFS_STATE', os.path.join(os.getcwd(), '.fake_ipfs'))
+
+
+def _pins_file():
+    return os.path.join(STATE_DIR, 'pins.log')
+
+
+def _record_pins(cids):
+    with open(_pins_file(), 'a') as f:
+        for cid in cids:
+            f.write(f"{cid}\n")
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def main(argv):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(os.path.join(STATE_DIR, 'calls.log'), 'a') as f:
+        f.write(' '.join(argv[:2]) + '\n')
+    latency = float(os.environ.get('FAKE_IPFS_LATENCY_MS', '0')) / 1000
+    if latency:
+        time.sleep(latency)
+    args = [a for a in argv if not a.startswith('--timeout')]
+    if not args:
+        return 1
+    command = args[0]
+    if command == 'add':
+        pin = '--pin=false' not in args and '--only-hash' not in args
+        cids = []
+        for path in (a for a in args[1:] if not a.startswith('-')):
+            cid = fake_cid(_hash_file(path))
+            cids.append(cid)
+            print(f"added {cid} {os.path.basename(path)}")
+        if pin:
+            _record_pins(cids)
+    elif command == 'get':
+        cid, dest = args[1], args[args.index('-o') + 1]
+        with open(dest, 'wb') as f:
+            for piece in fake_content(cid, DEFAULT_CONTENT_SIZE):
+                f.write(piece)
+    elif command == 'pin' and args[1] == 'add':
+        _record_pins(args[2:])
+        for cid in args[2:]:
+            print(f"pinned {cid} recursively")
+    elif command == 'pin' and args[1] == 'rm':
+        removed = set(args[2:])
+        if os.path.exists(_pins_file()):
+            with open(_pins_file()) as f:
+                pins = [line.strip() for line in f if line.strip() and line.strip() not in removed]
+            with open(_pins_file(), 'w') as f:
+                f.writelines(f"{cid}\n" for cid in pins)
+        for cid in args[2:]:
+            print(f"unpinned {cid}")
+    elif command == 'repo' and args[1] == 'stat':
+        print(json.dumps({'RepoSize': 0, 'StorageMax': 10 * 1024 ** 3}))
+    elif command == 'pin' and args[1] == 'ls':
+        wanted = [a for a in args[2:] if not a.startswith('-')]
+        pins = set()
+        if os.path.exists(_pins_file()):
+            with open(_pins_file()) as f:
+                pins = {line.strip() for line in f if line.strip()}
+        for cid in wanted or sorted(pins):
+            if cid not in pins:
+                print(f"Error: path '{cid}' is not pinned", file=sys.stderr)
+                return 1
+            print(f"{cid} recursive")
+    elif command == 'files':
+        mfs_file = os.path.join(STATE_DIR, 'mfs_' + hashlib.sha256(args[-1].encode('utf-8')).hexdigest()[:16])
+        if args[1] == 'write':
+            offset = int(next(a for a in args if a.startswith('--offset=')).split('=', 1)[1])
+            count = int(next(a for a in args if a.startswith('--count=')).split('=', 1)[1])
+            with open(mfs_file, 'r+b' if os.path.exists(mfs_file) else 'wb') as f:
+                f.seek(offset)
+                f.write(sys.stdin.buffer.read(count))
+        elif args[1] == 'stat' and args[-1].startswith('/ipfs/'):
+            print(f"{args[-1][len('/ipfs/'):]} {DEFAULT_CONTENT_SIZE} {DEFAULT_CONTENT_SIZE}")
+        elif args[1] == 'stat':
+            if not os.path.exists(mfs_file):
+                print("Error: file does not exist", file=sys.stderr)
+                return 1
+            size = os.path.getsize(mfs_file)
+            print(f"{fake_cid(_hash_file(mfs_file))} {size} {size}")
+        elif args[1] == 'rm' and os.path.exists(mfs_file):
+            os.remove(mfs_file)
+    elif command == 'block' and args[1] == 'put':
+        with open(args[-1], 'rb') as f:
+            print(block_cid(f.read(), 0 if '--format=v0' in args else 1))
+    elif command == 'id':
+        print(json.dumps({'ID': '12D3KooWFakeSelf', 'Addresses': []}))
+    elif command == 'config' and args[1:2] == ['show']:
+        config_file = os.path.join(STATE_DIR, 'config.json')
+        if os.path.exists(config_file):
+            with open(config_file) as f:
+                print(f.read())
+        else:
+            print(json.dumps({'Routing': {'Type': 'auto'}, 'Discovery': {'MDNS': {'Enabled': False}}}))
+    elif command == 'config' and args[1:2] == ['replace']:
+        with open(args[2]) as src, open(os.path.join(STATE_DIR, 'config.json'), 'w') as dst:
+            dst.write(src.read())
+    elif command in ('swarm', 'config', 'dht', 'init', 'repo'):
+        pass
+    else:
+        print(f"Error: unknown command {command}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
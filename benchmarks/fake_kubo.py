@@ -0,0 +1,388 @@
+import json
+import time
+import queue
+import base64
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Фейковый RPC API Kubo для бенчмарков: детерминированные CID, настраиваемая задержка,
+# потоковый разбор multipart без хранения содержимого больших файлов.
+
+DEFAULT_CONTENT_SIZE = 1024
+# Содержимое файлов до этого размера хранится и отдаётся через cat как есть
+STORE_CONTENT_LIMIT = 1024 * 1024
+CHUNK = 256 * 1024
+
+
+def fake_cid(digest_hex):
+    # CIDv1 dag-pb/sha2-256 с «хешем» из первых 64 hex-символов: разбирается как настоящий
+    digest = bytes.fromhex(digest_hex[:64].ljust(64, '0'))
+    return 'b' + base64.b32encode(b'\x01\x70\x12\x20' + digest).decode('ascii').lower().rstrip('=')
+
+
+def block_cid(data, cid_version=1):
+    # Настоящий CID блока dag-pb с sha2-256, как у block put
+    if cid_version == 1:
+        return fake_cid(hashlib.sha256(data).hexdigest())
+    alphabet = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+    number, chars = int.from_bytes(b'\x12\x20' + hashlib.sha256(data).digest(), 'big'), ''
+    while number:
+        number, rest = divmod(number, 58)
+        chars = alphabet[rest] + chars
+    return chars
+
+
+def fake_content(cid, size):
+    pattern = hashlib.sha256(cid.encode('utf-8')).digest() * 8
+    while size > 0:
+        piece = pattern[:min(size, len(pattern))]
+        size -= len(piece)
+        yield piece
+
+
+def iter_multipart(chunks, boundary):
+    # Потоковый разбор multipart/form-data: (имя файла, sha256, размер, первые байты)
+    it = iter(chunks)
+    delimiter = b'\r\n--' + boundary
+    first = b'--' + boundary
+    buf = b''
+    while first not in buf:
+        buf += next(it)
+    buf = buf[buf.index(first) + len(first):]
+    while True:
+        while len(buf) < 2:
+            chunk = next(it, b'')
+            if not chunk:
+                return
+            buf += chunk
+        if buf.startswith(b'--'):
+            return
+        while b'\r\n\r\n' not in buf:
+            buf += next(it)
+        head, buf = buf.split(b'\r\n\r\n', 1)
+        name = head.split(b'filename="', 1)[1].split(b'"', 1)[0].decode('utf-8') if b'filename="' in head else ''
+        digest = hashlib.sha256()
+        size = 0
+        kept = b''
+        while True:
+            idx = buf.find(delimiter)
+            if idx >= 0:
+                data, buf = buf[:idx], buf[idx + len(delimiter):]
+                digest.update(data)
+                size += len(data)
+                if len(kept) < STORE_CONTENT_LIMIT:
+                    kept += data[:STORE_CONTENT_LIMIT - len(kept)]
+                break
+            if len(buf) > len(delimiter):
+                data, buf = buf[:-len(delimiter)], buf[-len(delimiter):]
+                digest.update(data)
+                size += len(data)
+                if len(kept) < STORE_CONTENT_LIMIT:
+                    kept += data[:STORE_CONTENT_LIMIT - len(kept)]
+            chunk = next(it, None)
+            if chunk is None:
+                raise ValueError('multipart body ended inside a part')
+            buf += chunk
+        yield name, digest.hexdigest(), size, kept
+
+
+def _multipart_content(chunks, boundary):
+    # Содержимое единственной части multipart-тела потоком, без буферизации
+    it = iter(chunks)
+    buf = b''
+    while b'\r\n\r\n' not in buf:
+        buf += next(it)
+    buf = buf.split(b'\r\n\r\n', 1)[1]
+    delimiter = b'\r\n--' + boundary
+    for chunk in it:
+        buf += chunk
+        if len(buf) > len(delimiter) + 4:
+            yield buf[:-(len(delimiter) + 4)]
+            buf = buf[-(len(delimiter) + 4):]
+    yield buf[:buf.index(delimiter)]
+
+
+class PubsubBroker:
+    # Общая шина pubsub: несколько фейковых демонов с одним брокером видят сообщения друг друга
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def subscribe(self, topic):
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.setdefault(topic, []).append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, topic, subscriber):
+        with self.lock:
+            self.subscribers.get(topic, []).remove(subscriber)
+
+    def publish(self, topic, sender, data):
+        with self.lock:
+            subscribers = list(self.subscribers.get(topic, ()))
+        for subscriber in subscribers:
+            subscriber.put((sender, data))
+
+
+def _multibase(data):
+    return 'u' + base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _unmultibase(text):
+    return base64.urlsafe_b64decode(text[1:] + '=' * (-len(text[1:]) % 4))
+
+
+class FakeKuboState:
+    def __init__(self, latency=0.0, extra_pins=0, peers=0, content_size=DEFAULT_CONTENT_SIZE,
+                 peer_id='12D3KooWFakeSelf', pubsub=None):
+        self.latency = latency
+        self.content_size = content_size
+        self.lock = threading.Lock()
+        self.pins = {}
+        self.content = {}
+        self.sizes = {}
+        self.extra_pins = extra_pins
+        self.peers = [f"/ip4/10.0.{i // 256}.{i % 256}/tcp/4001/p2p/12D3KooWFake{i:06d}" for i in range(peers)]
+        self.requests = {}
+        # Файлы MFS: путь -> [размер, sha256 содержимого]; поддерживается только дозапись в конец
+        self.mfs = {}
+        # Блоки, записанные через block put: CID -> содержимое
+        self.blocks = {}
+        self.storage_max = 10 * 1024 ** 3
+        self.config = {'Routing': {'Type': 'auto'}, 'Discovery': {'MDNS': {'Enabled': False}}}
+        self.peer_id = peer_id
+        self.pubsub = pubsub or PubsubBroker()
+
+    def count(self, command):
+        with self.lock:
+            self.requests[command] = self.requests.get(command, 0) + 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def _body_chunks(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return
+                remaining = size
+                while remaining:
+                    data = self.rfile.read(min(remaining, CHUNK))
+                    remaining -= len(data)
+                    yield data
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length') or 0)
+            while remaining:
+                data = self.rfile.read(min(remaining, CHUNK))
+                remaining -= len(data)
+                yield data
+
+    def _send(self, payload, status=200, stream=False):
+        if stream:
+            self.send_response(status)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for piece in payload:
+                self.wfile.write(f"{len(piece):x}\r\n".encode('ascii') + piece + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        state = self.state
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        args = query.get('arg', [])
+        command = url.path[len('/api/v0/'):]
+        state.count(command)
+        if state.latency:
+            time.sleep(state.latency)
+
+        if command == 'add':
+            boundary = self.headers['Content-Type'].split('boundary=', 1)[1].encode('ascii')
+            pin = query.get('pin', ['true'])[0] == 'true' and query.get('only-hash', ['false'])[0] != 'true'
+            progress = query.get('progress', ['false'])[0] == 'true'
+            lines = []
+            chunks = self._body_chunks()
+            for name, digest, size, kept in iter_multipart(chunks, boundary):
+                if progress:
+                    lines.append(json.dumps({'Name': name, 'Bytes': size}).encode('utf-8') + b'\n')
+                cid = fake_cid(digest)
+                with state.lock:
+                    state.sizes[cid] = size
+                    if size <= STORE_CONTENT_LIMIT:
+                        state.content[cid] = kept
+                    if pin:
+                        state.pins[cid] = 'recursive'
+                lines.append(json.dumps({'Name': name, 'Hash': cid, 'Size': str(size)}).encode('utf-8') + b'\n')
+            # Дочитываем хвост тела (завершение chunked), иначе он попадёт в следующий запрос keep-alive
+            for _ in chunks:
+                pass
+            self._send(lines, stream=True)
+        elif command == 'files/write':
+            boundary = self.headers['Content-Type'].split('boundary=', 1)[1].encode('ascii')
+            offset = int(query.get('offset', ['0'])[0])
+            with state.lock:
+                entry = state.mfs.get(args[0])
+                if entry is None:
+                    entry = state.mfs[args[0]] = [0, hashlib.sha256()]
+            if offset != entry[0]:
+                for _ in self._body_chunks():
+                    pass
+                self._send(json.dumps({'Message': f'fake mfs supports appends only ({offset} != {entry[0]})',
+                                       'Type': 'error'}).encode(), status=500)
+                return
+            for piece in _multipart_content(self._body_chunks(), boundary):
+                entry[1].update(piece)
+                entry[0] += len(piece)
+            self._send(b'')
+        elif command == 'files/stat' and args[0].startswith('/ipfs/'):
+            cid = args[0][len('/ipfs/'):]
+            with state.lock:
+                size = state.sizes.get(cid, state.content_size)
+            self._send(json.dumps({'Hash': cid, 'Size': size, 'CumulativeSize': size,
+                                   'Type': 'file'}).encode('utf-8'))
+        elif command == 'block/put':
+            boundary = self.headers['Content-Type'].split('boundary=', 1)[1].encode('ascii')
+            data = b''.join(_multipart_content(self._body_chunks(), boundary))
+            cid = block_cid(data, 0 if query.get('format', [''])[0] == 'v0' else 1)
+            with state.lock:
+                state.blocks[cid] = data
+            self._send(json.dumps({'Key': cid, 'Size': len(data)}).encode('utf-8'))
+        elif command == 'files/stat':
+            entry = state.mfs.get(args[0])
+            if entry is None:
+                self._send(json.dumps({'Message': 'file does not exist', 'Type': 'error'}).encode(), status=500)
+                return
+            cid = fake_cid(entry[1].hexdigest())
+            with state.lock:
+                state.sizes[cid] = entry[0]
+            self._send(json.dumps({'Hash': cid, 'Size': entry[0], 'Type': 'file'}).encode('utf-8'))
+        elif command == 'files/rm':
+            state.mfs.pop(args[0], None)
+            self._send(b'')
+        elif command == 'cat':
+            cid = args[0]
+            with state.lock:
+                content = state.content.get(cid)
+                size = state.sizes.get(cid, state.content_size)
+            self._send([content] if content is not None else fake_content(cid, size), stream=True)
+        elif command == 'pin/add':
+            with state.lock:
+                for cid in args:
+                    state.pins[cid] = 'recursive'
+            self._send(json.dumps({'Pins': args}).encode('utf-8'))
+        elif command == 'pin/rm':
+            with state.lock:
+                for cid in args:
+                    state.pins.pop(cid, None)
+            self._send(json.dumps({'Pins': args}).encode('utf-8'))
+        elif command == 'pin/ls':
+            pin_type = query.get('type', ['all'])[0]
+            with state.lock:
+                pins = dict(state.pins)
+            if args:
+                missing = [cid for cid in args if cid not in pins]
+                if missing:
+                    self._send(json.dumps({'Message': f'path {missing[0]} is not pinned', 'Type': 'error'}).encode(),
+                               status=500)
+                    return
+                pins = {cid: pins[cid] for cid in args}
+
+            def lines():
+                for cid, listed_type in pins.items():
+                    if pin_type in ('all', listed_type):
+                        yield json.dumps({'Cid': cid, 'Type': listed_type}).encode('utf-8') + b'\n'
+                if not args and pin_type in ('all', 'indirect'):
+                    for i in range(state.extra_pins):
+                        yield json.dumps({'Cid': fake_cid(f'{i:064x}'), 'Type': 'indirect'}).encode('utf-8') + b'\n'
+            self._send(lines(), stream=True)
+        elif command == 'repo/stat':
+            with state.lock:
+                size = sum(state.sizes.values())
+            self._send(json.dumps({'RepoSize': size, 'StorageMax': state.storage_max}).encode('utf-8'))
+        elif command == 'repo/gc':
+            with state.lock:
+                removed = [cid for cid in state.sizes if cid not in state.pins]
+                for cid in removed:
+                    state.sizes.pop(cid, None)
+                    state.content.pop(cid, None)
+            self._send([json.dumps({'Key': {'/': cid}}).encode('utf-8') + b'\n' for cid in removed], stream=True)
+        elif command == 'swarm/peers':
+            peers = [{'Addr': p.rsplit('/p2p/', 1)[0], 'Peer': p.rsplit('/', 1)[1]} for p in state.peers]
+            self._send(json.dumps({'Peers': peers}).encode('utf-8'))
+        elif command == 'id':
+            self._send(json.dumps({'ID': state.peer_id, 'Addresses': []}).encode('utf-8'))
+        elif command == 'pubsub/pub':
+            boundary = self.headers['Content-Type'].split('boundary=', 1)[1].encode('ascii')
+            data = b''.join(_multipart_content(self._body_chunks(), boundary))
+            state.pubsub.publish(_unmultibase(args[0]), state.peer_id, data)
+            self._send(b'')
+        elif command == 'pubsub/sub':
+            topic = _unmultibase(args[0])
+            subscriber = state.pubsub.subscribe(topic)
+
+            def messages():
+                # Поток до отключения клиента: запись в закрытый сокет завершает обработчик
+                try:
+                    while True:
+                        sender, data = subscriber.get()
+                        yield json.dumps({'from': sender, 'data': _multibase(data),
+                                          'topicIDs': [_multibase(topic)]}).encode('utf-8') + b'\n'
+                finally:
+                    state.pubsub.unsubscribe(topic, subscriber)
+            self._send(messages(), stream=True)
+        elif command == 'config/show':
+            with state.lock:
+                self._send(json.dumps(state.config).encode('utf-8'))
+        elif command == 'config/replace':
+            boundary = self.headers['Content-Type'].split('boundary=', 1)[1].encode('ascii')
+            config = json.loads(b''.join(_multipart_content(self._body_chunks(), boundary)))
+            with state.lock:
+                state.config = config
+            self._send(b'')
+        elif command == 'config':
+            value = args[1] if len(args) > 1 else None
+            self._send(json.dumps({'Key': args[0] if args else '', 'Value': value}).encode('utf-8'))
+        else:
+            self._send(b'{}')
+
+
+def start_fake_kubo(state, host='127.0.0.1', port=0, idle_timeout=None):
+    # idle_timeout — через сколько секунд простоя сервер закрывает keep-alive соединение
+    handler = type('FakeKuboHandler', (_Handler,), {'state': state, 'timeout': idle_timeout})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-kubo', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Фейковый RPC API Kubo для бенчмарков')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--extra-pins', type=int, default=0)
+    parser.add_argument('--peers', type=int, default=0)
+    options = parser.parse_args()
+    server = start_fake_kubo(FakeKuboState(options.latency_ms / 1000, options.extra_pins, options.peers),
+                             port=options.port)
+    print(f"fake kubo listening on 127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,404 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+from datetime import datetime
+
+# Бенчмарки горячих путей ноды на фейковом Kubo (RPC-сервер fake_kubo.py или CLI fake_ipfs.py).
+#
+#   python benchmarks/run_benchmarks.py                       # быстрый набор сценариев через RPC
+#   python benchmarks/run_benchmarks.py --mode cli            # те же сценарии через фейковый CLI
+#   python benchmarks/run_benchmarks.py --scenarios all --scale 0.1
+#
+# Каждый сценарий выполняется в отдельном процессе (чистый пиковый RSS), результаты
+# пишутся в benchmarks/results/<время>_<коммит>.json для сравнения между коммитами.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+GIB = 1024 ** 3
+
+SCENARIOS = {
+    'backlog_small_1k': ('backlog', {'count': 1000, 'size': 1024}),
+    'backlog_small_10k': ('backlog', {'count': 10000, 'size': 1024}),
+    'backlog_small_100k': ('backlog', {'count': 100000, 'size': 1024}),
+    'large_files': ('large', {'count': 3, 'size': 2 * GIB}),
+    'steady_events': ('steady', {'rate': 50, 'duration': 10}),
+    'sync_1k': ('sync', {'count': 1000}),
+    'sync_10k': ('sync', {'count': 10000}),
+    'pin_check_10k': ('pin_check', {'count': 10000, 'extra_pins': 100000, 'cycles': 5}),
+}
+DEFAULT_SCENARIOS = ['backlog_small_1k', 'steady_events', 'sync_1k', 'pin_check_10k']
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[int(round((len(ordered) - 1) * q))]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КиБ, macOS — байты
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+class BenchContext:
+    def __init__(self, workdir, mode, latency):
+        self.workdir = workdir
+        self.mode = mode
+        self.latency = latency
+        self.upload_dir = os.path.join(workdir, 'Upload')
+        self.synced_dir = os.path.join(workdir, 'Synced_dir')
+        self.data_dir = os.path.join(workdir, 'data')
+        self.mapping_file = os.path.join(self.data_dir, 'file_cid_mapping.json')
+        self.deleted_files_path = os.path.join(self.data_dir, 'deleted_files.json')
+        for path in (self.upload_dir, self.synced_dir, self.data_dir):
+            os.makedirs(path, exist_ok=True)
+        self.logger = logging.getLogger('bench')
+        self.logger.setLevel(logging.INFO)
+        self.logger.handlers = [logging.NullHandler()]
+        self.logger.propagate = False
+        self.subprocess_count = 0
+        self._count_subprocesses()
+        self.server_state = None
+
+        from fake_kubo import FakeKuboState, start_fake_kubo
+        ipfs_dir = os.path.join(workdir, 'ipfs')
+        os.makedirs(ipfs_dir, exist_ok=True)
+        os.environ['IPFS_PATH'] = ipfs_dir
+        self.fake_state_dir = os.path.join(workdir, 'fake_cli_state')
+        os.environ['FAKE_IPFS_STATE'] = self.fake_state_dir
+        os.environ['FAKE_IPFS_LATENCY_MS'] = str(latency * 1000)
+        self.ipfs_path = os.path.join(BENCH_DIR, 'fake_ipfs.py')
+        os.chmod(self.ipfs_path, 0o755)
+        if mode == 'rpc':
+            self.server_state = FakeKuboState(latency=latency)
+            self.server = start_fake_kubo(self.server_state)
+            port = self.server.server_port
+        else:
+            # Закрытый порт: клиент сразу уходит в CLI-фолбэк
+            port = 9
+        with open(os.path.join(ipfs_dir, 'api'), 'w') as f:
+            f.write(f'/ip4/127.0.0.1/tcp/{port}')
+
+    def _count_subprocesses(self):
+        original_init = subprocess.Popen.__init__
+        context = self
+
+        def counting_init(self, *args, **kwargs):
+            context.subprocess_count += 1
+            original_init(self, *args, **kwargs)
+        subprocess.Popen.__init__ = counting_init
+
+    def make_files(self, count, size, per_dir=1000):
+        paths = []
+        block = os.urandom(min(size, 64 * 1024)) if size else b''
+        for i in range(count):
+            directory = os.path.join(self.upload_dir, f'd{i // per_dir:04d}')
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f'file{i:06d}.bin')
+            with open(path, 'wb') as f:
+                # Уникальный префикс, чтобы у каждого файла был свой CID
+                f.write(f'{i:08d}'.encode('ascii'))
+                remaining = max(size - 8, 0)
+                while remaining > 0:
+                    piece = block[:remaining]
+                    f.write(piece)
+                    remaining -= len(piece)
+            paths.append(path)
+        return paths
+
+    def requests(self):
+        if self.server_state is not None:
+            return dict(self.server_state.requests)
+        return {}
+
+
+def _timed_batches(latencies):
+    import file_monitor
+    original = file_monitor.NewFileHandler.add_files_to_ipfs
+
+    def timed(self, file_paths, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original(self, file_paths, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+    file_monitor.NewFileHandler.add_files_to_ipfs = timed
+
+
+def run_backlog(ctx, count, size):
+    from file_monitor import check_new_files
+    from cid_mapping import FileCidMapping
+    ctx.make_files(count, size)
+    latencies = []
+    _timed_batches(latencies)
+    mapping = FileCidMapping()
+    started = time.perf_counter()
+    check_new_files(ctx.ipfs_path, ctx.upload_dir, 'bench', ctx.logger, mapping, ctx.synced_dir,
+                    ctx.deleted_files_path, mapping_file=ctx.mapping_file)
+    elapsed = time.perf_counter() - started
+    return {'units': len(mapping), 'unit': 'file', 'bytes': count * size, 'seconds': elapsed,
+            'latencies': latencies, 'latency_unit': 'batch'}
+
+
+def run_large(ctx, count, size):
+    from file_monitor import NewFileHandler
+    from cid_mapping import FileCidMapping
+    from large_ingest import ResumableIngest
+    paths = []
+    for i in range(count):
+        path = os.path.join(ctx.upload_dir, f'large{i}.bin')
+        with open(path, 'wb') as f:
+            f.write(f'{i:08d}'.encode('ascii'))
+            f.truncate(size)
+        paths.append(path)
+    mapping = FileCidMapping()
+    large_ingest = ResumableIngest(ctx.ipfs_path, ctx.logger, os.path.join(ctx.data_dir, 'ingest_checkpoints.json'))
+    handler = NewFileHandler(ctx.ipfs_path, 'bench', ctx.logger, mapping, ctx.synced_dir, ctx.deleted_files_path,
+                             upload_dir=ctx.upload_dir, mapping_file=ctx.mapping_file, large_ingest=large_ingest)
+    latencies = []
+    started = time.perf_counter()
+    for path in paths:
+        file_started = time.perf_counter()
+        handler.add_files_to_ipfs([path], sync=False)
+        latencies.append(time.perf_counter() - file_started)
+    elapsed = time.perf_counter() - started
+    return {'units': len(mapping), 'bytes': count * size, 'seconds': elapsed, 'latencies': latencies,
+            'latency_unit': 'file'}
+
+
+def run_steady(ctx, rate, duration):
+    import file_monitor
+    from cid_mapping import FileCidMapping
+    created, done = {}, {}
+    original = file_monitor.NewFileHandler.add_files_to_ipfs
+
+    def tracking(self, file_paths, *args, **kwargs):
+        result = original(self, file_paths, *args, **kwargs)
+        now = time.perf_counter()
+        for path in file_paths:
+            done[path] = now
+        return result
+    file_monitor.NewFileHandler.add_files_to_ipfs = tracking
+
+    mapping = FileCidMapping()
+    handler = file_monitor.NewFileHandler(ctx.ipfs_path, 'bench', ctx.logger, mapping, ctx.synced_dir,
+                                          ctx.deleted_files_path, debounce=0.2, upload_dir=ctx.upload_dir,
+                                          mapping_file=ctx.mapping_file)
+    handler.start()
+    total = int(rate * duration)
+    started = time.perf_counter()
+    for i in range(total):
+        path = os.path.join(ctx.upload_dir, f'event{i:06d}.bin')
+        with open(path, 'wb') as f:
+            f.write(f'{i:08d}'.encode('ascii') * 128)
+        created[path] = time.perf_counter()
+        handler.queue_file(path)
+        delay = started + (i + 1) / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    deadline = time.perf_counter() + 60
+    while len(done) < total and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    handler.stop()
+    latencies = [done[path] - created[path] for path in created if path in done]
+    return {'units': len(done), 'bytes': total * 1024, 'seconds': elapsed, 'latencies': latencies,
+            'latency_unit': 'event', 'queue': handler.ingest_queue.stats()}
+
+
+def run_sync(ctx, count):
+    import ipfs_client
+    from file_sync import sync_files_to_synced_dir
+    from cid_mapping import FileCidMapping
+    from fake_kubo import fake_cid
+    latencies = []
+    lock = threading.Lock()
+    original_get = ipfs_client.IpfsClient.get
+
+    def timed_get(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original_get(self, *args, **kwargs)
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - started)
+    ipfs_client.IpfsClient.get = timed_get
+
+    mapping = FileCidMapping({f'd{i // 1000:04d}/file{i:06d}.bin': fake_cid(f'{i:064x}') for i in range(count)})
+    started = time.perf_counter()
+    sync_files_to_synced_dir(ctx.ipfs_path, ctx.synced_dir, ctx.logger, mapping, ctx.deleted_files_path, full=True)
+    elapsed = time.perf_counter() - started
+    return {'units': len(latencies), 'bytes': count * 1024, 'seconds': elapsed, 'latencies': latencies,
+            'latency_unit': 'download'}
+
+
+def run_pin_check(ctx, count, extra_pins, cycles):
+    from network_manager import list_pinned_files
+    from cid_mapping import FileCidMapping
+    from fake_kubo import fake_cid
+    cids = [fake_cid(f'{i:064x}') for i in range(count)]
+    if ctx.server_state is not None:
+        ctx.server_state.pins.update({cid: 'recursive' for cid in cids})
+        ctx.server_state.extra_pins = extra_pins
+    else:
+        os.makedirs(ctx.fake_state_dir, exist_ok=True)
+        with open(os.path.join(ctx.fake_state_dir, 'pins.log'), 'w') as f:
+            f.write('\n'.join(cids) + '\n')
+    mapping = FileCidMapping({f'file{i:06d}.bin': cid for i, cid in enumerate(cids)})
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(cycles):
+        cycle_started = time.perf_counter()
+        list_pinned_files(ctx.ipfs_path, 'bench', ctx.logger, mapping, ctx.synced_dir, ctx.deleted_files_path,
+                          sync=False)
+        latencies.append(time.perf_counter() - cycle_started)
+    elapsed = time.perf_counter() - started
+    return {'units': cycles, 'bytes': 0, 'seconds': elapsed, 'latencies': latencies, 'latency_unit': 'cycle'}
+
+
+RUNNERS = {
+    'backlog': run_backlog,
+    'large': run_large,
+    'steady': run_steady,
+    'sync': run_sync,
+    'pin_check': run_pin_check,
+}
+
+
+def scaled(params, scale):
+    result = dict(params)
+    for key in ('count', 'size', 'duration', 'extra_pins'):
+        if key in result:
+            result[key] = max(1, int(result[key] * scale))
+    return result
+
+
+def run_one(name, mode, latency, scale, keep_workdir=False):
+    kind, params = SCENARIOS[name]
+    params = scaled(params, scale)
+    workdir = tempfile.mkdtemp(prefix=f'ipfs_bench_{name}_')
+    try:
+        ctx = BenchContext(workdir, mode, latency)
+        raw = RUNNERS[kind](ctx, **params)
+    finally:
+        if not keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    seconds = raw['seconds']
+    latencies = raw.pop('latencies')
+    # units считаются в unit, латентности — в latency_unit (для backlog: файлы и батчи)
+    latency_unit = raw.pop('latency_unit')
+    result = {
+        'scenario': name,
+        'mode': mode,
+        'params': params,
+        'units': raw.pop('units'),
+        'unit': raw.pop('unit', latency_unit),
+        'bytes': raw.pop('bytes'),
+        'seconds': round(seconds, 4),
+        'latency_unit': latency_unit,
+        'latency_samples': len(latencies),
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'subprocess_count': ctx.subprocess_count,
+        'peak_rss_mb': round(peak_rss_mb(), 1) if peak_rss_mb() is not None else None,
+        'rpc_requests': ctx.requests(),
+    }
+    raw.pop('seconds')
+    result['throughput_units_per_s'] = round(result['units'] / seconds, 2) if seconds else None
+    result['throughput_mb_per_s'] = round(result['bytes'] / seconds / (1024 * 1024), 2) if seconds else None
+    result.update(raw)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарки ingest, sync и pin-check на фейковом Kubo')
+    parser.add_argument('--scenarios', default='default',
+                        help="Список через запятую, 'default' или 'all'. Доступны: " + ', '.join(SCENARIOS))
+    parser.add_argument('--mode', choices=('rpc', 'cli'), default='rpc')
+    parser.add_argument('--latency-ms', type=float, default=1.0, help='Задержка фейкового Kubo на вызов')
+    parser.add_argument('--scale', type=float, default=1.0, help='Множитель числа и размера файлов')
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'results'))
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    if options.run_one:
+        result = run_one(options.run_one, options.mode, options.latency_ms / 1000, options.scale)
+        print(json.dumps(result))
+        return 0
+
+    if options.scenarios == 'default':
+        names = DEFAULT_SCENARIOS
+    elif options.scenarios == 'all':
+        names = list(SCENARIOS)
+    else:
+        names = [name.strip() for name in options.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Неизвестные сценарии: {', '.join(unknown)}")
+
+    commit = git_commit()
+    results = []
+    for name in names:
+        print(f"[bench] {name} ({options.mode})...", flush=True)
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-one', name, '--mode', options.mode,
+             '--latency-ms', str(options.latency_ms), '--scale', str(options.scale)],
+            capture_output=True, text=True
+        )
+        if completed.returncode != 0:
+            print(completed.stderr, file=sys.stderr)
+            results.append({'scenario': name, 'mode': options.mode, 'error': completed.stderr.strip()[-2000:]})
+            continue
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print(f"  {result['units']} x {result['unit']} за {result['seconds']} с, "
+              f"{result['throughput_units_per_s']} {result['unit']}/s, p50 {result['latency_p50_ms']} ms, "
+              f"p99 {result['latency_p99_ms']} ms на {result['latency_unit']} ({result['latency_samples']}), "
+              f"subprocesses {result['subprocess_count']}, "
+              f"peak RSS {result['peak_rss_mb']} MiB", flush=True)
+
+    os.makedirs(options.output, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    output_file = os.path.join(options.output, f'{timestamp}_{commit}.json')
+    with open(output_file, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'timestamp': timestamp,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'mode': options.mode,
+            'latency_ms': options.latency_ms,
+            'scale': options.scale,
+            'results': results,
+        }, f, indent=2)
+    print(f"[bench] Результаты записаны в {output_file}")
+    return 0 if all('error' not in r for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
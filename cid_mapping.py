@@ -0,0 +1,346 @@
+import os
+import json
+import threading
+import logging
+from collections import OrderedDict, Counter
+import metrics
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+# Отложенная запись маппинга: журнал дописывается раз в DEFAULT_FLUSH_INTERVAL секунд
+# или после DEFAULT_FLUSH_EVERY изменений, снимок переписывается, когда журнал длиннее
+# DEFAULT_SNAPSHOT_EVERY записей и половины маппинга
+DEFAULT_FLUSH_INTERVAL = 5.0
+DEFAULT_FLUSH_EVERY = 1000
+DEFAULT_SNAPSHOT_EVERY = 10000
+
+
+def journal_path_for(mapping_file):
+    return os.path.join(os.path.dirname(mapping_file), 'file_cid_journal.json')
+
+
+def log_path_for(mapping_file):
+    # Журнал изменений маппинга после последнего снимка: по строке JSON [путь, cid или null]
+    return os.path.join(os.path.dirname(mapping_file), 'file_cid_mapping.log')
+
+
+def _fsync_dir(directory):
+    # Фиксация переименования в каталоге; на Windows каталог открыть нельзя — пропускаем
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_json_atomic(path, data, indent=None):
+    # Запись во временный файл, fsync и атомарное переименование: при сбое остаётся
+    # либо прежний, либо новый файл целиком
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(directory)
+
+
+class FileCidMapping(dict):
+    # Словарь путь -> CID с журналом изменений. Каждое добавление, замена или удаление
+    # получает следующий номер seq; changes_since(seq) отдаёт только изменённые после него пути.
+    def __init__(self, *args, seq=0, changes=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.seq = seq
+        # путь -> seq последнего изменения, упорядочено по seq
+        self._changes = OrderedDict(changes or ())
+        self._lock = threading.RLock()
+        # Колбэк (путь, cid или None, seq) на каждое изменение; его ставит MappingPersister
+        self.on_change = None
+        self.persister = None
+        # LazyCache ленивого режима Synced_dir, если он включён
+        self.lazy_cache = None
+
+    def _record(self, path):
+        self.seq += 1
+        self._changes.pop(path, None)
+        self._changes[path] = self.seq
+        if self.on_change is not None:
+            self.on_change(path, dict.get(self, path), self.seq)
+
+    def __setitem__(self, path, cid):
+        with self._lock:
+            if dict.get(self, path) == cid:
+                return
+            super().__setitem__(path, cid)
+            self._record(path)
+
+    def __delitem__(self, path):
+        with self._lock:
+            super().__delitem__(path)
+            self._record(path)
+
+    def pop(self, path, *default):
+        with self._lock:
+            if path in self:
+                value = super().pop(path)
+                self._record(path)
+                return value
+            return super().pop(path, *default)
+
+    def update(self, *args, **kwargs):
+        for path, cid in dict(*args, **kwargs).items():
+            self[path] = cid
+
+    def setdefault(self, path, cid=None):
+        with self._lock:
+            if path not in self:
+                self[path] = cid
+            return self[path]
+
+    def clear(self):
+        with self._lock:
+            for path in list(self):
+                del self[path]
+
+    def touch(self, path):
+        # Запись в журнал без изменения CID: путь снова попадёт в changes_since
+        with self._lock:
+            if path in self:
+                self._record(path)
+
+    def replay_change(self, path, cid, seq):
+        # Повтор записи журнала с её исходным seq: так восстанавливаются и touch(), и запись
+        # того же CID, которые через __setitem__ seq не двигают. Записи не новее seq снимка
+        # журнала уже учтены в нём, но сам снимок маппинга мог не успеть записаться — для них
+        # восстанавливается только значение, если это последнее изменение пути
+        with self._lock:
+            if seq <= self.seq and self._changes.get(path, seq) != seq:
+                return
+            if cid is None:
+                dict.pop(self, path, None)
+            else:
+                dict.__setitem__(self, path, cid)
+            if seq > self.seq:
+                self._changes.pop(path, None)
+                self._changes[path] = seq
+                self.seq = seq
+
+    def changes_since(self, seq):
+        # Список (путь, cid или None для удалённых) в порядке изменения
+        with self._lock:
+            changed = []
+            for path, change_seq in reversed(self._changes.items()):
+                if change_seq <= seq:
+                    break
+                changed.append((path, dict.get(self, path)))
+            changed.reverse()
+            return changed
+
+    def compact(self, seq):
+        # Забываем записи об удалениях, которые уже обработаны всеми потребителями до seq
+        with self._lock:
+            for path, change_seq in list(self._changes.items()):
+                if change_seq > seq:
+                    break
+                if path not in self:
+                    del self._changes[path]
+
+    def cid_counts(self):
+        # Пары (cid, число путей) по различным CID маппинга
+        with self._lock:
+            return Counter(dict.values(self)).items()
+
+    def journal_state(self):
+        with self._lock:
+            return {'seq': self.seq, 'changes': [[path, seq] for path, seq in self._changes.items()]}
+
+
+def load_file_cid_mapping(mapping_file, logger):
+    with open(mapping_file, 'r') as f:
+        entries = json.load(f)
+    journal_file = journal_path_for(mapping_file)
+    seq, changes = 0, []
+    if os.path.exists(journal_file):
+        try:
+            with open(journal_file, 'r') as f:
+                journal = json.load(f)
+            seq = journal.get('seq', 0)
+            changes = [(path, change_seq) for path, change_seq in journal.get('changes', [])]
+        except Exception as e:
+            logger.error(f"MAPPING_JOURNAL_ERROR: Не удалось прочитать журнал {journal_file}: {e}")
+    if not changes:
+        # Журнала нет (старый формат): все записи считаются изменёнными в seq 1..N
+        changes = [(path, i + 1) for i, path in enumerate(entries)]
+        seq = max(seq, len(changes))
+    file_cid_mapping = FileCidMapping(entries, seq=seq, changes=changes)
+    replay_mapping_log(mapping_file, file_cid_mapping, logger)
+    return file_cid_mapping
+
+
+def replay_mapping_log(mapping_file, file_cid_mapping, logger):
+    # Применение изменений, записанных после последнего снимка. Недописанная при сбое
+    # последняя строка отбрасывается; повторное применение уже вошедших в снимок записей безвредно
+    log_file = log_path_for(mapping_file)
+    if not os.path.exists(log_file):
+        return 0
+    applied = 0
+    with open(log_file, 'r') as f:
+        for line_no, line in enumerate(f, 1):
+            try:
+                entry = json.loads(line)
+                path, cid = entry[0], entry[1]
+            except (ValueError, TypeError, IndexError):
+                logger.warning(f"MAPPING_LOG: Недописанная запись в строке {line_no} журнала {log_file} отброшена")
+                break
+            if len(entry) > 2:
+                file_cid_mapping.replay_change(path, cid, entry[2])
+            elif cid is None:
+                file_cid_mapping.pop(path, None)
+            else:
+                file_cid_mapping[path] = cid
+            applied += 1
+    if applied:
+        logger.info(f"MAPPING_LOG: Из журнала {log_file} применено {applied} изменений")
+    return applied
+
+
+def save_mapping_journal(mapping_file, file_cid_mapping):
+    write_json_atomic(journal_path_for(mapping_file), file_cid_mapping.journal_state())
+
+
+class MappingPersister:
+    # Отложенная (write-behind) запись FileCidMapping в JSON-файлы. Изменения копятся в памяти
+    # и дописываются в журнал file_cid_mapping.log (append + fsync) раз в flush_interval секунд,
+    # после flush_every изменений или по flush(). Полный снимок file_cid_mapping.json пишется
+    # через временный файл с fsync и переименованием, после чего журнал обрезается.
+    # Стоимость сохранения пачки — O(изменений), а не O(всего маппинга).
+    def __init__(self, mapping_file, file_cid_mapping, logger, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 flush_every=DEFAULT_FLUSH_EVERY, snapshot_every=DEFAULT_SNAPSHOT_EVERY):
+        self.mapping_file = mapping_file
+        self.mapping = file_cid_mapping
+        self.logger = logger
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.snapshot_every = snapshot_every
+        self.log_file = log_path_for(mapping_file)
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._log = None
+        self._log_entries = 0
+        file_cid_mapping.on_change = self._on_change
+        file_cid_mapping.persister = self
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if os.path.exists(self.log_file) and os.path.getsize(self.log_file) > 0:
+            # Журнал уже применён при загрузке: свежий снимок заодно отрезает недописанный хвост
+            self.snapshot()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='mapping-persister', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.snapshot()
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+        self.mapping.on_change = None
+        self.mapping.persister = None
+
+    def _on_change(self, path, cid, seq):
+        # Вызывается под блокировкой маппинга
+        with self._lock:
+            self._pending.append((path, cid, seq))
+            full = len(self._pending) >= self.flush_every
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                if self._log_entries >= max(self.snapshot_every, len(self.mapping) // 2):
+                    self.snapshot()
+            except Exception as e:
+                self.logger.error(f"MAPPING_PERSIST_ERROR: Ошибка при сохранении {self.mapping_file}: {e}")
+
+    def _append(self, entries):
+        # Вызывается под self._lock
+        if self._log is None:
+            self._log = open(self.log_file, 'a')
+        self._log.write(''.join(json.dumps([path, cid, seq]) + '\n' for path, cid, seq in entries))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._log_entries += len(entries)
+        metrics.inc('mapping_log_entries_total', len(entries))
+
+    def flush(self):
+        # Дописывает накопленные изменения в журнал; после возврата они переживут сбой
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            with metrics.timer('mapping_flush'):
+                self._append(pending)
+        self.logger.debug(f"MAPPING_PERSIST: Appended {len(pending)} changes to {self.log_file}")
+
+    def snapshot(self):
+        with metrics.timer('mapping_snapshot'):
+            with self.mapping._lock:
+                with self._lock:
+                    pending, self._pending = self._pending, []
+                    if pending:
+                        self._append(pending)
+                    covered = self._log.tell() if self._log is not None else None
+                data = dict(self.mapping)
+                journal_state = self.mapping.journal_state()
+            # Сначала журнал seq: при сбое между двумя записями seq может только опередить снимок
+            write_json_atomic(journal_path_for(self.mapping_file), journal_state)
+            write_json_atomic(self.mapping_file, data, indent=2)
+            with self._lock:
+                self._truncate_log(covered)
+        self.logger.debug(f"MAPPING_PERSIST: Snapshot of {len(data)} entries written to {self.mapping_file}")
+
+    def _truncate_log(self, covered):
+        # Вызывается под self._lock: из журнала убираются записи, вошедшие в снимок
+        if covered is None:
+            if os.path.exists(self.log_file):
+                covered = os.path.getsize(self.log_file)
+            else:
+                return
+        tail = b''
+        if os.path.exists(self.log_file):
+            with open(self.log_file, 'rb') as f:
+                f.seek(covered)
+                tail = f.read()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        tmp_path = f"{self.log_file}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.log_file)
+        _fsync_dir(os.path.dirname(self.log_file))
+        self._log_entries = tail.count(b'\n')
@@ -0,0 +1,221 @@
+import sys
+import time
+import signal
+import asyncio
+import logging
+from collections import deque
+from ipfs_client import IpfsError, get_client
+from async_ipfs import AsyncIpfsClient
+import metrics
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+# Сколько ждать готовности API после запуска демона (миграция репозитория может идти долго)
+DEFAULT_READY_TIMEOUT = 300
+# Опрос готовности: первая пауза и её предел при экспоненциальном росте
+READY_POLL_INITIAL = 0.1
+READY_POLL_MAX = 2.0
+PROBE_TIMEOUT = 5
+# Проверка демона, запущенного не нами: интервал и число неудачных проверок до запуска своего
+DEFAULT_PROBE_INTERVAL = 30
+DEFAULT_PROBE_FAILURES = 3
+# Перезапуск после падения: пауза растёт вдвое до предела и сбрасывается,
+# если демон перед падением проработал не меньше stable_uptime секунд
+DEFAULT_RESTART_BACKOFF = 1.0
+DEFAULT_MAX_RESTART_BACKOFF = 60.0
+DEFAULT_STABLE_UPTIME = 60.0
+DEFAULT_STOP_TIMEOUT = 30
+# Последние строки вывода демона для сообщения об ошибке запуска
+OUTPUT_TAIL = 20
+# Строка, которой Kubo сообщает о готовности: по ней опрос API выполняется сразу, без паузы
+READY_LINE = 'Daemon is ready'
+
+
+class DaemonSupervisor:
+    # Запуск и наблюдение за демоном ipfs. Вывод демона построчно уходит в лог (stdout — INFO,
+    # stderr — WARNING), готовность определяется опросом RPC API с растущей паузой, упавший
+    # демон перезапускается. Если демон уже был запущен кем-то другим, он используется как есть
+    # и только проверяется; свой запускается, если внешний перестал отвечать.
+    def __init__(self, ipfs_path, logger, daemon_args=(), ready_timeout=DEFAULT_READY_TIMEOUT,
+                 probe_interval=DEFAULT_PROBE_INTERVAL, probe_failures=DEFAULT_PROBE_FAILURES,
+                 restart_backoff=DEFAULT_RESTART_BACKOFF, max_restart_backoff=DEFAULT_MAX_RESTART_BACKOFF,
+                 stable_uptime=DEFAULT_STABLE_UPTIME, stop_timeout=DEFAULT_STOP_TIMEOUT):
+        self.ipfs_path = ipfs_path
+        self.logger = logger
+        self.daemon_args = list(daemon_args)
+        self.ready_timeout = ready_timeout
+        self.probe_interval = probe_interval
+        self.probe_failures = probe_failures
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self.stable_uptime = stable_uptime
+        self.stop_timeout = stop_timeout
+        self.process = None
+        self.external = False
+        self.restarts = 0
+        self._started_at = None
+        self._drain_tasks = []
+        self._monitor_task = None
+        self._stopping = False
+        self._tail = deque(maxlen=OUTPUT_TAIL)
+        self._ready_line = asyncio.Event()
+
+    async def _probe(self, timeout=PROBE_TIMEOUT):
+        # Только RPC API: CLI-фолбэк ответил бы на id и без демона. Адрес читается заново,
+        # потому что демон пишет файл api при старте
+        client = AsyncIpfsClient(self.ipfs_path, self.logger)
+        try:
+            await client.call('id', timeout=timeout)
+            return True
+        except (IpfsError, OSError, EOFError, ValueError):
+            return False
+
+    async def _drain(self, stream, level):
+        # Непрочитанный PIPE заполняется, и демон блокируется на записи в него
+        while True:
+            line = await stream.readline()
+            if not line:
+                return
+            text = line.decode('utf-8', 'replace').rstrip()
+            if text:
+                if READY_LINE in text:
+                    self._ready_line.set()
+                self._tail.append(text)
+                self.logger.log(level, f"IPFS_DAEMON: {text}")
+
+    async def _spawn(self):
+        self._tail.clear()
+        self._ready_line.clear()
+        self.process = None
+        self.process = await asyncio.create_subprocess_exec(
+            self.ipfs_path, 'daemon', *self.daemon_args,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        self._started_at = time.monotonic()
+        self._drain_tasks = [
+            asyncio.create_task(self._drain(self.process.stdout, logging.INFO), name='daemon-stdout'),
+            asyncio.create_task(self._drain(self.process.stderr, logging.WARNING), name='daemon-stderr'),
+        ]
+        metrics.inc('ipfs_daemon_starts_total')
+        self.logger.info(f"DAEMON_START: Демон IPFS запущен, PID {self.process.pid}")
+
+    async def _wait_ready(self):
+        started = time.monotonic()
+        deadline = started + self.ready_timeout
+        delay = READY_POLL_INITIAL
+        exited = asyncio.ensure_future(self.process.wait())
+        ready_line = asyncio.ensure_future(self._ready_line.wait())
+        try:
+            while True:
+                if exited.done():
+                    tail = '; '.join(self._tail) or 'нет вывода'
+                    raise IpfsError(f"демон завершился с кодом {exited.result()} до готовности API: {tail}")
+                if await self._probe(timeout=min(PROBE_TIMEOUT, max(deadline - time.monotonic(), 0.1))):
+                    break
+                if time.monotonic() >= deadline:
+                    raise IpfsError(f"API демона не ответил за {self.ready_timeout} с")
+                # Пауза прерывается, если демон завершился или сообщил о готовности
+                await asyncio.wait({exited, ready_line}, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                delay = READY_POLL_INITIAL if ready_line.done() else min(delay * 2, READY_POLL_MAX)
+        finally:
+            for waiter in (exited, ready_line):
+                if not waiter.done():
+                    waiter.cancel()
+        elapsed = time.monotonic() - started
+        metrics.observe('ipfs_daemon_ready_seconds', elapsed)
+        metrics.set_gauge('ipfs_daemon_up', 1)
+        # Синхронный клиент мог пометить HTTP недоступным, пока демон поднимался
+        get_client(self.ipfs_path, self.logger).refresh_api()
+        self.logger.info(f"DAEMON_READY: API демона IPFS готов через {elapsed:.1f} с")
+
+    async def _launch(self):
+        await self._spawn()
+        try:
+            await self._wait_ready()
+        except BaseException:
+            await self._terminate()
+            raise
+
+    async def start(self):
+        # Возвращается, когда API демона готов; IpfsError, если демон не поднялся
+        self._stopping = False
+        if await self._probe():
+            self.external = True
+            metrics.set_gauge('ipfs_daemon_up', 1)
+            self.logger.info("DAEMON: Демон IPFS уже запущен, используется он")
+        else:
+            self.external = False
+            await self._launch()
+        self._monitor_task = asyncio.create_task(self._monitor(), name='daemon-supervisor')
+
+    async def _monitor(self):
+        backoff = self.restart_backoff
+        failures = 0
+        while not self._stopping:
+            if self.external:
+                await asyncio.sleep(self.probe_interval)
+                if await self._probe():
+                    failures = 0
+                    continue
+                failures += 1
+                self.logger.warning(f"DAEMON: Демон IPFS не отвечает ({failures} из {self.probe_failures} проверок)")
+                if failures < self.probe_failures:
+                    continue
+                metrics.set_gauge('ipfs_daemon_up', 0)
+                self.logger.error("DAEMON: Внешний демон IPFS недоступен, запуск собственного")
+                self.external = False
+            elif self.process is None:
+                # Запуск не удался ещё до появления процесса (например, не найден исполняемый файл)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_restart_backoff)
+            else:
+                returncode = await self.process.wait()
+                await asyncio.gather(*self._drain_tasks, return_exceptions=True)
+                if self._stopping:
+                    return
+                metrics.set_gauge('ipfs_daemon_up', 0)
+                metrics.inc('ipfs_daemon_crashes_total')
+                uptime = time.monotonic() - self._started_at
+                if uptime >= self.stable_uptime:
+                    backoff = self.restart_backoff
+                self.logger.error(f"DAEMON_EXITED: Демон IPFS завершился с кодом {returncode} после {uptime:.0f} с "
+                                  f"работы, перезапуск через {backoff:.1f} с")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_restart_backoff)
+            try:
+                await self._launch()
+                self.restarts += 1
+                failures = 0
+            except (IpfsError, OSError) as e:
+                self.logger.error(f"DAEMON_ERROR: Не удалось перезапустить демон IPFS: {e}")
+
+    async def _terminate(self):
+        process = self.process
+        if process is None:
+            return
+        if process.returncode is None:
+            # Kubo корректно завершается по SIGINT; на Windows доступен только terminate
+            if sys.platform == 'win32':
+                process.terminate()
+            else:
+                process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), self.stop_timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning(f"DAEMON: Демон IPFS не завершился за {self.stop_timeout} с, принудительная остановка")
+                process.kill()
+                await process.wait()
+        await asyncio.gather(*self._drain_tasks, return_exceptions=True)
+        metrics.set_gauge('ipfs_daemon_up', 0)
+
+    async def stop(self):
+        # Останавливает наблюдение и демон, если его запускал supervisor; внешний демон не трогается
+        self._stopping = True
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            await asyncio.gather(self._monitor_task, return_exceptions=True)
+            self._monitor_task = None
+        if not self.external and self.process is not None:
+            await self._terminate()
+            self.logger.info("DAEMON_STOP: Демон IPFS остановлен")
@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from cid_mapping import write_json_atomic
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+DEFAULT_MAX_ENTRIES = 100000
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(file_path):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FingerprintCache:
+    # Кэш отпечатков уже добавленных файлов -> CID, чтобы не гонять повторный ipfs add.
+    # Быстрый путь — ключ (размер, mtime, inode); если он не совпал, файл хешируется
+    # потоково и ищется по содержимому. Обе таблицы ограничены max_entries (LRU).
+    def __init__(self, cache_file=None, logger=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.cache_file = cache_file
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_entries = max_entries
+        self._by_stat = OrderedDict()
+        self._by_digest = OrderedDict()
+        self._lock = threading.Lock()
+        # Изменения с последнего save(): периодическое сохранение без изменений ничего не пишет
+        self._dirty = False
+        self.stat_hits = 0
+        self.hash_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _stat_key(file_path):
+        st = os.stat(file_path)
+        return f"{st.st_size}:{st.st_mtime_ns}:{st.st_ino}"
+
+    def _put(self, table, key, value):
+        table[key] = value
+        table.move_to_end(key)
+        self._dirty = True
+        while len(table) > self.max_entries:
+            table.popitem(last=False)
+            self.evictions += 1
+
+    def lookup(self, file_path):
+        # Возвращает (cid или None, digest или None); digest пригодится для record()
+        stat_key = self._stat_key(file_path)
+        with self._lock:
+            entry = self._by_stat.get(stat_key)
+            if entry is not None:
+                self._by_stat.move_to_end(stat_key)
+                self.stat_hits += 1
+                return entry[0], entry[1]
+        digest = hash_file(file_path)
+        with self._lock:
+            cid = self._by_digest.get(digest)
+            if cid is not None:
+                self._by_digest.move_to_end(digest)
+                self._put(self._by_stat, stat_key, (cid, digest))
+                self.hash_hits += 1
+                return cid, digest
+            self.misses += 1
+        return None, digest
+
+    def record(self, file_path, cid, digest=None):
+        try:
+            stat_key = self._stat_key(file_path)
+            if digest is None:
+                digest = hash_file(file_path)
+        except OSError:
+            return
+        with self._lock:
+            self._put(self._by_stat, stat_key, (cid, digest))
+            self._put(self._by_digest, digest, cid)
+
+    def forget_cids(self, cids):
+        # CID отпинен и мог быть собран GC: содержимое больше не считается известным
+        cids = set(cids)
+        if not cids:
+            return 0
+        with self._lock:
+            stale_stat = [key for key, (cid, _) in self._by_stat.items() if cid in cids]
+            stale_digest = [digest for digest, cid in self._by_digest.items() if cid in cids]
+            for key in stale_stat:
+                del self._by_stat[key]
+            for digest in stale_digest:
+                del self._by_digest[digest]
+            if stale_stat or stale_digest:
+                self._dirty = True
+        return len(stale_digest)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.stat_hits + self.hash_hits + self.misses
+            return {
+                'entries': len(self._by_digest),
+                'stat_hits': self.stat_hits,
+                'hash_hits': self.hash_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.stat_hits + self.hash_hits) / lookups if lookups else 0.0,
+            }
+
+    def load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+            with self._lock:
+                for stat_key, cid, digest in data.get('by_stat', []):
+                    self._put(self._by_stat, stat_key, (cid, digest))
+                for digest, cid in data.get('by_digest', []):
+                    self._put(self._by_digest, digest, cid)
+                self._dirty = False
+            self.logger.info(f"DEDUP_CACHE: Загружено {len(self._by_digest)} отпечатков из {self.cache_file}")
+        except Exception as e:
+            self.logger.error(f"DEDUP_CACHE_ERROR: Ошибка при загрузке {self.cache_file}: {e}")
+
+    def save(self):
+        if not self.cache_file:
+            return
+        try:
+            with self._lock:
+                if not self._dirty:
+                    return
+                data = {
+                    'by_stat': [[key, cid, digest] for key, (cid, digest) in self._by_stat.items()],
+                    'by_digest': [[digest, cid] for digest, cid in self._by_digest.items()],
+                }
+                self._dirty = False
+            write_json_atomic(self.cache_file, data)
+            self.logger.debug(f"DEDUP_CACHE: Saved {len(data['by_digest'])} fingerprints to {self.cache_file}")
+        except Exception as e:
+            with self._lock:
+                self._dirty = True
+            self.logger.error(f"DEDUP_CACHE_ERROR: Ошибка при сохранении {self.cache_file}: {e}")
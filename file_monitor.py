@@ -1,109 +1,436 @@
 import os
-import subprocess
 import logging
+import threading
 from datetime import datetime
-from watchdog.events import FileSystemEventHandler
-from file_sync import sync_files_to_synced_dir, save_file_cid_mapping, load_deleted_files, save_deleted_files
+from watchdog.events import FileSystemEventHandler, FileDeletedEvent
+from ipfs_client import get_client, IpfsError
+from ingest_queue import IngestQueue
+import metrics
+from pin_index import get_pin_index
+from large_ingest import profile_for_size, ProgressReporter, DEFAULT_SIZE_CLASSES
+from scanner import UploadScanner, DEFAULT_MEMORY_LIMIT_MB
+from file_sync import (sync_files_to_synced_dir, save_file_cid_mapping, load_deleted_files, save_deleted_files,
+                       deleted_checker, partial_path_for, load_sync_cursor, load_sync_retries, sync_state_path_for,
+                       sync_lock, PARTIAL_SUFFIX)
+from local_export import link_or_clone, DEFAULT_EXPORT_MODE
+from pin_reconciler import activity
+from lazy_cache import LAZY_SUFFIX
 
 # Версия модуля
 MODULE_VERSION = "2.1.7"
 
+# Параметры пакетного добавления по умолчанию
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_DEBOUNCE = 2.0
+DEFAULT_INGEST_WORKERS = 2
+# Для пачек с файлами от этого размера прогресс add пишется в лог
+PROGRESS_LOG_SIZE = 64 * 1024 * 1024
+# Пин уже известного CID: блоки лежат локально, дольше — значит, их собрал GC
+DEDUP_PIN_TIMEOUT = 30
+
 class NewFileHandler(FileSystemEventHandler):
-    def __init__(self, ipfs_path, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path, delete_after_sync=True):
+    def __init__(self, ipfs_path, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path, delete_after_sync=True,
+                 batch_size=DEFAULT_BATCH_SIZE, debounce=DEFAULT_DEBOUNCE, ingest_workers=DEFAULT_INGEST_WORKERS,
+                 dedup_cache=None, only_hash_precheck=False, upload_dir=None, mapping_file=None,
+                 size_classes=DEFAULT_SIZE_CLASSES, large_ingest=None, scan_index=None,
+                 export_mode=DEFAULT_EXPORT_MODE):
         super().__init__()
         self.ipfs_path = ipfs_path
         self.node_name = node_name
         self.logger = logger
-        self.logger.info(f"MODULE_VERSION: file_monitor версия {MODULE_VERSION}")
+        self.logger.debug(f"MODULE_VERSION: file_monitor version {MODULE_VERSION}")
         self.file_cid_mapping = file_cid_mapping
         self.synced_dir = synced_dir
         self.deleted_files_path = deleted_files_path
         self.delete_after_sync = delete_after_sync
+        self.batch_size = batch_size
+        self.dedup_cache = dedup_cache
+        self.only_hash_precheck = only_hash_precheck
+        self.size_classes = size_classes
+        self.large_ingest = large_ingest
+        self.scan_index = scan_index
+        # filestore ссылается на файл в Synced_dir, поэтому исходник в Upload не должен оставаться
+        self.export_mode = 'link' if export_mode == 'filestore' and not delete_after_sync else export_mode
+        self.upload_dir = upload_dir or os.path.join(os.path.dirname(__file__), 'Upload')
+        self.mapping_file = mapping_file or os.path.join(os.path.dirname(__file__), 'data', 'file_cid_mapping.json')
+        self.ingest_queue = IngestQueue(self.add_files_to_ipfs, logger, workers=ingest_workers,
+                                        debounce=debounce, batch_size=batch_size)
+        # Обновление маппинга, его сохранение и синхронизация выполняются по одной пачке за раз
+        self._mapping_lock = threading.Lock()
+
+    def start(self):
+        self.ingest_queue.start()
+        # Состояние очереди снимается при каждом запросе /metrics
+        for key in ('depth', 'in_flight', 'enqueued', 'coalesced', 'processed', 'requeued_unstable', 'wait_time_max'):
+            metrics.register_gauge(f'ingest_queue_{key}', lambda key=key: self.ingest_queue.stats()[key])
+        if self.dedup_cache is not None:
+            for key in ('entries', 'stat_hits', 'hash_hits', 'misses', 'evictions', 'hit_rate'):
+                metrics.register_gauge(f'dedup_cache_{key}', lambda key=key: self.dedup_cache.stats()[key])
+
+    def stop(self):
+        self.ingest_queue.stop()
+        if self.dedup_cache is not None:
+            stats = self.dedup_cache.stats()
+            self.logger.info(f"DEDUP_CACHE: Отпечатков {stats['entries']}, попаданий по stat {stats['stat_hits']}, "
+                             f"по содержимому {stats['hash_hits']}, промахов {stats['misses']} "
+                             f"(доля попаданий {stats['hit_rate']:.1%})")
+            self.dedup_cache.save()
 
     def on_created(self, event):
+        if not event.is_directory and self.upload_dir in event.src_path:
+            self.logger.debug(f"NEW_FILE: New file detected: {event.src_path}")
+            self.queue_file(event.src_path)
+
+    def on_modified(self, event):
         if not event.is_directory:
-            self.logger.info(f"NEW_FILE: Обнаружен новый файл: {event.src_path}")
-            self.add_to_ipfs(event.src_path)
+            self.queue_file(event.src_path)
 
-    def on_deleted(self, event):
+    def on_moved(self, event):
         if not event.is_directory:
+            self.queue_file(event.dest_path)
+
+    def queue_file(self, file_path):
+        # Обработчик не блокирует поток наблюдателя: файл уходит в очередь с debounce
+        if self.upload_dir not in file_path:
+            return
+        self.ingest_queue.put(file_path)
+
+    def on_deleted(self, event):
+        if not event.is_directory and not event.src_path.endswith(PARTIAL_SUFFIX):
             try:
                 if self.synced_dir in event.src_path:
                     relative_path = os.path.relpath(event.src_path, self.synced_dir)
-                    deleted_files = load_deleted_files(self.deleted_files_path, self.logger)
-                    if relative_path not in deleted_files:
-                        deleted_files.append(relative_path)
-                        save_deleted_files(self.deleted_files_path, deleted_files, self.logger)
+                    # Удалённая заглушка ленивого режима означает удаление самого файла
+                    if relative_path.endswith(LAZY_SUFFIX):
+                        relative_path = relative_path[:-len(LAZY_SUFFIX)]
+                    lazy_cache = getattr(self.file_cid_mapping, 'lazy_cache', None)
+                    if lazy_cache is not None:
+                        lazy_cache.forget(relative_path)
+                    store = getattr(self.file_cid_mapping, 'store', None)
+                    if store is not None:
+                        newly_deleted = store.mark_deleted(relative_path)
+                    else:
+                        deleted_files = load_deleted_files(self.deleted_files_path, self.logger)
+                        newly_deleted = relative_path not in deleted_files
+                        if newly_deleted:
+                            deleted_files.append(relative_path)
+                            save_deleted_files(self.deleted_files_path, deleted_files, self.logger)
+                    if newly_deleted:
                         self.logger.info(
                             f"REMOVE_FILE_SYNCED: Файл {relative_path} удалён из Synced_dir в {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
             except ValueError as e:
                 self.logger.debug(f"REMOVE_FILE_SKIPPED: Пропущен файл {event.src_path}, не в Synced_dir: {e}")
 
+    def rescan(self, directories):
+        # Восстановление после потери событий наблюдателем (переполнение очереди inotify, новый
+        # каталог, появившийся раньше своего watch): файлы Upload из этих каталогов, которых нет
+        # в индексе сканирования, ставятся в очередь добавления, а пропавшие из Synced_dir файлы
+        # отмечаются удалёнными так же, как по событию удаления
+        upload = [d for d in directories if d == self.upload_dir or d.startswith(self.upload_dir + os.sep)]
+        synced = [d for d in directories if d == self.synced_dir or d.startswith(self.synced_dir + os.sep)]
+        queued = lost = 0
+        if upload:
+            scanner = UploadScanner(self.upload_dir, self.logger, scan_index=self.scan_index, roots=upload)
+            for batch in scanner.batches(is_mapped=self.file_cid_mapping.__contains__):
+                for file_path in batch:
+                    self.queue_file(file_path)
+                queued += len(batch)
+        if synced:
+            # Проход синхронизации в это время создаёт ещё не выгруженные файлы — ждём его окончания
+            with sync_lock:
+                missing = self._missing_synced_files(synced)
+            for dest_path in missing:
+                self.on_deleted(FileDeletedEvent(dest_path))
+            lost = len(missing)
+        self.logger.info(f"RESCAN: Пересканировано каталогов: {len(directories)}, в очередь добавления: {queued}, "
+                         f"отмечено удалёнными: {lost}")
+        return queued, lost
+
+    def _missing_synced_files(self, directories):
+        # Файлы маппинга под directories, которых нет в Synced_dir, хотя синхронизация их уже обработала.
+        # Изменения после курсора синхронизации ещё могут выгружаться и не считаются пропавшими
+        mapping = self.file_cid_mapping
+        if not hasattr(mapping, 'changes_since'):
+            return []
+        store = getattr(mapping, 'store', None)
+        state_file = sync_state_path_for(self.deleted_files_path)
+        cursor = load_sync_cursor(state_file, self.logger, store, mapping)
+        pending = {path for path, _ in mapping.changes_since(cursor)}
+        pending.update(load_sync_retries(state_file, self.logger, store))
+        is_deleted = deleted_checker(mapping, self.deleted_files_path, self.logger)
+        lazy_cache = getattr(mapping, 'lazy_cache', None)
+        prefixes = [os.path.relpath(d, self.synced_dir) for d in directories]
+        missing = []
+        for path, _ in list(mapping.items()):
+            if path in pending:
+                continue
+            relative_path = path.replace("Upload/", "", 1)
+            if not any(prefix == '.' or relative_path.startswith(prefix + os.sep) for prefix in prefixes):
+                continue
+            dest_path = os.path.join(self.synced_dir, relative_path)
+            if os.path.exists(dest_path) or is_deleted(relative_path):
+                continue
+            if lazy_cache is not None and os.path.exists(lazy_cache.placeholder_path(relative_path)):
+                continue
+            missing.append(dest_path)
+        return missing
+
+    def _dedup_files(self, client, files):
+        # Делит пачку на уже известные по содержимому файлы (add не нужен) и файлы для добавления
+        if self.dedup_cache is None and not self.only_hash_precheck:
+            return [], files, {}
+        reused, to_add, digests = [], [], {}
+        index = get_pin_index(self.ipfs_path, self.logger)
+        for relative_path, file_path in files:
+            cid = None
+            if self.dedup_cache is not None:
+                cid, digests[file_path] = self.dedup_cache.lookup(file_path)
+            if cid is not None and not index.is_unpinned(cid):
+                reused.append((file_path, relative_path, cid))
+            else:
+                to_add.append((relative_path, file_path))
+
+        if self.only_hash_precheck and to_add:
+            store = getattr(self.file_cid_mapping, 'store', None)
+            known_cids = None if store is not None else set(self.file_cid_mapping.values())
+            remaining = []
+            # CID считается с профилем класса размера файла — тем же, с которым файл добавлялся бы
+            by_layout = {}
+            for relative_path, file_path in to_add:
+                layout = tuple(sorted(profile_for_size(os.path.getsize(file_path), self.size_classes).items()))
+                by_layout.setdefault(layout, []).append((relative_path, file_path))
+            hashed = ((item, entry) for layout, group in by_layout.items()
+                      for item, entry in zip(group, client.add(group, only_hash=True, **dict(layout))))
+            for (relative_path, file_path), entry in hashed:
+                cid = entry['Hash']
+                known = bool(store.paths_for_cid(cid)) if store is not None else cid in known_cids
+                known = known and not index.is_unpinned(cid)
+                if known:
+                    reused.append((file_path, relative_path, cid))
+                    if self.dedup_cache is not None:
+                        self.dedup_cache.record(file_path, cid, digests.get(file_path))
+                else:
+                    remaining.append((relative_path, file_path))
+            to_add = remaining
+
+        if reused:
+            # Содержимое уже в IPFS: только убеждаемся, что CID запинен. Если блоков уже нет
+            # (отпинены и собраны GC), пин ждал бы их из сети — такие файлы добавляются заново
+            cids = {cid for _, _, cid in reused}
+            try:
+                client.pin_add(*cids, timeout=DEDUP_PIN_TIMEOUT)
+            except IpfsError as e:
+                self.logger.warning(f"ADD_DEDUP: Не удалось запинить {len(cids)} известных CID, файлы будут "
+                                    f"добавлены заново: {e.stderr}")
+                if self.dedup_cache is not None:
+                    self.dedup_cache.forget_cids(cids)
+                to_add.extend((relative_path, file_path) for file_path, relative_path, _ in reused)
+                return [], to_add, digests
+            index.note_pinned(cids)
+            metrics.inc('ingest_files_total', len(reused), result='dedup')
+            for file_path, relative_path, cid in reused:
+                self.logger.debug(f"ADD_DEDUP: File {relative_path} already added as {cid}, ipfs add skipped")
+        return reused, to_add, digests
+
+    def _add_filestore(self, client, group_files, layout, progress, digests, added, exported):
+        # Файлы переносятся на своё место в Synced_dir и добавляются с --nocopy: blockstore ссылается
+        # на эти байты, второй копии нет. Возвращает файлы для обычного add (цель уже занята,
+        # файл удалён пользователем, перенос между ФС невозможен или filestore недоступен)
+        is_deleted = deleted_checker(self.file_cid_mapping, self.deleted_files_path, self.logger)
+        moved, rest = [], []
+        for relative_path, file_path in group_files:
+            dest_path = os.path.join(self.synced_dir, relative_path)
+            if os.path.exists(dest_path) or is_deleted(relative_path):
+                rest.append((relative_path, file_path))
+                continue
+            try:
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                os.replace(file_path, dest_path)
+            except OSError as e:
+                self.logger.debug(f"FILESTORE: Cannot move {file_path} to {dest_path}: {e}")
+                rest.append((relative_path, file_path))
+                continue
+            moved.append((relative_path, file_path, dest_path))
+        if not moved:
+            return rest
+        try:
+            results = list(client.add([(relative_path, dest_path) for relative_path, _, dest_path in moved],
+                                      pin=True, nocopy=True, progress=progress, **layout))
+        except IpfsError as e:
+            # Перенос отменяется: файлы вернутся в очередь по событию перемещения в Upload
+            self.logger.error(f"FILESTORE_ERROR: Добавление с --nocopy не удалось, режим выгрузки "
+                              f"переключён на link: {e.stderr}")
+            self.export_mode = 'link'
+            for _, file_path, dest_path in moved:
+                try:
+                    os.replace(dest_path, file_path)
+                except OSError as move_error:
+                    self.logger.error(f"FILESTORE_ERROR: Не удалось вернуть {dest_path} в Upload: {move_error}")
+            return rest
+        for (relative_path, file_path, dest_path), entry in zip(moved, results):
+            added.append((dest_path, relative_path, entry['Hash']))
+            exported.add(dest_path)
+            if self.dedup_cache is not None:
+                self.dedup_cache.record(dest_path, entry['Hash'], digests.get(file_path))
+        metrics.inc('export_local_total', len(results), method='filestore')
+        return rest
+
+    def _export_local(self, added, exported):
+        # Добавленный файл ещё лежит в Upload: Synced_dir получает reflink или жёсткую ссылку на него
+        # вместо копии из blockstore (ссылка — только если исходник сразу удаляется из Upload)
+        is_deleted = deleted_checker(self.file_cid_mapping, self.deleted_files_path, self.logger)
+        for file_path, path, cid in added:
+            dest_path = os.path.join(self.synced_dir, path)
+            if file_path in exported or os.path.exists(dest_path) or is_deleted(path):
+                continue
+            try:
+                method = link_or_clone(file_path, dest_path, partial_path_for(dest_path),
+                                       allow_hardlink=self.delete_after_sync)
+            except OSError as e:
+                self.logger.debug(f"EXPORT_LOCAL: Cannot link {file_path} to {dest_path}: {e}")
+                continue
+            if method is not None:
+                self.logger.debug(f"EXPORT_LOCAL: File {path} ({cid}) exported to Synced_dir via {method}")
+
+    def _group_by_layout(self, files):
+        # Файлы пачки группируются по профилю раскладки их класса размера;
+        # файлы от порога large_ingest идут отдельно, сегментами с контрольными точками
+        groups, large = {}, []
+        for relative_path, file_path in files:
+            size = os.path.getsize(file_path)
+            if self.large_ingest is not None and size >= self.large_ingest.threshold:
+                large.append((relative_path, file_path, size))
+                continue
+            layout = tuple(sorted(profile_for_size(size, self.size_classes).items()))
+            groups.setdefault(layout, []).append((relative_path, file_path, size))
+        return groups, large
+
     def add_to_ipfs(self, file_path):
-        self.logger.info(f"ADD_TO_IPFS_START: Начало добавления файла {file_path} в IPFS")
+        self.add_files_to_ipfs([file_path])
+
+    def add_files_to_ipfs(self, file_paths, sync=True):
+        with activity.busy(), metrics.span('add_to_ipfs', files=len(file_paths), sync=sync):
+            self._add_files_to_ipfs(file_paths, sync)
+
+    def _add_files_to_ipfs(self, file_paths, sync):
+        self.logger.debug(f"ADD_TO_IPFS_START: Adding {len(file_paths)} files to IPFS")
         try:
-            upload_dir = os.path.join(os.path.dirname(__file__), 'Upload')
-            if upload_dir not in file_path:
-                self.logger.warning(f"ADD_TO_IPFS_SKIPPED: Файл {file_path} не в Upload, пропущен")
+            upload_dir = self.upload_dir
+            files = []
+            for file_path in file_paths:
+                if upload_dir not in file_path:
+                    self.logger.warning(f"ADD_TO_IPFS_SKIPPED: Файл {file_path} не в Upload, пропущен")
+                    continue
+                relative_path = os.path.relpath(file_path, upload_dir)
+                self.logger.debug(f"ADD_TO_IPFS: Processing file {file_path}, relative path: {relative_path}")
+                files.append((relative_path, file_path))
+            if not files:
                 return
 
-            relative_path = os.path.relpath(file_path, upload_dir)
-            self.logger.debug(f"ADD_TO_IPFS: Processing file {file_path}, relative path: {relative_path}")
-            result = subprocess.run(
-                [self.ipfs_path, 'add', '-r', file_path],
-                capture_output=True, text=True, check=True
-            )
-            self.logger.debug(f"ADD_OUTPUT: Вывод команды ipfs add: {result.stdout}")
-
-            for line in result.stdout.splitlines():
-                if line.startswith('added'):
-                    parts = line.split()
-                    cid = parts[1]
-                    path = parts[2] if len(parts) > 2 else relative_path
-                    self.file_cid_mapping[path] = cid
-                    self.logger.info(
-                        f"ADD_FILE: Файл {path} добавлен с CID {cid} в {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-                    subprocess.run(
-                        [self.ipfs_path, 'pin', 'add', cid],
-                        capture_output=True, text=True, check=True
-                    )
-                    self.logger.info(f"PIN_ADD: Файл {path} запинен с CID {cid}")
-
-            mapping_file = os.path.join(os.path.dirname(__file__), 'data', 'file_cid_mapping.json')
-            save_file_cid_mapping(mapping_file, self.file_cid_mapping, self.logger)
-            sync_files_to_synced_dir(self.ipfs_path, self.synced_dir, self.logger, self.file_cid_mapping,
-                                    self.deleted_files_path)
+            client = get_client(self.ipfs_path, self.logger)
+            added, files, digests = self._dedup_files(client, files)
+            reused_count = len(added)
 
-            if self.delete_after_sync:
+            # Один вызов add с --pin на каждый класс размера в пачке, результаты разбираются за один проход
+            groups, large = self._group_by_layout(files)
+            exported = set()
+            for layout, group in groups.items():
+                total = sum(size for _, _, size in group)
+                progress = None
+                if max(size for _, _, size in group) >= PROGRESS_LOG_SIZE:
+                    progress = ProgressReporter(self.logger, f"пачка из {len(group)} файлов", total)
+                group_files = [(relative_path, file_path) for relative_path, file_path, _ in group]
+                if self.export_mode == 'filestore':
+                    group_files = self._add_filestore(client, group_files, dict(layout), progress, digests, added,
+                                                      exported)
+                for (relative_path, file_path), entry in zip(group_files, client.add(group_files, pin=True,
+                                                                                    progress=progress, **dict(layout))):
+                    added.append((file_path, entry['Name'], entry['Hash']))
+                    if self.dedup_cache is not None:
+                        self.dedup_cache.record(file_path, entry['Hash'], digests.get(file_path))
+            for relative_path, file_path, size in large:
                 try:
-                    os.remove(file_path)
-                    self.logger.info(f"DELETE_AFTER_SYNC: Файл {file_path} удалён из Upload после синхронизации")
-                except Exception as e:
-                    self.logger.error(f"DELETE_AFTER_SYNC_ERROR: Ошибка при удалении файла {file_path}: {e}")
-
-            self.logger.info("ADD_TO_IPFS_END: Завершение добавления файла в IPFS")
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f"ADD_ERROR: Ошибка при добавлении файла {file_path}: {e.stderr}")
+                    cid = self.large_ingest.ingest(file_path, relative_path, profile_for_size(size, self.size_classes))
+                except (IpfsError, OSError) as e:
+                    error = e.stderr if isinstance(e, IpfsError) else e
+                    self.logger.error(f"LARGE_INGEST_ERROR: Добавление {relative_path} прервано, "
+                                      f"продолжится с контрольной точки: {error}")
+                    continue
+                if cid is None:
+                    continue
+                added.append((file_path, relative_path, cid))
+                if self.dedup_cache is not None:
+                    self.dedup_cache.record(file_path, cid, digests.get(file_path))
+
+            metrics.inc('ingest_files_total', len(added) - reused_count, result='added')
+            with self._mapping_lock, metrics.timer('mapping_update'):
+                lazy_cache = getattr(self.file_cid_mapping, 'lazy_cache', None)
+                if lazy_cache is not None:
+                    # Отметка до обновления маппинга: синхронизация не заменит эти файлы заглушками
+                    lazy_cache.mark_local((path, cid) for _, path, cid in added)
+                # Одно обновление маппинга на пачку (в базе состояния — одна транзакция)
+                self.file_cid_mapping.update({path: cid for _, path, cid in added})
+                get_pin_index(self.ipfs_path, self.logger).note_pinned({cid for _, _, cid in added})
+                store = getattr(self.file_cid_mapping, 'store', None)
+                if store is not None:
+                    store.set_pin_status({cid for _, _, cid in added}, 'pinned')
+                for file_path, path, cid in added:
+                    self.logger.debug(f"ADD_FILE: File {path} added and pinned as {cid}")
+                save_file_cid_mapping(self.mapping_file, self.file_cid_mapping, self.logger)
+                if self.export_mode != 'copy':
+                    self._export_local(added, exported)
+                if sync:
+                    sync_files_to_synced_dir(self.ipfs_path, self.synced_dir, self.logger, self.file_cid_mapping,
+                                            self.deleted_files_path, export_mode=self.export_mode)
+            added_paths = [file_path for file_path, _, _ in added if file_path not in exported]
+            if self.scan_index is not None and not self.delete_after_sync:
+                # Оставшиеся в Upload файлы не будут повторно добавлены при следующем старте
+                self.scan_index.record_files((path, file_path) for file_path, path, _ in added)
+
+            if self.delete_after_sync:
+                for file_path in added_paths:
+                    try:
+                        os.remove(file_path)
+                        self.logger.debug(f"DELETE_AFTER_SYNC: File {file_path} removed from Upload")
+                    except Exception as e:
+                        self.logger.error(f"DELETE_AFTER_SYNC_ERROR: Ошибка при удалении файла {file_path}: {e}")
+
+            self.logger.info(
+                f"ADD_TO_IPFS_END: Добавлено в IPFS {len(added_paths)} файлов "
+                f"(из них без ipfs add по дедупликации: {reused_count}) в {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        except IpfsError as e:
+            self.logger.error(f"ADD_ERROR: Ошибка при добавлении файлов {file_paths}: {e.stderr}")
         except Exception as e:
-            self.logger.error(f"ADD_ERROR: Общая ошибка при добавления файла {file_path}: {e}")
+            self.logger.error(f"ADD_ERROR: Общая ошибка при добавлении файлов {file_paths}: {e}")
 
-def check_new_files(ipfs_path, upload_dir, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path):
-    logger.info(f"MODULE_VERSION: file_monitor версия {MODULE_VERSION}")
+def check_new_files(ipfs_path, upload_dir, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path,
+                    batch_size=DEFAULT_BATCH_SIZE, dedup_cache=None, only_hash_precheck=False, mapping_file=None,
+                    size_classes=DEFAULT_SIZE_CLASSES, large_ingest=None, scan_index=None,
+                    memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB, export_mode=DEFAULT_EXPORT_MODE, stop_event=None):
+    # stop_event (threading.Event) прерывает проверку между пачками, стартовая полная сверка тогда не выполняется
+    logger.debug(f"MODULE_VERSION: file_monitor version {MODULE_VERSION}")
     logger.info("CHECK_NEW_FILES_START: Начало проверки новых файлов")
     try:
         if not os.path.exists(upload_dir):
             logger.error(f"CHECK_NEW_FILES_ERROR: Папка {upload_dir} не существует")
             return
-        for root, _, files in os.walk(upload_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                relative_path = os.path.relpath(file_path, upload_dir)
-                if relative_path not in file_cid_mapping:
-                    logger.debug(f"CHECK_NEW_FILES: Found new file {file_path}")
-                    handler = NewFileHandler(ipfs_path, node_name, logger, file_cid_mapping, synced_dir,
-                                            deleted_files_path)
-                    handler.add_to_ipfs(file_path)
-        sync_files_to_synced_dir(ipfs_path, synced_dir, logger, file_cid_mapping, deleted_files_path)
+        handler = NewFileHandler(ipfs_path, node_name, logger, file_cid_mapping, synced_dir,
+                                 deleted_files_path, batch_size=batch_size, dedup_cache=dedup_cache,
+                                 only_hash_precheck=only_hash_precheck, upload_dir=upload_dir, mapping_file=mapping_file,
+                                 size_classes=size_classes, large_ingest=large_ingest, scan_index=scan_index,
+                                 export_mode=export_mode)
+        # Потоковый обход: пачки уходят в add по мере нахождения, без списка всех файлов в памяти
+        scanner = UploadScanner(upload_dir, logger, scan_index=scan_index, batch_size=batch_size,
+                                memory_limit_mb=memory_limit_mb)
+        for batch in scanner.batches(is_mapped=file_cid_mapping.__contains__, stop_event=stop_event):
+            logger.debug(f"CHECK_NEW_FILES: Found {len(batch)} new files")
+            handler.add_files_to_ipfs(batch, sync=False)
+        if stop_event is not None and stop_event.is_set():
+            logger.info("CHECK_NEW_FILES_END: Проверка новых файлов прервана остановкой")
+            return
+        # Стартовая проверка — единственное место, где Synced_dir сверяется со всем маппингом
+        sync_files_to_synced_dir(ipfs_path, synced_dir, logger, file_cid_mapping, deleted_files_path, full=True,
+                                 export_mode=handler.export_mode)
         logger.info("CHECK_NEW_FILES_END: Завершение проверки новых файлов")
     except Exception as e:
         logger.error(f"CHECK_NEW_FILES_ERROR: Ошибка при проверке новых файлов: {e}")
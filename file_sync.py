@@ -1,24 +1,89 @@
 import os
-import subprocess
 import json
+import time
+import random
+import shutil
+import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from ipfs_client import get_client, IpfsError
+from cid_mapping import FileCidMapping, save_mapping_journal, write_json_atomic
+from pin_index import get_pin_index
+from local_export import link_or_clone, DEFAULT_EXPORT_MODE
+from pin_reconciler import activity
+import metrics
 
 # Версия модуля
 MODULE_VERSION = "2.1.7"
 
-def backup_file_cid_mapping(mapping_file, logger):
-    logger.info(f"MODULE_VERSION: file_sync версия {MODULE_VERSION}")
+# Параметры загрузки в Synced_dir по умолчанию
+DEFAULT_SYNC_CONCURRENCY = 8
+DEFAULT_SYNC_TIMEOUT = 300
+DEFAULT_SYNC_RETRIES = 3
+DEFAULT_SYNC_BACKOFF = 1.0
+# Недокачанные файлы лежат рядом с целевым под этим суффиксом до атомарного переименования
+PARTIAL_SUFFIX = '.ipfs-part'
+PIN_BATCH_SIZE = 100
+# Не загрузившийся файл откладывается в таблицу повторов, и курсор синхронизации идёт дальше.
+# Повтор — через RETRY_DELAY, удваиваясь с каждой неудачей до RETRY_MAX_DELAY
+RETRY_DELAY = 300
+RETRY_MAX_DELAY = 6 * 3600
+# Сколько последних снимков хранить в data/backups
+DEFAULT_BACKUP_KEEP = 10
+
+# Проходы синхронизации не должны пересекаться: они делят курсор sync_state.json.
+# Этот же замок держит пересканирование Synced_dir после потери событий наблюдателя
+sync_lock = threading.Lock()
+
+def _rotate_backups(backup_dir, prefix, keep, logger):
+    # Имена снимков содержат метку времени, поэтому сортировка по имени — по возрасту
+    backups = sorted(name for name in os.listdir(backup_dir) if name.startswith(prefix))
+    for name in backups[:max(0, len(backups) - keep)]:
+        try:
+            os.remove(os.path.join(backup_dir, name))
+            logger.debug(f"BACKUP_MAPPING: Removed old snapshot {name}")
+        except OSError as e:
+            logger.warning(f"BACKUP_MAPPING: Не удалось удалить старый снимок {name}: {e}")
+    return backups[-keep:] if keep else []
+
+def backup_file_cid_mapping(mapping_file, logger, store=None, keep=DEFAULT_BACKUP_KEEP):
+    # Ротация снимков: новый снимок создаётся, только если состояние изменилось с прошлого,
+    # в каталоге backups остаются keep последних
+    logger.debug(f"MODULE_VERSION: file_sync version {MODULE_VERSION}")
     logger.info("BACKUP_MAPPING_START: Начало создания резервной копии file_cid_mapping.json")
     try:
-        if os.path.exists(mapping_file):
-            backup_dir = os.path.join(os.path.dirname(mapping_file), 'backups')
+        backup_dir = os.path.join(os.path.dirname(mapping_file), 'backups')
+        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        if store is not None:
+            # Онлайн-снимок базы состояния вместо копирования JSON
+            seq = store.seq
+            if store.get_meta('backup_seq') == seq:
+                logger.info("BACKUP_MAPPING: База состояния не менялась с прошлого снимка, пропуск")
+            else:
+                os.makedirs(backup_dir, exist_ok=True)
+                backup_file = os.path.join(backup_dir, f'state_{timestamp}.db')
+                store.backup(backup_file)
+                store.set_meta('backup_seq', seq)
+                logger.info(f"BACKUP_MAPPING: Создан снимок базы состояния {backup_file}")
+            if os.path.isdir(backup_dir):
+                _rotate_backups(backup_dir, 'state_', keep, logger)
+        elif os.path.exists(mapping_file):
             os.makedirs(backup_dir, exist_ok=True)
-            timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-            backup_file = os.path.join(backup_dir, f'file_cid_mapping_{timestamp}.json')
-            with open(mapping_file, 'r') as src, open(backup_file, 'w') as dst:
-                dst.write(src.read())
-            logger.info(f"BACKUP_MAPPING: Создана резервная копия {backup_file}")
+            previous = _rotate_backups(backup_dir, 'file_cid_mapping_', keep, logger)
+            latest = os.path.join(backup_dir, previous[-1]) if previous else None
+            if latest is not None and os.path.samefile(latest, mapping_file):
+                logger.info("BACKUP_MAPPING: Снимок file_cid_mapping.json не менялся с прошлого, пропуск")
+            else:
+                # Снимок маппинга только заменяется переименованием и не правится на месте,
+                # поэтому жёсткая ссылка на него — полноценная резервная копия без копирования
+                backup_file = os.path.join(backup_dir, f'file_cid_mapping_{timestamp}.json')
+                try:
+                    os.link(mapping_file, backup_file)
+                except OSError:
+                    shutil.copy2(mapping_file, backup_file)
+                _rotate_backups(backup_dir, 'file_cid_mapping_', keep, logger)
+                logger.info(f"BACKUP_MAPPING: Создана резервная копия {backup_file}")
         else:
             logger.info("BACKUP_MAPPING: Файл file_cid_mapping.json не существует, пропуск резервного копирования")
         logger.info("BACKUP_MAPPING_END: Завершение создания резервной копии")
@@ -30,70 +95,335 @@ def load_deleted_files(deleted_files_path, logger):
         if os.path.exists(deleted_files_path):
             with open(deleted_files_path, 'r') as f:
                 return json.load(f)
-        logger.info(f"DELETED_FILES: Файл {deleted_files_path} не существует, возвращается пустой список")
+        logger.debug(f"DELETED_FILES: {deleted_files_path} does not exist, returning an empty list")
         return []
     except Exception as e:
         logger.error(f"DELETED_FILES_ERROR: Ошибка при загрузке deleted_files.json: {e}")
         return []
 
 def save_deleted_files(deleted_files_path, deleted_files, logger):
-    logger.info(f"MODULE_VERSION: file_sync версия {MODULE_VERSION}")
-    logger.info("SAVE_DELETED_FILES_START: Начало сохранения deleted_files.json")
+    logger.debug(f"MODULE_VERSION: file_sync version {MODULE_VERSION}")
+    logger.debug("SAVE_DELETED_FILES_START: Saving deleted_files.json")
     try:
         os.makedirs(os.path.dirname(deleted_files_path), exist_ok=True)
         with open(deleted_files_path, 'w') as f:
             json.dump(deleted_files, f, indent=2)
-        logger.info(f"DELETED_FILES: Сохранён список удалённых файлов в {deleted_files_path}")
-        logger.info("SAVE_DELETED_FILES_END: Завершение сохранения deleted_files.json")
+        logger.debug(f"DELETED_FILES: Saved deleted files list to {deleted_files_path}")
     except Exception as e:
         logger.error(f"DELETED_FILES_ERROR: Ошибка при сохранении deleted_files.json: {e}")
 
 def save_file_cid_mapping(mapping_file, file_cid_mapping, logger):
-    logger.info(f"MODULE_VERSION: file_sync версия {MODULE_VERSION}")
-    logger.info("SAVE_FILE_CID_MAPPING_START: Начало сохранения file_cid_mapping.json")
+    logger.debug(f"MODULE_VERSION: file_sync version {MODULE_VERSION}")
+    if getattr(file_cid_mapping, 'store', None) is not None:
+        # Маппинг в базе состояния: каждое изменение уже зафиксировано транзакцией
+        logger.debug("SAVE_FILE_CID_MAPPING: Mapping is backed by the state store, nothing to save")
+        return
+    persister = getattr(file_cid_mapping, 'persister', None)
     try:
-        os.makedirs(os.path.dirname(mapping_file), exist_ok=True)
-        with open(mapping_file, 'w') as f:
-            json.dump(file_cid_mapping, f, indent=2)
-        logger.info(f"SAVE_FILE_CID_MAPPING: Сохранён file_cid_mapping.json в {mapping_file}")
-        logger.info("SAVE_FILE_CID_MAPPING_END: Завершение сохранения file_cid_mapping.json")
+        if persister is not None:
+            # Отложенная запись: дописываются только изменения с прошлого сохранения
+            persister.flush()
+            return
+        logger.debug("SAVE_FILE_CID_MAPPING_START: Saving file_cid_mapping.json")
+        with metrics.timer('mapping_save'):
+            if isinstance(file_cid_mapping, FileCidMapping):
+                save_mapping_journal(mapping_file, file_cid_mapping)
+            write_json_atomic(mapping_file, dict(file_cid_mapping), indent=2)
+        logger.debug(f"SAVE_FILE_CID_MAPPING: Saved {len(file_cid_mapping)} entries to {mapping_file}")
     except Exception as e:
         logger.error(f"SAVE_FILE_CID_MAPPING_ERROR: Ошибка при сохранении file_cid_mapping.json: {e}")
 
-def sync_files_to_synced_dir(ipfs_path, synced_dir, logger, file_cid_mapping, deleted_files_path):
-    logger.info(f"MODULE_VERSION: file_sync версия {MODULE_VERSION}")
-    logger.info("SYNC_FILES_START: Начало синхронизации файлов в Synced_dir")
+def partial_path_for(dest_path):
+    return os.path.join(os.path.dirname(dest_path), f".{os.path.basename(dest_path)}{PARTIAL_SUFFIX}")
+
+def remove_quietly(path):
+    # Удаление файла из Synced_dir, которое наблюдатель не примет за удаление пользователем:
+    # файл сначала переименовывается в служебное имя, события по которому пропускаются
+    partial_path = partial_path_for(path)
+    os.replace(path, partial_path)
+    os.remove(partial_path)
+
+def deleted_checker(file_cid_mapping, deleted_files_path, logger):
+    # Функция проверки пути по множеству удалённых из Synced_dir файлов
+    store = getattr(file_cid_mapping, 'store', None)
+    if store is not None:
+        return store.is_deleted
+    return set(load_deleted_files(deleted_files_path, logger)).__contains__
+
+def _download_file(client, path, cid, dest_path, logger, timeout, retries, backoff, local_source=None):
+    partial_path = partial_path_for(dest_path)
+    if local_source is not None:
+        # То же содержимое уже лежит в Synced_dir под другим путём: reflink вместо копии из blockstore.
+        # Жёсткая ссылка здесь недопустима — правка одного файла изменила бы и другой
+        try:
+            method = link_or_clone(local_source, dest_path, partial_path, allow_hardlink=False)
+        except OSError as e:
+            logger.debug(f"SYNC_FILE: Reflink from {local_source} failed: {e}")
+            method = None
+        if method is not None:
+            logger.debug(f"SYNC_FILE: File {path} ({cid}) exported from {local_source} via {method}")
+            metrics.inc('sync_downloads_total', result=method)
+            return True
+    for attempt in range(retries + 1):
+        try:
+            logger.debug(f"SYNC_FILE: Downloading {path} with CID {cid} to {dest_path} (attempt {attempt + 1})")
+            client.get(cid, partial_path, timeout=timeout)
+            os.replace(partial_path, dest_path)
+            logger.debug(f"SYNC_FILE: File {path} ({cid}) downloaded to {dest_path}")
+            metrics.inc('sync_downloads_total', result='ok')
+            return True
+        except (IpfsError, OSError) as e:
+            error = e.stderr if isinstance(e, IpfsError) else e
+            if attempt < retries:
+                metrics.inc('sync_download_retries_total')
+                delay = backoff * (2 ** attempt) * (1 + random.random() / 2)
+                logger.warning(
+                    f"SYNC_FILE_RETRY: Ошибка при загрузке файла {path} с CID {cid}: {error}. "
+                    f"Повтор через {delay:.1f} с")
+                time.sleep(delay)
+            else:
+                logger.error(f"SYNC_FILE_ERROR: Ошибка при загрузке файла {path} с CID {cid}: {error}")
+                metrics.inc('sync_downloads_total', result='failed')
     try:
-        os.makedirs(synced_dir, exist_ok=True)
-        deleted_files = load_deleted_files(deleted_files_path, logger)
-        if not file_cid_mapping:
-            logger.info("SYNC_FILES: file_cid_mapping.json пуст, синхронизация не требуется")
-            logger.info("SYNC_FILES_END: Завершение синхронизации файлов в Synced_dir")
-            return
+        os.remove(partial_path)
+    except OSError:
+        pass
+    return False
+
+def sync_state_path_for(deleted_files_path):
+    return os.path.join(os.path.dirname(deleted_files_path), 'sync_state.json')
+
+def _load_sync_state(state_file, logger, store, key, default):
+    if store is not None:
+        return store.get_meta(key, default)
+    try:
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                return json.load(f).get(key, default)
+    except Exception as e:
+        logger.error(f"SYNC_STATE_ERROR: Ошибка при загрузке {state_file}: {e}")
+    return default
+
+def _save_sync_state(state_file, logger, store, key, value):
+    if store is not None:
+        store.set_meta(key, value)
+        return
+    try:
+        state = {}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+        state[key] = value
+        write_json_atomic(state_file, state)
+    except Exception as e:
+        logger.error(f"SYNC_STATE_ERROR: Ошибка при сохранении {state_file}: {e}")
+
+def load_sync_cursor(state_file, logger, store=None, file_cid_mapping=None):
+    cursor = _load_sync_state(state_file, logger, store, 'last_synced_seq', 0)
+    if file_cid_mapping is not None and cursor > file_cid_mapping.seq:
+        # Журнал маппинга восстановлен с меньшим seq, чем уже синхронизировано (потерян хвост
+        # при сбое): иначе следующие cursor - seq изменений были бы молча пропущены.
+        # С нуля changes_since отдаёт весь маппинг — проход получается полным
+        logger.warning(f"SYNC_STATE: Курсор синхронизации {cursor} опережает журнал маппинга "
+                       f"({file_cid_mapping.seq}), курсор сброшен, будет выполнена полная синхронизация")
+        save_sync_cursor(state_file, 0, logger, store)
+        return 0
+    return cursor
 
+def save_sync_cursor(state_file, seq, logger, store=None):
+    _save_sync_state(state_file, logger, store, 'last_synced_seq', seq)
+
+def load_sync_retries(state_file, logger, store=None):
+    # {путь: [cid, число неудач, время следующей попытки, этап]} — файлы, отложенные после неудачной
+    # загрузки; этап 'pin' — файл уже в Synced_dir, не удалось только запинить (в старых записях этапа нет)
+    return _load_sync_state(state_file, logger, store, 'sync_retries', {})
+
+def save_sync_retries(state_file, retries, logger, store=None):
+    _save_sync_state(state_file, logger, store, 'sync_retries', retries)
+
+def sync_files_to_synced_dir(ipfs_path, synced_dir, logger, file_cid_mapping, deleted_files_path, full=False,
+                             concurrency=DEFAULT_SYNC_CONCURRENCY, timeout=DEFAULT_SYNC_TIMEOUT,
+                             retries=DEFAULT_SYNC_RETRIES, backoff=DEFAULT_SYNC_BACKOFF, export_mode=DEFAULT_EXPORT_MODE):
+    # По умолчанию обрабатываются только записи, изменённые после сохранённого курсора.
+    # full=True — полная сверка всего маппинга с Synced_dir (запускается редко).
+    logger.debug(f"MODULE_VERSION: file_sync version {MODULE_VERSION}")
+    logger.debug(f"SYNC_FILES_START: Starting {'full' if full else 'incremental'} sync to Synced_dir")
+    try:
+        mode = 'full' if full else 'incremental'
+        with activity.busy(record=False):
+            with sync_lock, metrics.span('sync_files_to_synced_dir', mode=mode), metrics.timer('sync_pass', mode=mode):
+                _sync_pass(ipfs_path, synced_dir, logger, file_cid_mapping, deleted_files_path, full,
+                           concurrency, timeout, retries, backoff, export_mode)
+        logger.debug("SYNC_FILES_END: Sync to Synced_dir finished")
+    except Exception as e:
+        logger.error(f"SYNC_FILES_ERROR: Ошибка при синхронизации файлов в Synced_dir: {e}")
+
+def reconcile_synced_dir(ipfs_path, synced_dir, logger, file_cid_mapping, deleted_files_path):
+    sync_files_to_synced_dir(ipfs_path, synced_dir, logger, file_cid_mapping, deleted_files_path, full=True)
+
+def _local_sources(file_cid_mapping, synced_dir, missing):
+    # Для отсутствующих файлов ищет уже выгруженный файл с тем же CID (дубликаты содержимого)
+    store = getattr(file_cid_mapping, 'store', None)
+    missing_paths = {path for path, _, _ in missing}
+    if store is not None:
+        candidates = lambda cid: store.paths_for_cid(cid)
+    else:
+        wanted = {cid for _, cid, _ in missing}
+        by_cid = {}
         for path, cid in file_cid_mapping.items():
-            relative_path = path.replace("Upload/", "", 1)
-            dest_path = os.path.join(synced_dir, relative_path)
-            if relative_path in deleted_files:
-                logger.info(f"SYNC_FILE_SKIPPED: Файл {path} пропущен, так как он был удалён из Synced_dir")
+            if cid in wanted and path not in missing_paths:
+                by_cid.setdefault(cid, []).append(path)
+        candidates = lambda cid: by_cid.get(cid, ())
+    sources = {}
+    for path, cid, _ in missing:
+        for other in candidates(cid):
+            source = os.path.join(synced_dir, other.replace("Upload/", "", 1))
+            if other not in missing_paths and os.path.isfile(source):
+                sources[path] = source
+                break
+    return sources
+
+def _sync_pass(ipfs_path, synced_dir, logger, file_cid_mapping, deleted_files_path, full,
+               concurrency, timeout, retries, backoff, export_mode):
+    os.makedirs(synced_dir, exist_ok=True)
+    if not file_cid_mapping:
+        logger.debug("SYNC_FILES: file_cid_mapping is empty, nothing to sync")
+        return
+
+    incremental = hasattr(file_cid_mapping, 'changes_since')
+    store = getattr(file_cid_mapping, 'store', None)
+    state_file = sync_state_path_for(deleted_files_path)
+    target_seq = file_cid_mapping.seq if incremental else 0
+    retry_table = load_sync_retries(state_file, logger, store) if incremental else {}
+    now = time.time()
+    if incremental and not full:
+        cursor = load_sync_cursor(state_file, logger, store, file_cid_mapping)
+        entries = {path: cid for path, cid in file_cid_mapping.changes_since(cursor) if cid is not None}
+        for path, (cid, _, next_retry, *_) in list(retry_table.items()):
+            if file_cid_mapping.get(path) != cid:
+                # Путь удалён или получил новый CID: отложенная загрузка больше не нужна
+                del retry_table[path]
+            elif next_retry <= now:
+                entries[path] = cid
+            elif entries.get(path) == cid:
+                entries.pop(path)
+        entries = list(entries.items())
+        if not entries:
+            logger.debug(f"SYNC_FILES: No mapping changes since seq {cursor}")
+            if target_seq > cursor:
+                save_sync_cursor(state_file, target_seq, logger, store)
+            return
+    else:
+        entries = list(file_cid_mapping.items())
+
+    is_deleted = deleted_checker(file_cid_mapping, deleted_files_path, logger)
+    synced_root = os.path.realpath(synced_dir)
+    missing = []
+    repin = []
+    skipped = 0
+    for path, cid in entries:
+        relative_path = path.replace("Upload/", "", 1)
+        dest_path = os.path.join(synced_dir, relative_path)
+        if is_deleted(relative_path):
+            logger.debug(f"SYNC_FILE_SKIPPED: File {path} skipped, it was deleted from Synced_dir")
+            skipped += 1
+            continue
+        if not os.path.exists(dest_path):
+            # Пути приходят и от других узлов кластера: запись за пределы Synced_dir не выполняется
+            if not os.path.realpath(dest_path).startswith(synced_root + os.sep):
+                logger.warning(f"SYNC_FILE_SKIPPED: Путь {path} ведёт за пределы Synced_dir, пропущен")
+                skipped += 1
                 continue
             os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            missing.append((path, cid, dest_path))
+        elif retry_table.get(path, [None])[0] == cid and retry_table[path][3:] == ['pin']:
+            # Файл уже выгружен, прошлый проход не смог его запинить: повторяется только пин
+            repin.append((path, cid))
 
-            if not os.path.exists(dest_path):
-                try:
-                    logger.debug(f"SYNC_FILE: Downloading {path} with CID {cid} to {dest_path}")
-                    subprocess.run(
-                        [ipfs_path, 'get', cid, '-o', dest_path],
-                        capture_output=True, text=True, check=True
-                    )
-                    logger.info(f"SYNC_FILE: Файл {path} с CID {cid} загружен в {dest_path}")
-                    subprocess.run(
-                        [ipfs_path, 'pin', 'add', cid],
-                        capture_output=True, text=True, check=True
-                    )
-                    logger.info(f"SYNC_PIN: Файл {path} запинен с CID {cid}")
-                except subprocess.CalledProcessError as e:
-                    logger.error(f"SYNC_FILE_ERROR: Ошибка при загрузке файла {path} с CID {cid}: {e.stderr}")
-        logger.info("SYNC_FILES_END: Завершение синхронизации файлов в Synced_dir")
-    except Exception as e:
-        logger.error(f"SYNC_FILES_ERROR: Ошибка при синхронизации файлов в Synced_dir: {e}")
+    downloaded = []
+    lazy_cache = getattr(file_cid_mapping, 'lazy_cache', None)
+    if lazy_cache is not None:
+        # Ленивый режим: вместо загрузки — заглушки, содержимое загружается при открытии.
+        # Файлы, добавленные самой нодой, загружаются целиком: других копий у них может не быть
+        local = lazy_cache.local_paths([(path.replace("Upload/", "", 1), cid) for path, cid, _ in missing])
+        created = lazy_cache.add_placeholders([(path.replace("Upload/", "", 1), cid) for path, cid, _ in missing
+                                               if path.replace("Upload/", "", 1) not in local])
+        if created:
+            activity.touch()
+            logger.info(f"SYNC_FILES: Создано {created} заглушек для ленивой загрузки (пропущено удалённых: {skipped})")
+        missing = [item for item in missing if item[0].replace("Upload/", "", 1) in local]
+    metrics.set_gauge('sync_backlog_files', len(missing))
+    client = get_client(ipfs_path, logger) if missing or repin else None
+    if missing:
+        # Загрузки идут параллельно с ограничением concurrency, пины ставятся пачками
+        sources = _local_sources(file_cid_mapping, synced_dir, missing) if export_mode != 'copy' else {}
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='sync') as executor:
+            results = list(executor.map(
+                lambda item: _download_file(client, item[0], item[1], item[2], logger, timeout, retries, backoff,
+                                            sources.get(item[0])),
+                missing))
+        downloaded = [(path, cid) for (path, cid, _), ok in zip(missing, results) if ok]
+        if downloaded:
+            activity.touch()
+        metrics.set_gauge('sync_backlog_files', len(missing) - len(downloaded))
+    # Пачка, которую не удалось запинить, не прерывает проход: её пути уходят в таблицу повторов
+    # (этап 'pin'), а в базе состояния CID получают статус failed
+    pin_failed = set()
+    to_pin = downloaded + repin
+    for start in range(0, len(to_pin), PIN_BATCH_SIZE):
+        chunk = to_pin[start:start + PIN_BATCH_SIZE]
+        cids = {cid for _, cid in chunk}
+        try:
+            client.pin_add(*cids)
+        except IpfsError as e:
+            logger.error(f"SYNC_PIN_ERROR: Ошибка при пиннинге {len(chunk)} файлов: {e.stderr}")
+            pin_failed.update(path for path, _ in chunk)
+            if store is not None:
+                store.set_pin_status(cids, 'failed')
+            continue
+        get_pin_index(ipfs_path, logger).note_pinned(cids)
+        if store is not None:
+            store.set_pin_status(cids, 'pinned')
+        for path, cid in chunk:
+            logger.debug(f"SYNC_PIN: File {path} pinned as {cid}")
+    if missing:
+        pinned = sum(1 for path, _ in downloaded if path not in pin_failed)
+        logger.info(f"SYNC_FILES: Загружено {len(downloaded)} и запинено {pinned} из {len(missing)} "
+                    f"отсутствующих файлов (пропущено удалённых: {skipped})")
+    if repin:
+        logger.info(f"SYNC_FILES: Повторно запинено {sum(1 for path, _ in repin if path not in pin_failed)} "
+                    f"из {len(repin)} выгруженных ранее файлов")
+
+    if not incremental:
+        return
+    # Неудавшиеся загрузки и пины откладываются в таблицу повторов, и курсор двигается дальше:
+    # один недоступный CID не заставляет каждый проход заново разбирать весь хвост журнала
+    done = {path for path, _ in to_pin} - pin_failed
+    attempted = {path for path, _, _ in missing} | {path for path, _ in repin}
+    retries_before = dict(retry_table)
+    for path, cid in [(path, cid) for path, cid, _ in missing] + repin:
+        if path in done:
+            retry_table.pop(path, None)
+            continue
+        failures = retry_table[path][1] + 1 if path in retry_table else 1
+        retry_table[path] = [cid, failures, now + min(RETRY_DELAY * 2 ** (failures - 1), RETRY_MAX_DELAY)]
+        if path in pin_failed:
+            retry_table[path].append('pin')
+    for path in list(retry_table):
+        # Файл удалён пользователем или появился в Synced_dir другим путём (наблюдатель, полная сверка);
+        # отложенный пин остаётся, пока файл не удалён
+        if path in attempted:
+            continue
+        relative_path = path.replace("Upload/", "", 1)
+        if is_deleted(relative_path) or (retry_table[path][3:] != ['pin']
+                                         and os.path.exists(os.path.join(synced_dir, relative_path))):
+            del retry_table[path]
+    if retry_table != retries_before:
+        save_sync_retries(state_file, retry_table, logger, store)
+        parked = len(attempted - done)
+        if parked:
+            logger.warning(f"SYNC_FILES: {parked} файлов не загружено или не запинено, отложены для повтора "
+                           f"(всего в очереди повторов: {len(retry_table)})")
+    metrics.set_gauge('sync_retry_files', len(retry_table))
+    save_sync_cursor(state_file, target_seq, logger, store)
+    file_cid_mapping.compact(target_seq)
@@ -0,0 +1,573 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from watchdog.events import FileCreatedEvent, FileModifiedEvent, FileDeletedEvent, FileMovedEvent
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+import metrics
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+# Флаги событий inotify (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+# Ненужные события отсекаются ядром и не занимают очередь. В Upload важен только готовый файл:
+# IN_CLOSE_WRITE вместо потока IN_MODIFY на каждую запись (стабильность файла всё равно проверяет
+# очередь добавления), IN_CREATE — для каталогов и файлов, созданных без записи. В Synced_dir
+# файлы пишет сама синхронизация, и нужны только удаления и перемещения
+_WATCH_FLAGS = IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK | IN_DELETE_SELF | IN_MOVE_SELF
+UPLOAD_MASK = IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_FROM | IN_MOVED_TO | _WATCH_FLAGS
+SYNCED_MASK = IN_DELETE | IN_CREATE | IN_MOVED_FROM | IN_MOVED_TO | _WATCH_FLAGS
+
+WATCHER_BACKENDS = ('auto', 'inotify', 'watchdog', 'polling')
+DEFAULT_POLLING_INTERVAL = 5.0
+# Сколько ждать IN_MOVED_TO, парный IN_MOVED_FROM в конце прочитанной пачки
+MOVE_PAIR_WAIT = 0.05
+READ_SIZE = 64 * 1024
+# После переполнения пересканируются каталоги с событиями за последние ACTIVITY_WINDOW секунд:
+# поток, переполнивший очередь, идёт из них. Если таких нет или их больше ACTIVITY_LIMIT —
+# пересканируется весь корень
+ACTIVITY_WINDOW = 60.0
+ACTIVITY_LIMIT = 1000
+# Пауза перед пересканированием, чтобы шторм событий успел закончиться и запросы объединились
+RESCAN_SETTLE = 1.0
+
+_EVENT = struct.Struct('iIII')
+_PROC_LIMITS = ('max_user_watches', 'max_queued_events', 'max_user_instances')
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+def inotify_available():
+    return _libc is not None
+
+
+def inotify_limits():
+    limits = {}
+    for name in _PROC_LIMITS:
+        try:
+            with open(f'/proc/sys/fs/inotify/{name}') as f:
+                limits[name] = int(f.read())
+        except (OSError, ValueError):
+            pass
+    return limits
+
+
+def _collapse(directories):
+    # Вложенные каталоги покрываются пересканированием родителя
+    result = []
+    for directory in sorted(set(directories)):
+        if result and (directory == result[-1] or directory.startswith(result[-1] + os.sep)):
+            continue
+        result.append(directory)
+    return result
+
+
+class InotifyWatcher:
+    # Рекурсивное наблюдение за одним корнем через собственный экземпляр inotify: очередь ядра
+    # (max_queued_events) у каждого корня своя, и шторм в Upload не переполняет очередь Synced_dir.
+    # События разбираются в потоке и передаются обработчику как события watchdog. Переполнение
+    # очереди и каталоги, содержимое которых появилось без событий (создан до установки watch или
+    # перемещён извне), передаются в FileWatcher на пересканирование.
+    def __init__(self, root, mask, handler, logger, file_watcher, rescan_new_dirs=False):
+        self.root = root
+        self.mask = mask
+        self.handler = handler
+        self.logger = logger
+        self.file_watcher = file_watcher
+        self.rescan_new_dirs = rescan_new_dirs
+        self.fd = None
+        self._wds = {}
+        self._paths = {}
+        self._activity = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        # Канал пробуждения принадлежит stop()/join(): поток чтения его не закрывает,
+        # иначе stop() мог бы писать в уже закрытый (или переиспользованный) дескриптор
+        self._wake_r = self._wake_w = None
+        self._wake_lock = threading.Lock()
+        self._stopping = False
+        # После первого ENOSPC новые watch не ставятся: каталоги без watch опрашиваются
+        # через их общего предка (при повторе — через корень), лимит пишется в лог один раз
+        self._watch_limit = False
+        self._polled = []
+        self.events = 0
+        self.overflows = 0
+        self.watch_errors = 0
+
+    # --- watch ---
+
+    def _add_watch(self, path, unwatched):
+        # None — каталог исчез, недоступен или остался без watch (тогда он добавлен в unwatched)
+        fd = self.fd
+        if fd is None:
+            return None
+        if self._watch_limit:
+            unwatched.append(path)
+            return None
+        wd = _libc.inotify_add_watch(fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            if path == self.root:
+                raise OSError(err, os.strerror(err), path)
+            self.watch_errors += 1
+            if err == errno.ENOSPC:
+                self._watch_limit = True
+                limit = inotify_limits().get('max_user_watches')
+                self.logger.warning(f"WATCHER: Исчерпан лимит inotify max_user_watches"
+                                    f"{f' ({limit})' if limit else ''} для {self.root}: новые watch не ставятся, "
+                                    f"каталоги без watch будут опрашиваться")
+                unwatched.append(path)
+            else:
+                self.logger.warning(f"WATCHER: Не удалось наблюдать за каталогом {path}: {os.strerror(err)}")
+            return None
+        with self._lock:
+            old = self._wds.get(wd)
+            if old is not None and old != path:
+                self._paths.pop(old, None)
+            self._wds[wd] = path
+            self._paths[path] = wd
+        return wd
+
+    def add_tree(self, top):
+        # Повторная установка watch на уже наблюдаемый каталог возвращает тот же дескриптор,
+        # поэтому после переполнения обход просто добавляет пропущенные каталоги
+        stack = [top]
+        unwatched = []
+        while stack and self.fd is not None:
+            directory = stack.pop()
+            if self._add_watch(directory, unwatched) is None:
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        if unwatched:
+            self._poll_unwatched(unwatched)
+
+    def _poll_unwatched(self, unwatched):
+        # Опрос рекурсивный, поэтому поддеревья уже опрашиваемых каталогов не добавляются
+        with self._lock:
+            unwatched = [directory for directory in unwatched
+                         if not any(directory == polled or directory.startswith(polled + os.sep)
+                                    for polled in self._polled)]
+            if not unwatched:
+                return
+            target = os.path.commonpath(unwatched) if not self._polled else self.root
+            self._polled.append(target)
+        self.logger.debug(f"Polling {target} for {len(unwatched)} directories without inotify watch")
+        self.file_watcher.poll(target)
+        if self.rescan_new_dirs:
+            self.file_watcher.request_rescan(_collapse(unwatched))
+
+    def _remove_tree(self, top):
+        with self._lock:
+            removed = [(path, wd) for path, wd in self._paths.items()
+                       if path == top or path.startswith(top + os.sep)]
+            for path, wd in removed:
+                del self._paths[path]
+                self._wds.pop(wd, None)
+        for _, wd in removed:
+            _libc.inotify_rm_watch(self.fd, wd)
+
+    def _rename_tree(self, src, dest):
+        with self._lock:
+            moved = [(path, wd) for path, wd in self._paths.items()
+                     if path == src or path.startswith(src + os.sep)]
+            for path, wd in moved:
+                new_path = dest + path[len(src):]
+                del self._paths[path]
+                self._paths[new_path] = wd
+                self._wds[wd] = new_path
+        return bool(moved)
+
+    @property
+    def watches(self):
+        return len(self._wds)
+
+    # --- жизненный цикл ---
+
+    def start(self):
+        fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.fd = fd
+        try:
+            started = time.monotonic()
+            self.add_tree(self.root)
+        except OSError:
+            os.close(self.fd)
+            self.fd = None
+            raise
+        self.logger.debug(f"Inotify watches for {self.root}: {self.watches} in {time.monotonic() - started:.2f}s")
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread = threading.Thread(target=self._run, name=f'inotify-{os.path.basename(self.root)}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._wake_lock:
+            self._stopping = True
+            if self._wake_w is not None:
+                os.write(self._wake_w, b'x')
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                return
+        with self._wake_lock:
+            for fd in (self._wake_r, self._wake_w):
+                if fd is not None:
+                    os.close(fd)
+            self._wake_r = self._wake_w = None
+
+    # --- чтение событий ---
+
+    def _read(self, timeout=None):
+        ready, _, _ = select.select([self.fd, self._wake_r], [], [], timeout)
+        if self._wake_r in ready or self.fd not in ready:
+            return b''
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    @staticmethod
+    def _parse(data):
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def _run(self):
+        try:
+            while not self._stopping:
+                events = self._parse(self._read())
+                if not events:
+                    continue
+                # Пара IN_MOVED_FROM/IN_MOVED_TO может разорваться границей чтения: ждём вторую половину
+                if self._unpaired_moves(events):
+                    events.extend(self._parse(self._read(MOVE_PAIR_WAIT)))
+                self._handle(events)
+        except Exception as e:
+            self.logger.error(f"WATCHER_ERROR: Наблюдение за {self.root} остановлено: {e}")
+        finally:
+            fd, self.fd = self.fd, None
+            if fd is not None:
+                os.close(fd)
+
+    @staticmethod
+    def _unpaired_moves(events):
+        sources = {cookie for _, mask, cookie, _ in events if mask & IN_MOVED_FROM}
+        targets = {cookie for _, mask, cookie, _ in events if mask & IN_MOVED_TO}
+        return bool(sources - targets)
+
+    # --- разбор событий ---
+
+    def _dispatch(self, event):
+        try:
+            self.handler.dispatch(event)
+        except Exception as e:
+            self.logger.error(f"WATCHER_ERROR: Ошибка обработки события {event.event_type} {event.src_path}: {e}")
+
+    def _handle(self, events):
+        now = time.monotonic()
+        targets = {}
+        for wd, mask, cookie, name in events:
+            if mask & IN_MOVED_TO:
+                targets[cookie] = (wd, mask, name)
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self._overflow()
+                continue
+            directory = self._wds.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                with self._lock:
+                    if self._wds.get(wd) == directory:
+                        del self._wds[wd]
+                        self._paths.pop(directory, None)
+                continue
+            if not name:
+                # IN_DELETE_SELF/IN_MOVE_SELF самого каталога: его родитель сообщает об этом своим событием
+                continue
+            self.events += 1
+            self._activity[directory] = now
+            path = os.path.join(directory, name)
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & IN_MOVED_FROM:
+                target = targets.pop(cookie, None)
+                if target is not None and self._wds.get(target[0]) is not None:
+                    self._moved(path, os.path.join(self._wds[target[0]], target[2]), is_dir)
+                else:
+                    self._moved_out(path, is_dir)
+            elif mask & IN_MOVED_TO:
+                # Пара этого события уже разобрана вместе с IN_MOVED_FROM
+                if targets.pop(cookie, None) is not None:
+                    self._moved_in(path, is_dir)
+            elif mask & IN_CREATE:
+                if is_dir:
+                    self._moved_in(path, is_dir)
+                else:
+                    self._dispatch(FileCreatedEvent(path))
+            elif mask & IN_CLOSE_WRITE and not is_dir:
+                self._dispatch(FileModifiedEvent(path))
+            elif mask & IN_DELETE and not is_dir:
+                self._dispatch(FileDeletedEvent(path))
+        if len(self._activity) > ACTIVITY_LIMIT * 10:
+            self._prune_activity(now)
+
+    def _moved(self, src, dest, is_dir):
+        if not is_dir:
+            self._dispatch(FileMovedEvent(src, dest))
+            return
+        if not self._rename_tree(src, dest):
+            self.add_tree(dest)
+        if self.rescan_new_dirs:
+            self.file_watcher.request_rescan([dest])
+
+    def _moved_in(self, path, is_dir):
+        # Файлы нового или перемещённого извне каталога могли появиться до установки watch
+        if not is_dir:
+            self._dispatch(FileCreatedEvent(path))
+            return
+        self.add_tree(path)
+        if self.rescan_new_dirs:
+            self.file_watcher.request_rescan([path])
+
+    def _moved_out(self, path, is_dir):
+        if not is_dir:
+            self._dispatch(FileDeletedEvent(path))
+            return
+        # Содержимое ушедшего каталога событий не даст: пропажу файлов находит пересканирование
+        self._remove_tree(path)
+        self.file_watcher.request_rescan([path])
+
+    # --- переполнение ---
+
+    def _prune_activity(self, now):
+        cutoff = now - ACTIVITY_WINDOW
+        self._activity = {directory: seen for directory, seen in self._activity.items() if seen >= cutoff}
+
+    def _overflow(self):
+        self.overflows += 1
+        self.logger.warning(f"WATCHER: Переполнение очереди inotify для {self.root}, часть событий потеряна; "
+                            f"затронутые каталоги будут пересканированы (увеличьте fs.inotify.max_queued_events)")
+        self.file_watcher.request_rescan(None, watcher=self)
+
+    def affected_dirs(self):
+        # Вызывается потоком пересканирования после паузы, поэтому учитывает и события,
+        # пришедшие уже после переполнения
+        cutoff = time.monotonic() - ACTIVITY_WINDOW
+        directories = _collapse(directory for directory, seen in list(self._activity.items()) if seen >= cutoff)
+        if not directories or len(directories) > ACTIVITY_LIMIT:
+            directories = [self.root]
+        # Каталоги, созданные во время переполнения, остались без watch
+        for directory in directories:
+            self.add_tree(directory)
+        return directories
+
+
+class FileWatcher:
+    # Наблюдение за Upload и Synced_dir. Бэкенд 'inotify' — собственная реализация поверх inotify
+    # с масками событий и восстановлением после переполнения, 'watchdog' — Observer из watchdog,
+    # 'polling' — периодический опрос; 'auto' выбирает inotify, если он есть. Корень, который не
+    # удалось поставить под inotify, и поддеревья сверх лимита watch опрашиваются PollingObserver.
+    # Пересканирование выполняет обработчик (NewFileHandler.rescan) в отдельном потоке.
+    def __init__(self, handler, logger, backend='auto', polling_interval=DEFAULT_POLLING_INTERVAL):
+        if backend not in WATCHER_BACKENDS:
+            raise ValueError(f"неизвестный бэкенд наблюдателя: {backend}")
+        if backend == 'auto':
+            backend = 'inotify' if inotify_available() else 'watchdog'
+        elif backend == 'inotify' and not inotify_available():
+            logger.warning("WATCHER: inotify недоступен, используется опрос файловой системы")
+            backend = 'polling'
+        self.handler = handler
+        self.logger = logger
+        self.backend = backend
+        self.polling_interval = polling_interval
+        self._scheduled = []
+        self._watchers = []
+        self._observer = None
+        self._polling = None
+        self._polled = []
+        self._started = False
+        self._rescan_cond = threading.Condition()
+        self._rescan_dirs = set()
+        self._rescan_overflowed = set()
+        self._rescan_thread = None
+        self._stopping = False
+        self.rescans = 0
+
+    def schedule(self, path, mask, rescan_new_dirs=False):
+        # mask используется только бэкендом inotify; rescan_new_dirs — пересканировать появившиеся каталоги
+        self._scheduled.append((path, mask, rescan_new_dirs))
+
+    def start(self):
+        if self.backend == 'watchdog':
+            self._observer = Observer()
+            for path, _, _ in self._scheduled:
+                self._observer.schedule(self.handler, path, recursive=True)
+            self._observer.start()
+        elif self.backend == 'inotify':
+            for path, mask, rescan_new_dirs in self._scheduled:
+                watcher = InotifyWatcher(path, mask, self.handler, self.logger, self, rescan_new_dirs=rescan_new_dirs)
+                try:
+                    watcher.start()
+                except OSError as e:
+                    self.logger.warning(f"WATCHER: Не удалось наблюдать за {path} через inotify ({e}), "
+                                        f"используется опрос")
+                    self.poll(path)
+                    continue
+                self._watchers.append(watcher)
+        else:
+            for path, _, _ in self._scheduled:
+                self.poll(path)
+        if self._polling is not None:
+            self._polling.start()
+        self._started = True
+        if hasattr(self.handler, 'rescan'):
+            self._rescan_thread = threading.Thread(target=self._rescan_loop, name='fs-rescan', daemon=True)
+            self._rescan_thread.start()
+        self._register_gauges()
+        watches = sum(watcher.watches for watcher in self._watchers)
+        limits = ', '.join(f'{name}={value}' for name, value in inotify_limits().items())
+        self.logger.info(f"WATCHER: Наблюдение запущено, бэкенд {self.backend}, watch inotify: {watches}"
+                         f"{', опрос: ' + str(len(self._polled)) if self._polled else ''}"
+                         f"{', лимиты ' + limits if self.backend == 'inotify' and limits else ''}")
+
+    def poll(self, path):
+        # Watchdog разрешает добавлять наблюдение в уже запущенный Observer
+        if self._polling is None:
+            self._polling = PollingObserver(timeout=self.polling_interval)
+            if self._started:
+                self._polling.start()
+        self._polling.schedule(self.handler, path, recursive=True)
+        self._polled.append(path)
+
+    def stop(self):
+        self._stopping = True
+        for watcher in self._watchers:
+            watcher.stop()
+        for observer in (self._observer, self._polling):
+            if observer is not None:
+                observer.stop()
+        with self._rescan_cond:
+            self._rescan_cond.notify_all()
+
+    def join(self, timeout=None):
+        for watcher in self._watchers:
+            watcher.join(timeout)
+        for observer in (self._observer, self._polling):
+            if observer is not None:
+                observer.join(timeout)
+        if self._rescan_thread is not None:
+            self._rescan_thread.join(timeout)
+
+    # --- пересканирование ---
+
+    def request_rescan(self, directories, watcher=None):
+        # directories=None — переполнение очереди watcher, каталоги определяются при выполнении
+        with self._rescan_cond:
+            if directories is None:
+                self._rescan_overflowed.add(watcher)
+            else:
+                self._rescan_dirs.update(directories)
+            self._rescan_cond.notify()
+
+    def _rescan_loop(self):
+        while True:
+            with self._rescan_cond:
+                while not (self._rescan_dirs or self._rescan_overflowed or self._stopping):
+                    self._rescan_cond.wait()
+                if self._stopping:
+                    return
+            time.sleep(RESCAN_SETTLE)
+            with self._rescan_cond:
+                directories = set(self._rescan_dirs)
+                overflowed = set(self._rescan_overflowed)
+                self._rescan_dirs.clear()
+                self._rescan_overflowed.clear()
+            try:
+                for watcher in overflowed:
+                    directories.update(watcher.affected_dirs())
+                directories = _collapse(directories)
+                self.rescans += 1
+                self.logger.debug(f"Rescanning {len(directories)} directories: {directories[:10]}")
+                self.handler.rescan(directories)
+            except Exception as e:
+                self.logger.error(f"WATCHER_ERROR: Ошибка пересканирования: {e}")
+
+    # --- метрики ---
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'roots': {watcher.root: {'watches': watcher.watches, 'events': watcher.events,
+                                     'overflows': watcher.overflows, 'watch_errors': watcher.watch_errors}
+                      for watcher in self._watchers},
+            'polled': list(self._polled),
+            'rescans': self.rescans,
+        }
+
+    def _register_gauges(self):
+        for key in ('watches', 'events', 'overflows', 'watch_errors'):
+            metrics.register_gauge(f'fs_watcher_{key}', lambda key=key: {
+                (('root', watcher.root),): getattr(watcher, key) for watcher in self._watchers})
+        metrics.register_gauge('fs_watcher_polled_dirs', lambda: len(self._polled))
+        metrics.register_gauge('fs_watcher_rescans', lambda: self.rescans)
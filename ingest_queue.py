@@ -0,0 +1,154 @@
+import os
+import time
+import threading
+import logging
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class _Job:
+    __slots__ = ('path', 'first_event', 'last_event', 'stat', 'events')
+
+    def __init__(self, path, now):
+        self.path = path
+        self.first_event = now
+        self.last_event = now
+        self.stat = None
+        self.events = 1
+
+
+class IngestQueue:
+    # Очередь между наблюдателем watchdog и добавлением в IPFS.
+    # События по одному пути схлопываются в одну задачу; задача уходит в работу,
+    # только когда после debounce секунд тишины размер и mtime файла не изменились.
+    def __init__(self, process_batch, logger, workers=2, debounce=2.0, batch_size=50):
+        self.process_batch = process_batch
+        self.logger = logger
+        self.workers = workers
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self._jobs = {}
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopped = False
+        self.enqueued = 0
+        self.coalesced = 0
+        self.processed = 0
+        self.requeued_unstable = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._stopped = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'ingest-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        self.logger.info(f"INGEST_QUEUE: Запущено {self.workers} обработчиков очереди")
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def put(self, path):
+        now = time.monotonic()
+        with self._cond:
+            self.enqueued += 1
+            job = self._jobs.get(path)
+            if job is not None:
+                job.last_event = now
+                job.events += 1
+                self.coalesced += 1
+                return
+            job = _Job(path, now)
+            job.stat = _stat_key(path)
+            self._jobs[path] = job
+            self._cond.notify()
+
+    def depth(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': len(self._jobs),
+                'in_flight': len(self._in_flight),
+                'enqueued': self.enqueued,
+                'coalesced': self.coalesced,
+                'processed': self.processed,
+                'requeued_unstable': self.requeued_unstable,
+                'wait_time_avg': self.wait_time_total / self.processed if self.processed else 0.0,
+                'wait_time_max': self.wait_time_max,
+            }
+
+    def _take_ready(self, now):
+        # Вызывается под self._cond. Возвращает готовые пути и время до следующей проверки
+        ready = []
+        next_check = None
+        for path, job in list(self._jobs.items()):
+            if path in self._in_flight:
+                continue
+            due = job.last_event + self.debounce
+            if due > now:
+                next_check = due if next_check is None else min(next_check, due)
+                continue
+            current = _stat_key(path)
+            if current is None:
+                # Файл исчез до обработки — задача больше не нужна
+                del self._jobs[path]
+                continue
+            if job.stat != current:
+                # Файл ещё дописывается — ждём ещё один интервал
+                self.requeued_unstable += 1
+                job.stat = current
+                job.last_event = now
+                next_check = now + self.debounce if next_check is None else min(next_check, now + self.debounce)
+                continue
+            del self._jobs[path]
+            waited = now - job.first_event
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+            ready.append(path)
+            if len(ready) >= self.batch_size:
+                break
+        return ready, next_check
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    now = time.monotonic()
+                    batch, next_check = self._take_ready(now)
+                    if batch:
+                        self._in_flight.update(batch)
+                        break
+                    self._cond.wait(None if next_check is None else max(next_check - now, 0.01))
+            try:
+                self.process_batch(batch)
+            except Exception as e:
+                self.logger.error(f"INGEST_QUEUE_ERROR: Ошибка при обработке пачки из {len(batch)} файлов: {e}")
+            finally:
+                with self._cond:
+                    self._in_flight.difference_update(batch)
+                    self.processed += len(batch)
+                    self._cond.notify_all()
@@ -1,6 +1,7 @@
 import os
 import subprocess
 import logging
+from ipfs_client import get_client, IpfsError
 
 # Версия модуля
 MODULE_VERSION = "2.1.7"
@@ -27,7 +28,53 @@ def ensure_ipfs_initialized(ipfs_path, logger):
         raise
 
 
-def setup_public_network(ipfs_path, logger, node_name):
+_MISSING = object()
+
+
+def _config_value(config, key):
+    node = config
+    for part in key.split('.'):
+        if not isinstance(node, dict) or part not in node:
+            return _MISSING
+        node = node[part]
+    return node
+
+
+def _set_config_value(config, key, value):
+    parts = key.split('.')
+    node = config
+    for part in parts[:-1]:
+        if not isinstance(node.get(part), dict):
+            node[part] = {}
+        node = node[part]
+    node[parts[-1]] = value
+
+
+def apply_config(ipfs_path, logger, desired, optional=()):
+    # Применяет значения {ключ.через.точку: значение} одной записью конфига и только если они
+    # отличаются от текущих. Ключи из optional задаются, только если текущая версия Kubo их знает
+    # (ключ есть в конфиге). Возвращает список изменённых ключей
+    client = get_client(ipfs_path, logger)
+    config = client.config_show()
+    changed = []
+    for key, value in desired.items():
+        current = _config_value(config, key)
+        if current is _MISSING and key in optional:
+            logger.debug(f"IPFS_CONFIG: {key} is not supported by this Kubo version, skipped")
+            continue
+        if current != value:
+            _set_config_value(config, key, value)
+            changed.append(key)
+    if not changed:
+        logger.debug("IPFS_CONFIG: Config is up to date, nothing to write")
+        return changed
+    client.config_replace(config)
+    logger.info(f"IPFS_CONFIG: Конфиг обновлён одной записью: {', '.join(changed)}")
+    return changed
+
+
+def setup_public_network(ipfs_path, logger, node_name, extra_config=None):
+    # Возвращает список изменённых ключей конфига: если демон уже запущен, они вступят в силу после перезапуска
     logger.info(f"MODULE_VERSION: ipfs_config версия {MODULE_VERSION}")
     try:
         ipfs_dir = os.path.expanduser("~/.ipfs")
@@ -37,29 +84,18 @@ def setup_public_network(ipfs_path, logger, node_name):
             os.remove(swarm_key_path)
             logger.info(f"PUBLIC_NETWORK: Удалён swarm.key из {swarm_key_path} для работы в публичной сети")
 
-        result = subprocess.run(
-            [ipfs_path, 'config', 'Routing.Type', 'dhtclient'],
-            capture_output=True, text=True, check=True
-        )
-        logger.info("PUBLIC_NETWORK: DHT включён (Routing.Type = dhtclient)")
-
-        result = subprocess.run(
-            [ipfs_path, 'config', 'Discovery.MDNS.Enabled', '--bool', 'true'],
-            capture_output=True, text=True, check=True
-        )
-        logger.info("PUBLIC_NETWORK: mDNS включён (Discovery.MDNS.Enabled = true)")
+        # DHT в режиме клиента, mDNS с интервалом 30 секунд (Discovery.MDNS.Interval есть не во всех версиях Kubo)
+        desired = {
+            'Routing.Type': 'dhtclient',
+            'Discovery.MDNS.Enabled': True,
+            'Discovery.MDNS.Interval': 30,
+        }
+        desired.update(extra_config or {})
+        changed = apply_config(ipfs_path, logger, desired, optional=('Discovery.MDNS.Interval',))
+        logger.info("PUBLIC_NETWORK: DHT (Routing.Type = dhtclient) и mDNS (Discovery.MDNS.Enabled = true) настроены")
+        return changed
 
-        try:
-            result = subprocess.run(
-                [ipfs_path, 'config', 'Discovery.MDNS.Interval', '--json', '30'],
-                capture_output=True, text=True, check=True
-            )
-            logger.info("PUBLIC_NETWORK: mDNS интервал установлен на 30 секунд")
-        except subprocess.CalledProcessError as e:
-            logger.warning(
-                f"PUBLIC_NETWORK_WARNING: Не удалось установить Discovery.MDNS.Interval: {e.stderr}. Продолжаем с настройками по умолчанию.")
-
-    except subprocess.CalledProcessError as e:
+    except IpfsError as e:
         logger.error(f"PUBLIC_NETWORK_ERROR: Ошибка при настройке публичной сети: {e.stderr}")
         raise
     except Exception as e:
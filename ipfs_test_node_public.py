@@ -1,19 +1,34 @@
 import os
-import subprocess
 import json
 import logging
+import signal
 import asyncio
-from watchdog.observers import Observer
+import threading
 from ipfs_config import ensure_ipfs_initialized, setup_public_network, MODULE_VERSION as IPFS_CONFIG_VERSION
 from file_monitor import NewFileHandler, check_new_files, MODULE_VERSION as FILE_MONITOR_VERSION
 from network_manager import manage_mdns_connections, list_pinned_files, MODULE_VERSION as NETWORK_MANAGER_VERSION
-from file_sync import MODULE_VERSION as FILE_SYNC_VERSION
+from file_sync import sync_files_to_synced_dir, backup_file_cid_mapping, MODULE_VERSION as FILE_SYNC_VERSION
+from ipfs_client import IpfsError
+from async_ipfs import AsyncIpfsClient, run_blocking
+from cid_mapping import FileCidMapping, MappingPersister, load_file_cid_mapping
+from state_store import StateStore
+from dedup_cache import FingerprintCache
+from large_ingest import ResumableIngest, DEFAULT_SIZE_CLASSES, MIB
+from scanner import ScanIndex
+from pin_reconciler import PinReconciler, DEFAULT_RECONCILE_INTERVAL
+from daemon_supervisor import DaemonSupervisor
+from local_export import verify_synced_files
+from fs_watcher import FileWatcher, UPLOAD_MASK, SYNCED_MASK
+from lazy_cache import LazyCache, DEFAULT_CACHE_BUDGET, DEFAULT_PREFETCH_INTERVAL
+from replication import (ReplicaStore, MappingReplicator, PubsubTransport, DEFAULT_TOPIC, DEFAULT_PUBLISH_INTERVAL,
+                         DEFAULT_CATCH_UP_INTERVAL)
+import metrics
 
 # Версия скрипта
 SCRIPT_VERSION = "2.1.7"
 
 # Настройка логирования
-def setup_logging(node_name):
+def setup_logging(node_name, level=logging.INFO):
     log_dir = os.path.join(os.path.dirname(__file__), 'data', 'logs')
     os.makedirs(log_dir, exist_ok=True)
     log_file = os.path.join(log_dir, f'log_{node_name}.log')
@@ -21,7 +36,7 @@ def setup_logging(node_name):
         with open(log_file, 'w'):
             pass
     logger = logging.getLogger(node_name)
-    logger.setLevel(logging.INFO)
+    logger.setLevel(level)
     logger.handlers.clear()
     formatter = logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     file_handler = logging.FileHandler(log_file)
@@ -49,14 +64,28 @@ def initialize_file_cid_mapping(mapping_file, logger):
             logger.info(f"MAIN: file_cid_mapping.json not found, creating new file at {mapping_file}")
             with open(mapping_file, 'w') as f:
                 json.dump({}, f, indent=4)
-            return {}
-        logger.info(f"MAIN: Loading file_cid_mapping.json from {mapping_file}")
-        with open(mapping_file, 'r') as f:
-            return json.load(f)
+            file_cid_mapping = FileCidMapping()
+        else:
+            logger.info(f"MAIN: Loading file_cid_mapping.json from {mapping_file}")
+            file_cid_mapping = load_file_cid_mapping(mapping_file, logger)
+        # Изменения маппинга пишутся в журнал пачками, снимок переписывается в фоне
+        MappingPersister(mapping_file, file_cid_mapping, logger).start()
+        return file_cid_mapping
     except Exception as e:
         logger.error(f"MAIN_ERROR: Failed to initialize file_cid_mapping.json: {str(e)}")
         return None
 
+def initialize_state_store(state_db, mapping_file, deleted_files_path, logger):
+    try:
+        store = StateStore(state_db, logger)
+        if store.migrate_from_json(mapping_file, deleted_files_path):
+            logger.info(f"MAIN: JSON-состояние перенесено в {state_db}")
+        logger.info(f"MAIN: База состояния {state_db} открыта, записей в маппинге: {store.count()}")
+        return store.mapping()
+    except Exception as e:
+        logger.error(f"MAIN_ERROR: Failed to initialize state store {state_db}: {str(e)}")
+        return None
+
 async def main():
     node_name = 'local'
     ipfs_path = r"C:\Program Files\IPFS Desktop\resources\app.asar.unpacked\node_modules\kubo\kubo\ipfs.exe"
@@ -64,8 +93,44 @@ async def main():
     synced_dir = os.path.join(os.path.dirname(__file__), 'Synced_dir')
     mapping_file = os.path.join(os.path.dirname(__file__), 'data', 'file_cid_mapping.json')
     deleted_files_path = os.path.join(os.path.dirname(__file__), 'data', 'deleted_files.json')
+    state_db = os.path.join(os.path.dirname(__file__), 'data', 'state.db')
+    state_backend = 'sqlite'  # 'sqlite' — база состояния, 'json' — прежние JSON-файлы
+    backup_keep = 10  # Сколько снимков состояния хранить в data/backups
+    batch_size = 50  # Максимум файлов в одном вызове ipfs add
+    debounce = 2.0  # Секунд тишины по файлу, прежде чем он считается дописанным
+    ingest_workers = 2  # Потоков, разбирающих очередь добавления
+    dedup_cache_file = os.path.join(os.path.dirname(__file__), 'data', 'dedup_cache.json')
+    dedup_cache_size = 100000  # Максимум отпечатков в кэше дедупликации
+    only_hash_precheck = False  # Проверять CID через add --only-hash перед настоящим добавлением
+    size_classes = DEFAULT_SIZE_CLASSES  # Профили раскладки ipfs add (chunker, raw_leaves, cid_version, trickle) по размеру
+    large_file_threshold = 1024 * MIB  # Файлы от этого размера добавляются сегментами с возобновлением; None — отключить
+    large_file_segment = 64 * MIB  # Размер сегмента между контрольными точками (выравнивается до chunk * 174**k)
+    ingest_checkpoint_file = os.path.join(os.path.dirname(__file__), 'data', 'ingest_checkpoints.json')
+    scan_memory_limit_mb = 512  # Порог RSS при стартовом обходе Upload, выше него пачки уменьшаются
+    export_mode = 'link'  # Выгрузка в Synced_dir: 'copy' (ipfs get), 'link' (reflink/жёсткая ссылка), 'filestore' (--nocopy)
+    materialize = 'eager'  # 'eager' — все файлы выгружаются в Synced_dir; 'lazy' — заглушки *.ipfs-lazy и загрузка при открытии
+    lazy_cache_budget = DEFAULT_CACHE_BUDGET  # Байт под загруженные при открытии файлы, сверх — вытеснение
+    lazy_cache_policy = 'lru'  # Политика вытеснения: 'lru' или 'lfu' (затухающий счётчик обращений)
+    lazy_prefetch_interval = DEFAULT_PREFETCH_INTERVAL  # Секунд между предзагрузками часто открываемых файлов
+    watcher_backend = 'auto'  # Наблюдатель: 'inotify' (маски событий, пересканирование после переполнения), 'watchdog', 'polling'; 'auto' — inotify, если доступен
+    verify_synced_on_start = False  # Проверить соответствие файлов Synced_dir их CID после старта
+    pin_reconcile = True  # Сверка пинов с маппингом: отпинивание удалённых из Synced_dir файлов и repo gc
+    pin_reconcile_interval = DEFAULT_RECONCILE_INTERVAL  # Секунд между сверками
+    pin_reconcile_dry_run = False  # Только отчёт: что было бы запинено, отпинено и собрано GC
+    storage_budget = None  # Бюджет репозитория в байтах; None — Datastore.StorageMax из конфига Kubo
+    gc_idle_seconds = 300  # GC только после стольких секунд без добавлений и загрузок; при превышении бюджета — 30 с
+    gc_hours = None  # Окно GC в часах местного времени, например (1, 6); None — в любое время
+    cluster_enabled = False  # Репликация маппинга между узлами кластера через pubsub IPFS
+    cluster_topic = DEFAULT_TOPIC  # Топик pubsub, общий для всех узлов кластера
+    cluster_peers = None  # PeerID узлов, от которых принимаются изменения; без списка репликация не запускается
+    cluster_publish_interval = DEFAULT_PUBLISH_INTERVAL  # Секунд между рассылками локальных изменений
+    cluster_catch_up_interval = DEFAULT_CATCH_UP_INTERVAL  # Секунд между обменами векторами версий
+    daemon_ready_timeout = 300  # Максимум секунд ожидания готовности API после запуска демона
+    log_level = logging.INFO  # logging.DEBUG — построчные записи по каждому файлу и пиру
+    metrics_port = metrics.DEFAULT_METRICS_PORT  # Локальный эндпоинт /metrics и /traces; None — отключить
+    tracing = False  # Трассировка спанов add_to_ipfs и sync_files_to_synced_dir
 
-    logger = setup_logging(node_name)
+    logger = setup_logging(node_name, log_level)
     logger.info(f"START: Запуск скрипта версии {SCRIPT_VERSION} (публичная сеть) с узлом {node_name}")
 
     logger.info("MAIN: Проверка директорий")
@@ -79,104 +144,291 @@ async def main():
         return
 
     logger.info("MAIN: Загрузка file_cid_mapping.json")
-    file_cid_mapping = initialize_file_cid_mapping(mapping_file, logger)
+    if state_backend == 'sqlite':
+        file_cid_mapping = initialize_state_store(state_db, mapping_file, deleted_files_path, logger)
+    else:
+        file_cid_mapping = initialize_file_cid_mapping(mapping_file, logger)
     if file_cid_mapping is None:
         logger.error("MAIN_ERROR: Не удалось инициализировать file_cid_mapping.json, завершение работы")
         return
+    backup_file_cid_mapping(mapping_file, logger, store=getattr(file_cid_mapping, 'store', None), keep=backup_keep)
+    lazy_cache = None
+    if materialize == 'lazy':
+        # Индекс заглушек живёт в базе состояния (или в отдельной базе при JSON-бэкенде)
+        lazy_cache = LazyCache(ipfs_path, synced_dir, state_db if state_backend == 'sqlite' else
+                               os.path.join(os.path.dirname(mapping_file), 'lazy_cache.db'), logger,
+                               budget=lazy_cache_budget, policy=lazy_cache_policy)
+        lazy_cache.attach(file_cid_mapping)
+        if metrics_port is None:
+            logger.warning("MAIN: Эндпоинт метрик отключён, открытие файлов ленивого режима доступно только из кода")
 
-    logger.info("MAIN: Проверка статуса демона IPFS")
-    try:
-        result = subprocess.run(
-            [ipfs_path, 'id'],
-            capture_output=True, text=True, check=True, timeout=30
-        )
-        logger.info("MAIN: Демон IPFS активен")
-    except subprocess.CalledProcessError as e:
-        logger.error(f"MAIN_ERROR: Ошибка при проверке демона IPFS: {e.stderr}")
-        logger.info("MAIN: Попытка запуска демона IPFS")
+    metrics_server = None
+    if metrics_port is not None:
         try:
-            subprocess.Popen(
-                [ipfs_path, 'daemon'],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            await asyncio.sleep(10)
-        except Exception as e:
-            logger.error(f"MAIN_ERROR: Не удалось запустить демон IPFS: {e}")
-            return
-    except Exception as e:
-        logger.error(f"MAIN_ERROR: Неизвестная ошибка при проверке демона IPFS: {e}")
-        return
+            metrics_server = metrics.start_metrics_server(logger, port=metrics_port)
+        except OSError as e:
+            logger.error(f"MAIN_ERROR: Не удалось запустить эндпоинт метрик на порту {metrics_port}: {e}")
+    if tracing:
+        metrics.tracer.enable(logger)
 
+    # Репозиторий и конфиг готовятся до запуска демона: изменения конфига пишутся одной записью
+    # (через CLI, если демон ещё не запущен) и сразу вступают в силу при его старте
     logger.info("MAIN: Инициализация IPFS")
     try:
-        ensure_ipfs_initialized(ipfs_path, logger)
+        await run_blocking(ensure_ipfs_initialized, ipfs_path, logger)
     except Exception as e:
         logger.error(f"MAIN_ERROR: Ошибка инициализации IPFS: {e}")
         return
 
     logger.info("MAIN: Настройка публичной сети")
+    extra_config = {}
+    if export_mode == 'filestore':
+        extra_config['Experimental.FilestoreEnabled'] = True
+    if cluster_enabled and not cluster_peers:
+        # Топик в публичной сети открыт любому подписчику: без списка узлов кластера изменения не принимаются
+        logger.error("MAIN_ERROR: Репликация отключена: не задан cluster_peers (PeerID узлов кластера)")
+        cluster_enabled = False
+    if cluster_enabled:
+        extra_config['Pubsub.Enabled'] = True
     try:
-        setup_public_network(ipfs_path, logger, node_name)
+        changed_config = await run_blocking(setup_public_network, ipfs_path, logger, node_name, extra_config)
     except Exception as e:
         logger.error(f"MAIN_ERROR: Ошибка настройки публичной сети: {e}")
         return
 
+    logger.info("MAIN: Проверка статуса демона IPFS")
+    supervisor = DaemonSupervisor(ipfs_path, logger, ready_timeout=daemon_ready_timeout)
+    try:
+        await supervisor.start()
+    except (IpfsError, OSError) as e:
+        logger.error(f"MAIN_ERROR: Не удалось запустить демон IPFS: {e}")
+        return
+    if supervisor.external and changed_config:
+        logger.warning(f"MAIN: Демон IPFS запущен не этим скриптом, изменения конфига "
+                       f"({', '.join(changed_config)}) вступят в силу после его перезапуска")
+        if 'Experimental.FilestoreEnabled' in changed_config:
+            export_mode = 'link'
+        if 'Pubsub.Enabled' in changed_config:
+            cluster_enabled = False
+    async_client = AsyncIpfsClient(ipfs_path, logger)
+
     logger.info("MAIN: Получение PeerID")
     try:
-        result = subprocess.run(
-            [ipfs_path, 'id', '--format=<id>'],
-            capture_output=True, text=True, check=True
-        )
-        peer_id = result.stdout.strip()
+        peer_id = (await async_client.id(timeout=30))['ID']
         logger.info(f"PEER_ID: PeerID узла local: {peer_id}")
-    except subprocess.CalledProcessError as e:
+    except IpfsError as e:
         logger.error(f"PEER_ID_ERROR: Ошибка при получении PeerID: {e.stderr}")
+        await supervisor.stop()
         return
 
-    logger.info("MAIN: Проверка новых файлов")
-    try:
-        check_new_files(ipfs_path, upload_dir, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path)
-    except Exception as e:
-        logger.error(f"MAIN_ERROR: Ошибка при проверке новых файлов: {e}")
-        return
+    dedup_cache = FingerprintCache(dedup_cache_file, logger, max_entries=dedup_cache_size)
+    await run_blocking(dedup_cache.load)
+    # Индекс сканирования Upload живёт в базе состояния (или в отдельной базе при JSON-бэкенде)
+    scan_index = ScanIndex(state_db if state_backend == 'sqlite' else
+                           os.path.join(os.path.dirname(mapping_file), 'scan_index.db'), logger)
+    large_ingest = None
+    if large_file_threshold is not None:
+        large_ingest = ResumableIngest(ipfs_path, logger, ingest_checkpoint_file, threshold=large_file_threshold,
+                                       segment_size=large_file_segment)
+        for relative_path, checkpoint in large_ingest.pending().items():
+            logger.info(f"MAIN: Незавершённое добавление {relative_path}: записано {checkpoint['offset'] // MIB} "
+                        f"из {checkpoint['size'] // MIB} МиБ, будет продолжено")
 
+    # Наблюдатель запускается до разбора накопившихся файлов, чтобы новые события не ждали старта
     logger.info("MAIN: Настройка наблюдателя за файловой системой")
+    observer = None
     try:
-        event_handler = NewFileHandler(ipfs_path, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path, delete_after_sync=True)
-        observer = Observer()
-        observer.schedule(event_handler, upload_dir, recursive=True)
-        observer.schedule(event_handler, synced_dir, recursive=True)
+        event_handler = NewFileHandler(ipfs_path, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path, delete_after_sync=True,
+                                       batch_size=batch_size, debounce=debounce, ingest_workers=ingest_workers,
+                                       dedup_cache=dedup_cache, only_hash_precheck=only_hash_precheck,
+                                       upload_dir=upload_dir, mapping_file=mapping_file,
+                                       size_classes=size_classes, large_ingest=large_ingest, scan_index=scan_index,
+                                       export_mode=export_mode)
+        event_handler.start()
+        observer = FileWatcher(event_handler, logger, backend=watcher_backend)
+        observer.schedule(upload_dir, UPLOAD_MASK, rescan_new_dirs=True)
+        observer.schedule(synced_dir, SYNCED_MASK)
         observer.start()
         logger.info("MAIN: Наблюдатель запущен")
     except Exception as e:
         logger.error(f"MAIN_ERROR: Ошибка при настройке наблюдателя: {e}")
-        observer.stop()
+        if observer is not None:
+            observer.stop()
+        await supervisor.stop()
         return
 
-    logger.info("MAIN: Запуск цикла проверки пинов и mDNS")
+    stop_event = asyncio.Event()
+    # Отмена задачи не останавливает поток run_blocking: длинные операции (стартовое добавление,
+    # проверка Synced_dir) сами проверяют stop_workers между пачками
+    stop_workers = threading.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остановка по Ctrl+C придёт как KeyboardInterrupt
+            pass
+
+    logger.info("MAIN: Запуск задач: стартовая проверка файлов, синхронизация, проверка пинов и mDNS")
+    tasks = [
+        asyncio.create_task(run_backlog_ingest(ipfs_path, upload_dir, node_name, logger, file_cid_mapping, synced_dir,
+                                               deleted_files_path, mapping_file, batch_size, dedup_cache,
+                                               only_hash_precheck, size_classes, large_ingest, scan_index,
+                                               scan_memory_limit_mb, export_mode, stop_workers),
+                            name='ingest'),
+        asyncio.create_task(run_sync_loop(ipfs_path, logger, file_cid_mapping, synced_dir, deleted_files_path,
+                                          export_mode=export_mode),
+                            name='sync'),
+        asyncio.create_task(run_pin_check_loop(ipfs_path, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path,
+                                               dedup_cache=dedup_cache),
+                            name='pin-check'),
+        asyncio.create_task(manage_mdns_connections(ipfs_path, node_name, logger), name='peers'),
+    ]
+    if pin_reconcile:
+        reconciler = PinReconciler(ipfs_path, logger, file_cid_mapping, deleted_files_path,
+                                   storage_budget=storage_budget, gc_idle_seconds=gc_idle_seconds, gc_hours=gc_hours,
+                                   dry_run=pin_reconcile_dry_run, dedup_cache=dedup_cache)
+        tasks.append(asyncio.create_task(run_pin_reconcile_loop(reconciler, logger, pin_reconcile_interval),
+                                         name='pin-reconcile'))
+    replicator = None
+    if cluster_enabled:
+        replica_store = ReplicaStore(state_db if state_backend == 'sqlite' else
+                                     os.path.join(os.path.dirname(mapping_file), 'replica.db'), logger)
+        replicator = MappingReplicator(peer_id, file_cid_mapping, synced_dir, deleted_files_path,
+                                       PubsubTransport(ipfs_path, cluster_topic, peer_id, logger), replica_store,
+                                       logger, allowed_peers=cluster_peers)
+        await run_blocking(replicator.start)
+        tasks.append(asyncio.create_task(
+            run_replication_loop(replicator, ipfs_path, logger, file_cid_mapping, synced_dir, deleted_files_path,
+                                 cluster_publish_interval, cluster_catch_up_interval, export_mode),
+            name='replication'))
+    if lazy_cache is not None:
+        tasks.append(asyncio.create_task(run_prefetch_loop(lazy_cache, logger, lazy_prefetch_interval),
+                                         name='lazy-prefetch'))
+    if verify_synced_on_start:
+        tasks.append(asyncio.create_task(
+            run_blocking(verify_synced_files, ipfs_path, synced_dir, logger, file_cid_mapping, size_classes=size_classes,
+                         stop_event=stop_workers),
+            name='verify'))
     try:
-        tasks = [
-            asyncio.create_task(manage_mdns_connections(ipfs_path, node_name, logger)),
-            asyncio.create_task(run_pin_check_loop(ipfs_path, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path))
-        ]
-        await asyncio.gather(*tasks, return_exceptions=True)
-    except KeyboardInterrupt:
+        await stop_event.wait()
+        logger.info("STOP: Получен сигнал остановки")
+    except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("STOP: Скрипт остановлен")
     except Exception as e:
         logger.error(f"MAIN_ERROR: Ошибка в основном цикле: {e}")
     finally:
+        stop_workers.set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
         observer.stop()
         observer.join()
+        event_handler.stop()
+        # Экспорт состояния, закрытие журнала маппинга и остановка демона — только после того, как
+        # потоки добавления и синхронизации закончили текущую пачку: иначе их изменения маппинга
+        # потерялись бы, а add шли бы в остановленный демон
+        logger.info("STOP: Ожидание завершения фоновых операций")
+        await loop.shutdown_default_executor()
+        if replicator is not None:
+            replicator.stop()
+        store = getattr(file_cid_mapping, 'store', None)
+        if store is not None:
+            store.export_json(mapping_file, deleted_files_path)
+        persister = getattr(file_cid_mapping, 'persister', None)
+        if persister is not None:
+            persister.close()
+        await supervisor.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        logger.info("STOP: Все задачи остановлены")
+
+async def run_backlog_ingest(ipfs_path, upload_dir, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path,
+                             mapping_file, batch_size, dedup_cache, only_hash_precheck, size_classes, large_ingest,
+                             scan_index, scan_memory_limit_mb, export_mode, stop_workers=None):
+    logger.info("MAIN: Проверка новых файлов")
+    try:
+        await run_blocking(check_new_files, ipfs_path, upload_dir, node_name, logger, file_cid_mapping, synced_dir,
+                           deleted_files_path, batch_size=batch_size, dedup_cache=dedup_cache,
+                           only_hash_precheck=only_hash_precheck, mapping_file=mapping_file,
+                           size_classes=size_classes, large_ingest=large_ingest, scan_index=scan_index,
+                           memory_limit_mb=scan_memory_limit_mb, export_mode=export_mode, stop_event=stop_workers)
+    except Exception as e:
+        logger.error(f"MAIN_ERROR: Ошибка при проверке новых файлов: {e}")
 
-async def run_pin_check_loop(ipfs_path, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path):
+async def run_sync_loop(ipfs_path, logger, file_cid_mapping, synced_dir, deleted_files_path,
+                        interval=60, full_reconcile_every=60, export_mode='link'):
+    # Каждый цикл синхронизирует только изменения маппинга; полная сверка — раз в full_reconcile_every циклов
+    cycle = 0
     while True:
-        logger.info("PIN_CHECK_LOOP: Начало цикла проверки пиннов")
+        await asyncio.sleep(interval)
+        cycle += 1
         try:
-            list_pinned_files(ipfs_path, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path)
+            await run_blocking(sync_files_to_synced_dir, ipfs_path, synced_dir, logger, file_cid_mapping,
+                               deleted_files_path, full=cycle % full_reconcile_every == 0, export_mode=export_mode)
+        except Exception as e:
+            logger.error(f"SYNC_LOOP_ERROR: Ошибка в цикле синхронизации: {e}")
+
+async def run_pin_check_loop(ipfs_path, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path,
+                             interval=60, dedup_cache=None):
+    while True:
+        logger.debug("PIN_CHECK_LOOP: Starting pin check cycle")
+        try:
+            await run_blocking(list_pinned_files, ipfs_path, node_name, logger, file_cid_mapping, synced_dir,
+                               deleted_files_path, sync=False)
         except Exception as e:
             logger.error(f"PIN_CHECK_LOOP_ERROR: Ошибка в цикле проверки пиннов: {e}")
-        logger.info("PIN_CHECK_LOOP: Ожидание 60 секунд")
-        await asyncio.sleep(60)
+        # Кэш дедупликации сохраняется каждый цикл (если менялся): сбой теряет не больше interval секунд отпечатков
+        if dedup_cache is not None:
+            await run_blocking(dedup_cache.save)
+        logger.debug(f"PIN_CHECK_LOOP: Waiting {interval} seconds")
+        await asyncio.sleep(interval)
+
+async def run_pin_reconcile_loop(reconciler, logger, interval=DEFAULT_RECONCILE_INTERVAL):
+    # Первая сверка — через interval после старта, когда стартовое добавление уже разобрано
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_blocking(reconciler.reconcile)
+        except Exception as e:
+            logger.error(f"PIN_RECONCILE_LOOP_ERROR: Ошибка в цикле сверки пинов: {e}")
+
+async def run_replication_loop(replicator, ipfs_path, logger, file_cid_mapping, synced_dir, deleted_files_path,
+                               interval=DEFAULT_PUBLISH_INTERVAL, catch_up_interval=DEFAULT_CATCH_UP_INTERVAL,
+                               export_mode='link'):
+    # Рассылка локальных изменений маппинга, периодический обмен векторами версий и выгрузка
+    # принятых от других узлов файлов, не дожидаясь обычного цикла синхронизации
+    catch_up_every = max(1, int(catch_up_interval // interval))
+    cycle = 0
+    while True:
+        await asyncio.sleep(interval)
+        cycle += 1
+        try:
+            await run_blocking(replicator.publish_local_changes)
+            if cycle % catch_up_every == 0:
+                await run_blocking(replicator.request_catch_up)
+            if replicator.pending_sync.is_set():
+                replicator.pending_sync.clear()
+                await run_blocking(sync_files_to_synced_dir, ipfs_path, synced_dir, logger, file_cid_mapping,
+                                   deleted_files_path, export_mode=export_mode)
+        except Exception as e:
+            logger.error(f"REPLICATION_LOOP_ERROR: Ошибка в цикле репликации маппинга: {e}")
+
+async def run_prefetch_loop(lazy_cache, logger, interval=DEFAULT_PREFETCH_INTERVAL):
+    # Предзагрузка по истории обращений и отчёт о попаданиях в кэш ленивого режима
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_blocking(lazy_cache.prefetch)
+            stats = lazy_cache.stats()
+            logger.info(f"LAZY_CACHE: Загружено {stats['cached_files']} из {stats['files']} файлов, "
+                        f"{stats['cached_bytes'] // (1024 * 1024)} из {stats['budget'] // (1024 * 1024)} МиБ, "
+                        f"попаданий {stats['hit_ratio']:.1%}, средняя загрузка {stats['fetch_latency_avg']:.2f} с")
+        except Exception as e:
+            logger.error(f"LAZY_PREFETCH_LOOP_ERROR: Ошибка в цикле предзагрузки: {e}")
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,321 @@
+import os
+import json
+import base64
+import hashlib
+import threading
+import logging
+from ipfs_client import get_client, IpfsError
+import metrics
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+MIB = 1024 * 1024
+# Файлы от этого размера добавляются сегментами с контрольной точкой
+DEFAULT_RESUMABLE_THRESHOLD = 1024 * MIB
+DEFAULT_SEGMENT_SIZE = 64 * MIB
+DEFAULT_SEGMENT_TIMEOUT = 600
+# Число ссылок во внутреннем узле сбалансированной раскладки Kubo (Import.UnixFSFileMaxLinks)
+LINKS_PER_NODE = 174
+_BASE58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+_DAG_PB = 0x70
+_SHA2_256 = 0x12
+# Классы размеров: (верхняя граница в байтах или None, параметры раскладки для ipfs add).
+# Ключи профиля: chunker ('size-N' или 'rabin-min-avg-max'), raw_leaves, cid_version, trickle.
+# Пустой профиль — раскладка демона по умолчанию, CID мелких файлов не меняются
+DEFAULT_SIZE_CLASSES = (
+    (64 * MIB, {}),
+    (None, {'chunker': 'size-1048576', 'raw_leaves': True, 'cid_version': 1}),
+)
+PROGRESS_STEP = 0.1
+
+
+def profile_for_size(size, size_classes=DEFAULT_SIZE_CLASSES):
+    for limit, profile in size_classes:
+        if limit is None or size < limit:
+            return profile
+    return {}
+
+
+def segment_chunk_size(profile):
+    # Размер блока, если DAG профиля собирается из сегментов: сбалансированная раскладка
+    # с явным фиксированным chunker. trickle и rabin режут файл не по границам сегментов,
+    # а chunker по умолчанию задаётся конфигом демона — для них None
+    chunker = profile.get('chunker') or ''
+    if profile.get('trickle') or not chunker.startswith('size-'):
+        return None
+    return int(chunker[len('size-'):])
+
+
+def aligned_segment_size(chunk_size, segment_size):
+    # Полный сегмент — целое поддерево DAG из chunk_size * LINKS_PER_NODE**k байт, не меньше одного уровня
+    size = chunk_size * LINKS_PER_NODE
+    while size * LINKS_PER_NODE <= segment_size:
+        size *= LINKS_PER_NODE
+    return size
+
+
+def _tree_depth(leaves):
+    depth, capacity = 0, 1
+    while capacity < leaves:
+        depth += 1
+        capacity *= LINKS_PER_NODE
+    return depth
+
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def cid_to_bytes(cid):
+    # CIDv0 (base58btc, 'Qm...') или CIDv1 в base32 ('b...')
+    if cid.startswith('Qm'):
+        number = 0
+        for char in cid:
+            number = number * 58 + _BASE58.index(char)
+        return number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    if cid.startswith('b'):
+        body = cid[1:].upper()
+        return base64.b32decode(body + '=' * (-len(body) % 8))
+    raise ValueError(f"неподдерживаемая кодировка CID: {cid[:1]!r}")
+
+
+def bytes_to_cid(raw):
+    if raw[0] == _SHA2_256:
+        number = int.from_bytes(raw, 'big')
+        chars = ''
+        while number:
+            number, rest = divmod(number, 58)
+            chars = _BASE58[rest] + chars
+        return chars
+    return 'b' + base64.b32encode(raw).decode('ascii').lower().rstrip('=')
+
+
+def _node_cid_version(cid):
+    # Версия CID узла dag-pb с sha2-256 или None для прочих кодеков и хешей
+    try:
+        raw = cid_to_bytes(cid)
+    except ValueError:
+        return None
+    if raw[:2] == bytes([_SHA2_256, 32]) and len(raw) == 34:
+        return 0
+    if raw[:4] == bytes([1, _DAG_PB, _SHA2_256, 32]):
+        return 1
+    return None
+
+
+def file_node(children, cid_version):
+    # Внутренний узел UnixFS-файла в том виде, в каком его пишет импортёр Kubo: ссылки dag-pb
+    # (Hash, пустой Name, Tsize), затем Data {Type: File, filesize, blocksizes...}.
+    # children — тройки (cid, накопленный размер DAG, байт файла); возвращает (cid, блок, tsize, байт)
+    filesize = sum(size for _, _, size in children)
+    links = b''
+    data = b'\x08\x02\x18' + _varint(filesize)
+    for cid, tsize, size in children:
+        raw = cid_to_bytes(cid)
+        link = b'\x0a' + _varint(len(raw)) + raw + b'\x12\x00\x18' + _varint(tsize)
+        links += b'\x12' + _varint(len(link)) + link
+        data += b'\x20' + _varint(size)
+    block = links + b'\x0a' + _varint(len(data)) + data
+    multihash = bytes([_SHA2_256, 32]) + hashlib.sha256(block).digest()
+    raw = multihash if cid_version == 0 else bytes([1, _DAG_PB]) + multihash
+    return bytes_to_cid(raw), block, len(block) + sum(tsize for _, tsize, _ in children), filesize
+
+
+class ProgressReporter:
+    # Колбэк progress для ipfs add: пишет в лог каждые PROGRESS_STEP от общего объёма пачки
+    def __init__(self, logger, label, total_bytes):
+        self.logger = logger
+        self.label = label
+        self.total_bytes = total_bytes
+        self._sent = {}
+        self._next_step = PROGRESS_STEP
+
+    def __call__(self, name, sent):
+        self._sent[name] = sent
+        done = sum(self._sent.values())
+        if self.total_bytes and done / self.total_bytes >= self._next_step:
+            self.logger.info(f"ADD_PROGRESS: {self.label}: {done / self.total_bytes:.0%} "
+                             f"({done // MIB} из {self.total_bytes // MIB} МиБ)")
+            while self._next_step <= done / self.total_bytes:
+                self._next_step += PROGRESS_STEP
+
+
+class ResumableIngest:
+    # Добавление больших файлов сегментами: каждый сегмент добавляется обычным ipfs add
+    # (диапазон байт файла, с профилем класса размера и пином), после каждого сегмента
+    # сохраняется контрольная точка. Прерванное добавление (рестарт демона или ноды, таймаут)
+    # продолжается со следующего сегмента. Границы сегментов совпадают с границами поддеревьев
+    # сбалансированного DAG, поэтому корень собирается из корней сегментов через block put
+    # и совпадает с CID ipfs add всего файла с тем же профилем — дедупликация и проверка
+    # экспорта считают те же CID. Профили, которые так не собрать (trickle, rabin, chunker
+    # по умолчанию), добавляются целиком без возобновления.
+    def __init__(self, ipfs_path, logger, checkpoint_file, threshold=DEFAULT_RESUMABLE_THRESHOLD,
+                 segment_size=DEFAULT_SEGMENT_SIZE, segment_timeout=DEFAULT_SEGMENT_TIMEOUT):
+        self.ipfs_path = ipfs_path
+        self.logger = logger
+        self.checkpoint_file = checkpoint_file
+        self.threshold = threshold
+        self.segment_size = segment_size
+        self.segment_timeout = segment_timeout
+        self._lock = threading.Lock()
+        self._checkpoints = self._load()
+
+    def _load(self):
+        try:
+            if os.path.exists(self.checkpoint_file):
+                with open(self.checkpoint_file, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            self.logger.error(f"LARGE_INGEST_ERROR: Ошибка при загрузке {self.checkpoint_file}: {e}")
+        return {}
+
+    def _save(self):
+        try:
+            with self._lock:
+                data = dict(self._checkpoints)
+            os.makedirs(os.path.dirname(self.checkpoint_file), exist_ok=True)
+            tmp_path = f"{self.checkpoint_file}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.checkpoint_file)
+        except Exception as e:
+            self.logger.error(f"LARGE_INGEST_ERROR: Ошибка при сохранении {self.checkpoint_file}: {e}")
+
+    def _set_checkpoint(self, relative_path, checkpoint):
+        with self._lock:
+            if checkpoint is None:
+                self._checkpoints.pop(relative_path, None)
+            else:
+                self._checkpoints[relative_path] = checkpoint
+        self._save()
+
+    def pending(self):
+        with self._lock:
+            return dict(self._checkpoints)
+
+    def _release_segments(self, client, relative_path, cids):
+        # Снимает пины сегментов, кроме общих с другими незавершёнными добавлениями
+        # (одинаковое содержимое, например нулевые участки, даёт одинаковые CID сегментов)
+        with self._lock:
+            shared = {segment[0] for path, checkpoint in self._checkpoints.items() if path != relative_path
+                      for segment in checkpoint.get('segments', [])}
+        cids = [cid for cid in dict.fromkeys(cids) if cid not in shared]
+        try:
+            if cids:
+                client.pin_rm(*cids)
+        except IpfsError as e:
+            self.logger.warning(f"LARGE_INGEST_CLEANUP: Не удалось снять пины сегментов {relative_path}: {e.stderr}")
+
+    def _discard(self, client, relative_path, checkpoint):
+        # Брошенное добавление; контрольные точки прежнего формата хранили файл в MFS — он удаляется
+        if checkpoint.get('mfs_path'):
+            try:
+                client.files_rm(checkpoint['mfs_path'])
+            except IpfsError as e:
+                self.logger.warning(f"LARGE_INGEST_CLEANUP: Не удалось удалить {checkpoint['mfs_path']}: {e.stderr}")
+        self._release_segments(client, relative_path, [segment[0] for segment in checkpoint.get('segments', [])])
+        self._set_checkpoint(relative_path, None)
+
+    def _changed(self, file_path, st):
+        current = os.stat(file_path)
+        return (current.st_size, current.st_mtime_ns) != (st.st_size, st.st_mtime_ns)
+
+    def _ingest_whole(self, client, file_path, relative_path, profile, st):
+        self.logger.info(f"LARGE_INGEST_WHOLE: {relative_path}: профиль {profile} не собирается из сегментов, "
+                         f"файл добавляется целиком без возобновления")
+        entries = list(client.add([(relative_path, file_path)], pin=True, **profile))
+        metrics.inc('ingest_large_bytes_total', st.st_size)
+        if self._changed(file_path, st):
+            self.logger.warning(f"LARGE_INGEST_CHANGED: Файл {relative_path} изменился во время добавления, "
+                                f"добавление начнётся заново")
+            return None
+        return entries[-1]['Hash']
+
+    def _put_node(self, client, children, cid_version):
+        cid, block, tsize, size = file_node(children, cid_version)
+        stored = client.block_put(block, cid_version=cid_version, timeout=self.segment_timeout)
+        if cid_to_bytes(stored) != cid_to_bytes(cid):
+            raise IpfsError(f"block put: демон вернул {stored}, ожидался {cid}")
+        return cid, tsize, size
+
+    def _assemble(self, client, segments, chunk_size, segment_size):
+        # Полный сегмент — поддерево глубины depth; неполный последний дотягивается до той же
+        # глубины узлами с одной ссылкой, выше узлы собираются по LINKS_PER_NODE, как у импортёра Kubo
+        level = [tuple(segment) for segment in segments]
+        if len(level) == 1:
+            return level[0][0]
+        cid_version = _node_cid_version(level[0][0])
+        depth = _tree_depth(segment_size // chunk_size)
+        last = level[-1]
+        for _ in range(_tree_depth(-(-last[2] // chunk_size)), depth):
+            last = self._put_node(client, [last], cid_version)
+        level[-1] = last
+        while len(level) > 1:
+            level = [self._put_node(client, level[i:i + LINKS_PER_NODE], cid_version)
+                     for i in range(0, len(level), LINKS_PER_NODE)]
+        return level[0][0]
+
+    def ingest(self, file_path, relative_path, profile=None):
+        # Возвращает CID или None, если файл изменился во время добавления (повтор при следующем событии)
+        profile = profile or {}
+        client = get_client(self.ipfs_path, self.logger)
+        st = os.stat(file_path)
+        with self._lock:
+            checkpoint = self._checkpoints.get(relative_path)
+        chunk_size = segment_chunk_size(profile)
+        if chunk_size is None:
+            if checkpoint is not None:
+                self._discard(client, relative_path, checkpoint)
+            return self._ingest_whole(client, file_path, relative_path, profile, st)
+
+        segment_size = aligned_segment_size(chunk_size, self.segment_size)
+        source = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'profile': profile, 'segment_size': segment_size}
+        segments = []
+        if checkpoint is not None and all(checkpoint.get(key) == value for key, value in source.items()):
+            segments = checkpoint['segments']
+            self.logger.info(f"LARGE_INGEST_RESUME: {relative_path}: продолжение с {checkpoint['offset'] / MIB:.1f} "
+                             f"из {st.st_size / MIB:.1f} МиБ")
+        elif checkpoint is not None:
+            self._discard(client, relative_path, checkpoint)
+
+        offset = len(segments) * segment_size
+        last_step = offset / st.st_size
+        while offset < st.st_size:
+            count = min(segment_size, st.st_size - offset)
+            with metrics.span('large_ingest_segment', path=relative_path, offset=offset):
+                entry = list(client.add([(relative_path, file_path)], pin=True, timeout=self.segment_timeout,
+                                        offset=offset, count=count, **profile))[-1]
+            if not segments and count == segment_size and _node_cid_version(entry['Hash']) is None:
+                # Демон хеширует не sha2-256 (Import.HashFunction) — узлы над сегментами не собрать
+                self._discard(client, relative_path, {'segments': [[entry['Hash'], 0, count]]})
+                return self._ingest_whole(client, file_path, relative_path, profile, st)
+            tsize = entry.get('Size')
+            if tsize is None:
+                tsize = client.files_stat(f"/ipfs/{entry['Hash']}")['CumulativeSize']
+            segments.append([entry['Hash'], int(tsize), count])
+            offset += count
+            metrics.inc('ingest_large_bytes_total', count)
+            self._set_checkpoint(relative_path, dict(source, segments=segments, offset=offset))
+            if offset / st.st_size - last_step >= PROGRESS_STEP or offset == st.st_size:
+                last_step = offset / st.st_size
+                self.logger.info(f"ADD_PROGRESS: {relative_path}: {last_step:.0%} "
+                                 f"({offset // MIB} из {st.st_size // MIB} МиБ)")
+
+        if self._changed(file_path, st):
+            self.logger.warning(f"LARGE_INGEST_CHANGED: Файл {relative_path} изменился во время добавления, "
+                                f"добавление начнётся заново")
+            self._discard(client, relative_path, {'segments': segments})
+            return None
+
+        cid = self._assemble(client, segments, chunk_size, segment_size)
+        client.pin_add(cid)
+        # Корни сегментов остаются в DAG файла под его рекурсивным пином
+        self._release_segments(client, relative_path, [segment[0] for segment in segments if segment[0] != cid])
+        self._set_checkpoint(relative_path, None)
+        return cid
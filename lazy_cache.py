@@ -0,0 +1,469 @@
+import os
+import json
+import math
+import time
+import sqlite3
+import threading
+import logging
+from ipfs_client import get_client, IpfsError
+from file_sync import partial_path_for, remove_quietly
+from pin_reconciler import activity
+import metrics
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+# Заглушка лежит рядом с местом будущего файла: <имя>.ipfs-lazy с CID и размером внутри
+LAZY_SUFFIX = '.ipfs-lazy'
+MATERIALIZE_MODES = ('eager', 'lazy')
+EVICTION_POLICIES = ('lru', 'lfu')
+DEFAULT_CACHE_BUDGET = 10 * 1024 ** 3
+DEFAULT_POLICY = 'lru'
+# Счётчик обращений затухает вдвое за half_life секунд: по нему работают LFU и предзагрузка
+DEFAULT_HALF_LIFE = 24 * 3600
+# Предзагружаются файлы с затухшим счётчиком не ниже порога, пока кэш заполнен меньше чем на долю бюджета
+DEFAULT_PREFETCH_MIN_HEAT = 2.0
+DEFAULT_PREFETCH_FILL = 0.9
+DEFAULT_PREFETCH_LIMIT = 50
+DEFAULT_PREFETCH_INTERVAL = 300
+DEFAULT_FETCH_TIMEOUT = 300
+STAT_TIMEOUT = 30
+# Сколько путей проверять по индексу одним запросом
+LOOKUP_CHUNK = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lazy_files (
+    path TEXT PRIMARY KEY,
+    cid TEXT NOT NULL,
+    size INTEGER,
+    cached INTEGER NOT NULL DEFAULT 0,
+    mtime_ns INTEGER,
+    last_access REAL NOT NULL DEFAULT 0,
+    heat REAL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS lazy_files_cached ON lazy_files (cached, last_access);
+CREATE INDEX IF NOT EXISTS lazy_files_heat ON lazy_files (cached, heat);
+CREATE TABLE IF NOT EXISTS local_files (
+    path TEXT PRIMARY KEY,
+    cid TEXT NOT NULL
+);
+"""
+
+
+class LazyCache:
+    # Ленивое наполнение Synced_dir. Для файлов из маппинга синхронизация создаёт заглушки,
+    # содержимое загружается при первом открытии через open() (HTTP /lazy/open или CLI этого
+    # модуля) и хранится в Synced_dir как обычный файл. Загруженное кэшем занимает не больше
+    # budget байт: сверх него вытесняются холодные файлы (LRU — по давности обращения, LFU — по
+    # затухающему счётчику обращений) и снова становятся заглушками. Файлы, которые уже были
+    # в Synced_dir (добавленные через Upload или выгруженные раньше), кэшем не управляются и не
+    # вытесняются. Файлы, добавленные самой нодой, отмечаются в local_files: для них заглушки не
+    # создаются, и их CID остаются запиненными, даже если копии в Upload уже нет. Индекс заглушек
+    # и истории обращений хранится в SQLite.
+    #
+    # heat хранит счётчик обращений в логарифмической форме log2(счётчик) + время / half_life:
+    # затухший на момент now счётчик равен 2 ** (heat - now / half_life), и сортировка по heat
+    # совпадает с сортировкой по затухшему счётчику без пересчёта всех строк.
+    def __init__(self, ipfs_path, synced_dir, db_path, logger, budget=DEFAULT_CACHE_BUDGET, policy=DEFAULT_POLICY,
+                 half_life=DEFAULT_HALF_LIFE, prefetch_min_heat=DEFAULT_PREFETCH_MIN_HEAT,
+                 prefetch_fill=DEFAULT_PREFETCH_FILL, prefetch_limit=DEFAULT_PREFETCH_LIMIT,
+                 fetch_timeout=DEFAULT_FETCH_TIMEOUT):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"неизвестная политика вытеснения {policy!r}, допустимо: {', '.join(EVICTION_POLICIES)}")
+        self.ipfs_path = ipfs_path
+        self.synced_dir = synced_dir
+        self.db_path = db_path
+        self.logger = logger
+        self.budget = budget
+        self.policy = policy
+        self.half_life = half_life
+        self.prefetch_min_heat = prefetch_min_heat
+        self.prefetch_fill = prefetch_fill
+        self.prefetch_limit = prefetch_limit
+        self.fetch_timeout = fetch_timeout
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.evicted = 0
+        self.fetches = 0
+        self.fetch_seconds = 0.0
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        # Одновременные открытия одного пути ждут одну загрузку
+        self._lock = threading.Lock()
+        self._inflight = {}
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, func):
+        with self._write_lock:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    def attach(self, file_cid_mapping):
+        # Синхронизация, сверка пинов и репликация находят кэш через маппинг
+        file_cid_mapping.lazy_cache = self
+        for key in ('files', 'cached_files', 'cached_bytes', 'hit_ratio'):
+            metrics.register_gauge(f'lazy_cache_{key}', lambda key=key: self.stats()[key])
+        metrics.register_route('/lazy/open', self._http_open)
+        metrics.register_route('/lazy/stats', self._http_stats)
+
+    # --- индекс ---
+
+    def placeholder_path(self, path):
+        return os.path.join(self.synced_dir, path + LAZY_SUFFIX)
+
+    def _row(self, path):
+        return self._conn().execute(
+            "SELECT cid, size, cached, mtime_ns, heat FROM lazy_files WHERE path = ?", (path,)).fetchone()
+
+    def _lookup(self, paths, table='lazy_files'):
+        result = {}
+        paths = list(paths)
+        conn = self._conn()
+        for start in range(0, len(paths), LOOKUP_CHUNK):
+            chunk = paths[start:start + LOOKUP_CHUNK]
+            rows = conn.execute(f"SELECT path, cid FROM {table} WHERE path IN ({','.join('?' * len(chunk))})", chunk)
+            result.update(rows)
+        return result
+
+    def paths(self):
+        # Пути, которыми управляет кэш (заглушки и загруженные им файлы)
+        return {row[0] for row in self._conn().execute("SELECT path FROM lazy_files")}
+
+    def mark_local(self, items):
+        # items: [(путь относительно Synced_dir, cid)] — файлы, которые нода добавила сама
+        items = list(items)
+        if items:
+            self._write(lambda conn: conn.executemany(
+                "INSERT OR REPLACE INTO local_files (path, cid) VALUES (?, ?)", items))
+
+    def local_paths(self, items):
+        # Пути из items [(путь, cid)], добавленные самой нодой с тем же CID
+        local = self._lookup((path for path, _ in items), table='local_files')
+        return {path for path, cid in items if local.get(path) == cid}
+
+    def local_files(self):
+        return dict(self._conn().execute("SELECT path, cid FROM local_files"))
+
+    def _heat(self, heat, now):
+        return 2 ** (heat - now / self.half_life) if heat is not None else 0.0
+
+    def _write_placeholder(self, path, cid, size):
+        stub_path = self.placeholder_path(path)
+        os.makedirs(os.path.dirname(stub_path), exist_ok=True)
+        partial_path = partial_path_for(stub_path)
+        with open(partial_path, 'w') as f:
+            json.dump({'cid': cid, 'size': size, 'path': path}, f)
+        os.replace(partial_path, stub_path)
+
+    def add_placeholders(self, items):
+        # items: [(путь относительно Synced_dir, cid)] для файлов, которых нет в Synced_dir.
+        # Существующая заглушка с тем же CID не трогается; история обращений пути сохраняется.
+        # Возвращает число созданных или обновлённых заглушек
+        items = list(items)
+        known = self._lookup(path for path, _ in items)
+        changed = []
+        for path, cid in items:
+            if known.get(path) == cid and os.path.exists(self.placeholder_path(path)):
+                continue
+            try:
+                self._write_placeholder(path, cid, None)
+            except OSError as e:
+                self.logger.error(f"LAZY_CACHE_ERROR: Не удалось создать заглушку для {path}: {e}")
+                continue
+            changed.append((path, cid))
+        if changed:
+            self._write(lambda conn: conn.executemany(
+                "INSERT INTO lazy_files (path, cid) VALUES (?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET cid = excluded.cid, size = NULL, cached = 0, mtime_ns = NULL",
+                changed))
+        return len(changed)
+
+    def forget(self, path):
+        # Путь удалён (пользователем или надгробием из кластера): убрать заглушку и запись индекса
+        stub_path = self.placeholder_path(path)
+        if os.path.exists(stub_path):
+            try:
+                remove_quietly(stub_path)
+            except OSError as e:
+                self.logger.error(f"LAZY_CACHE_ERROR: Не удалось удалить заглушку {stub_path}: {e}")
+        def apply(conn):
+            conn.execute("DELETE FROM lazy_files WHERE path = ?", (path,))
+            conn.execute("DELETE FROM local_files WHERE path = ?", (path,))
+        self._write(apply)
+
+    # --- открытие и загрузка ---
+
+    def _relative(self, path):
+        # Принимает путь относительно Synced_dir, абсолютный путь к файлу или к его заглушке
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.synced_dir)
+            if path.startswith(os.pardir):
+                raise KeyError(path)
+        if path.endswith(LAZY_SUFFIX):
+            path = path[:-len(LAZY_SUFFIX)]
+        return os.path.normpath(path)
+
+    def open(self, path):
+        # Возвращает локальный путь к файлу, при необходимости загрузив его.
+        # KeyError, если путь неизвестен; IpfsError, если загрузка не удалась
+        path = self._relative(path)
+        dest_path = os.path.join(self.synced_dir, path)
+        row = self._row(path)
+        if row is None:
+            if os.path.isfile(dest_path):
+                metrics.inc('lazy_cache_requests_total', result='local')
+                return dest_path
+            raise KeyError(path)
+        with activity.busy(record=False):
+            fetched = self._materialize(path, row[0])
+        if fetched:
+            activity.touch()
+            self.misses += 1
+            metrics.inc('lazy_cache_requests_total', result='miss')
+        else:
+            self.hits += 1
+            metrics.inc('lazy_cache_requests_total', result='hit')
+        self._record_access(path)
+        if fetched:
+            self.enforce_budget(keep={path})
+        return dest_path
+
+    def _record_access(self, path):
+        now = time.time()
+
+        def apply(conn):
+            row = conn.execute("SELECT heat FROM lazy_files WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return
+            heat = math.log2(self._heat(row[0], now) + 1) + now / self.half_life
+            conn.execute("UPDATE lazy_files SET last_access = ?, heat = ?, hits = hits + 1 WHERE path = ?",
+                         (now, heat, path))
+        self._write(apply)
+
+    def _materialize(self, path, cid, reason='open'):
+        # True, если файл пришлось загрузить; параллельный вызов для того же пути ждёт первый
+        dest_path = os.path.join(self.synced_dir, path)
+        with self._lock:
+            waiter = self._inflight.get(path)
+            if waiter is None:
+                row = self._row(path)
+                if row is not None and row[2] and os.path.isfile(dest_path):
+                    return False
+                waiter = self._inflight[path] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            waiter.wait()
+            if not os.path.isfile(dest_path):
+                raise IpfsError(f"загрузка {path} ({cid}) не удалась")
+            return False
+        try:
+            self._fetch(path, cid, reason)
+            return True
+        finally:
+            with self._lock:
+                del self._inflight[path]
+            waiter.set()
+
+    def _fetch(self, path, cid, reason):
+        dest_path = os.path.join(self.synced_dir, path)
+        partial_path = partial_path_for(dest_path)
+        started = time.perf_counter()
+        try:
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            with metrics.span('lazy_fetch', path=path, reason=reason):
+                get_client(self.ipfs_path, self.logger).get(cid, partial_path, timeout=self.fetch_timeout)
+            os.replace(partial_path, dest_path)
+        except (IpfsError, OSError) as e:
+            try:
+                os.remove(partial_path)
+            except OSError:
+                pass
+            metrics.inc('lazy_cache_fetches_total', reason=reason, result='failed')
+            if isinstance(e, IpfsError):
+                raise
+            raise IpfsError(f"загрузка {path} ({cid}): {e}")
+        elapsed = time.perf_counter() - started
+        st = os.stat(dest_path)
+        self._write(lambda conn: conn.execute(
+            "UPDATE lazy_files SET cached = 1, size = ?, mtime_ns = ? WHERE path = ?",
+            (st.st_size, st.st_mtime_ns, path)))
+        stub_path = self.placeholder_path(path)
+        if os.path.exists(stub_path):
+            remove_quietly(stub_path)
+        self.fetches += 1
+        self.fetch_seconds += elapsed
+        metrics.observe('lazy_fetch_seconds', elapsed, reason=reason)
+        metrics.inc('lazy_cache_fetches_total', reason=reason, result='ok')
+        self.logger.debug(f"LAZY_CACHE: Fetched {path} ({cid}, {st.st_size} bytes) in {elapsed:.3f}s, reason {reason}")
+
+    # --- вытеснение и предзагрузка ---
+
+    def cached_bytes(self):
+        return self._conn().execute("SELECT COALESCE(SUM(size), 0) FROM lazy_files WHERE cached = 1").fetchone()[0]
+
+    def enforce_budget(self, keep=()):
+        # Вытесняет холодные файлы, пока загруженное кэшем не уместится в бюджет. Возвращает число вытесненных
+        total = self.cached_bytes()
+        if total <= self.budget:
+            return 0
+        order = 'last_access' if self.policy == 'lru' else 'COALESCE(heat, -1e300)'
+        rows = self._conn().execute(
+            f"SELECT path, cid, size, mtime_ns FROM lazy_files WHERE cached = 1 ORDER BY {order}").fetchall()
+        evicted, freed = [], 0
+        for path, cid, size, mtime_ns in rows:
+            if total - freed <= self.budget:
+                break
+            if path in keep:
+                continue
+            dest_path = os.path.join(self.synced_dir, path)
+            try:
+                if os.stat(dest_path).st_mtime_ns != mtime_ns:
+                    # Файл изменён на месте: это уже не копия CID, и вытеснять его нельзя
+                    self.logger.warning(f"LAZY_CACHE: Файл {path} изменён после загрузки, исключён из кэша")
+                    self._write(lambda conn: conn.execute("DELETE FROM lazy_files WHERE path = ?", (path,)))
+                    freed += size or 0
+                    continue
+                self._write_placeholder(path, cid, size)
+                remove_quietly(dest_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.error(f"LAZY_CACHE_ERROR: Не удалось вытеснить {path}: {e}")
+                continue
+            evicted.append(path)
+            freed += size or 0
+        if evicted:
+            self._write(lambda conn: conn.executemany(
+                "UPDATE lazy_files SET cached = 0, mtime_ns = NULL WHERE path = ?", [(path,) for path in evicted]))
+            self.evicted += len(evicted)
+            metrics.inc('lazy_cache_evictions_total', len(evicted), policy=self.policy)
+            self.logger.info(f"LAZY_CACHE_EVICT: Вытеснено {len(evicted)} файлов ({freed // (1024 * 1024)} МиБ) "
+                             f"по политике {self.policy.upper()}")
+        return len(evicted)
+
+    def prefetch(self):
+        # Загружает заглушки с наибольшим затухшим счётчиком обращений, пока кэш не заполнен
+        # до prefetch_fill бюджета; ради предзагрузки ничего не вытесняется. Возвращает число загруженных
+        now = time.time()
+        free = self.budget * self.prefetch_fill - self.cached_bytes()
+        if free <= 0:
+            return 0
+        rows = self._conn().execute(
+            "SELECT path, cid, size, heat FROM lazy_files WHERE cached = 0 AND heat IS NOT NULL "
+            "ORDER BY heat DESC LIMIT ?", (self.prefetch_limit,)).fetchall()
+        client = get_client(self.ipfs_path, self.logger)
+        fetched = 0
+        for path, cid, size, heat in rows:
+            if self._heat(heat, now) < self.prefetch_min_heat:
+                break
+            if size is None:
+                try:
+                    size = (client.files_stat(f'/ipfs/{cid}', timeout=STAT_TIMEOUT) or {}).get('Size')
+                except IpfsError as e:
+                    self.logger.debug(f"LAZY_CACHE: Cannot stat {cid} for prefetch: {e}")
+                    continue
+            if size is None or size > free:
+                continue
+            try:
+                with activity.busy(record=False):
+                    if not self._materialize(path, cid, reason='prefetch'):
+                        continue
+                activity.touch()
+            except IpfsError as e:
+                self.logger.warning(f"LAZY_CACHE: Не удалось предзагрузить {path}: {e}")
+                continue
+            free -= size
+            fetched += 1
+        if fetched:
+            self.prefetched += fetched
+            self.logger.info(f"LAZY_CACHE_PREFETCH: Предзагружено {fetched} часто открываемых файлов")
+        return fetched
+
+    def stats(self):
+        files, cached_files = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(cached), 0) FROM lazy_files").fetchone()
+        requests = self.hits + self.misses
+        return {
+            'files': files,
+            'cached_files': cached_files,
+            'cached_bytes': self.cached_bytes(),
+            'budget': self.budget,
+            'policy': self.policy,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests else 0.0,
+            'prefetched': self.prefetched,
+            'evicted': self.evicted,
+            'fetch_latency_avg': self.fetch_seconds / self.fetches if self.fetches else 0.0,
+        }
+
+    # --- HTTP API ---
+
+    def _http_open(self, query):
+        path = (query.get('path') or [''])[0]
+        try:
+            local_path = self.open(path)
+        except KeyError:
+            return 404, {'error': f'неизвестный путь {path}'}
+        except IpfsError as e:
+            return 502, {'error': str(e)}
+        return 200, {'path': path, 'local_path': local_path}
+
+    def _http_stats(self, query):
+        return 200, self.stats()
+
+
+if __name__ == '__main__':
+    # Клиент к работающему узлу: python lazy_cache.py open <путь>... | stats
+    import sys
+    import argparse
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+    from urllib.parse import urlencode
+    parser = argparse.ArgumentParser(description='Открытие файлов Synced_dir в ленивом режиме через работающий узел')
+    parser.add_argument('command', choices=('open', 'stats'))
+    parser.add_argument('paths', nargs='*', help='путь относительно Synced_dir, к файлу или к его заглушке')
+    parser.add_argument('--host', default=metrics.DEFAULT_METRICS_HOST)
+    parser.add_argument('--port', type=int, default=metrics.DEFAULT_METRICS_PORT)
+    options = parser.parse_args()
+    base_url = f'http://{options.host}:{options.port}'
+    status = 0
+    try:
+        if options.command == 'stats':
+            with urlopen(f'{base_url}/lazy/stats') as response:
+                print(json.dumps(json.load(response), ensure_ascii=False, indent=2))
+        for path in options.paths:
+            # Существующий локально путь (например, заглушка) передаётся абсолютным
+            wanted = os.path.abspath(path) if os.path.exists(path) else path
+            try:
+                with urlopen(f'{base_url}/lazy/open?{urlencode({"path": wanted})}') as response:
+                    print(json.load(response)['local_path'])
+            except HTTPError as e:
+                print(f"{path}: {json.load(e).get('error', e.reason)}", file=sys.stderr)
+                status = 1
+    except OSError as e:
+        print(f"Узел недоступен на {base_url}: {e}", file=sys.stderr)
+        status = 1
+    sys.exit(status)
@@ -0,0 +1,138 @@
+import os
+import sys
+import errno
+import shutil
+import hashlib
+import tempfile
+import logging
+from ipfs_client import get_client, IpfsError
+from large_ingest import profile_for_size, DEFAULT_SIZE_CLASSES
+import metrics
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+# Режимы выгрузки в Synced_dir:
+#   'copy'      — всегда ipfs get (полная копия из blockstore)
+#   'link'      — reflink (FICLONE) или жёсткая ссылка на локальный источник с тем же содержимым,
+#                 при невозможности — ipfs get
+#   'filestore' — добавленный файл переносится в Synced_dir и добавляется с --nocopy:
+#                 blockstore ссылается на байты файла, а не хранит их копию
+EXPORT_MODES = ('copy', 'link', 'filestore')
+DEFAULT_EXPORT_MODE = 'link'
+# ioctl FICLONE (Linux: Btrfs, XFS с reflink=1, bcachefs и др.)
+FICLONE = 0x40049409
+VERIFY_CHUNK_SIZE = 1024 * 1024
+
+
+def reflink(src_path, dest_path):
+    # Копия с общими экстентами: занимает место только под последующие изменения.
+    # False, если ФС или платформа reflink не поддерживает
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        with open(src_path, 'rb') as src, open(dest_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(src_path, dest_path)
+        return True
+    except OSError as e:
+        try:
+            os.remove(dest_path)
+        except OSError:
+            pass
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EPERM):
+            return False
+        raise
+
+
+def link_or_clone(src_path, dest_path, partial_path, allow_hardlink=True):
+    # Материализация dest_path без копирования байтов через временный partial_path.
+    # Возвращает 'reflink', 'hardlink' или None. Жёсткая ссылка делит inode с источником:
+    # допустима, только если источник больше не меняется (например, удаляется из Upload сразу после добавления)
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    method = None
+    if reflink(src_path, partial_path):
+        method = 'reflink'
+    elif allow_hardlink:
+        try:
+            os.link(src_path, partial_path)
+            method = 'hardlink'
+        except OSError:
+            method = None
+    if method is None:
+        return None
+    os.replace(partial_path, dest_path)
+    metrics.inc('export_local_total', method=method)
+    return method
+
+
+def _digest_file(path):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(VERIFY_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_export(ipfs_path, logger, file_path, cid, size_classes=DEFAULT_SIZE_CLASSES):
+    # Проверка, что файл в Synced_dir по-прежнему соответствует CID. Сначала add --only-hash
+    # с профилями, которыми файл мог быть добавлен (ничего не пишет в blockstore); если CID
+    # не совпал (другая раскладка DAG, например filestore или сегментное добавление),
+    # содержимое сравнивается побайтно с ipfs get во временный файл
+    client = get_client(ipfs_path, logger)
+    size = os.path.getsize(file_path)
+    profile = profile_for_size(size, size_classes)
+    profiles = [profile, {}, dict(profile, raw_leaves=True)]
+    seen = []
+    for profile in profiles:
+        if profile in seen:
+            continue
+        seen.append(profile)
+        entry = next(client.add([(os.path.basename(file_path), file_path)], only_hash=True, **profile), None)
+        if entry is not None and entry['Hash'] == cid:
+            return True
+    # Временный файл вне Synced_dir, чтобы наблюдатель не принял его удаление за удаление пользователем
+    fd, tmp_path = tempfile.mkstemp(prefix='ipfs-verify-')
+    os.close(fd)
+    try:
+        client.get(cid, tmp_path)
+        return _digest_file(tmp_path) == _digest_file(file_path)
+    finally:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def verify_synced_files(ipfs_path, synced_dir, logger, file_cid_mapping, paths=None, size_classes=DEFAULT_SIZE_CLASSES,
+                        stop_event=None):
+    # Проверка по требованию: возвращает список путей, содержимое которых не совпадает с CID.
+    # stop_event (threading.Event) прерывает проверку между файлами
+    logger.info("EXPORT_VERIFY_START: Проверка файлов Synced_dir на соответствие CID")
+    mismatched = []
+    checked = 0
+    items = ((path, file_cid_mapping.get(path)) for path in paths) if paths is not None else file_cid_mapping.items()
+    for path, cid in items:
+        if stop_event is not None and stop_event.is_set():
+            logger.info(f"EXPORT_VERIFY_END: Проверка прервана остановкой после {checked} файлов")
+            return mismatched
+        dest_path = os.path.join(synced_dir, path)
+        if cid is None or not os.path.exists(dest_path):
+            continue
+        try:
+            ok = verify_export(ipfs_path, logger, dest_path, cid, size_classes)
+        except (IpfsError, OSError) as e:
+            error = e.stderr if isinstance(e, IpfsError) else e
+            logger.error(f"EXPORT_VERIFY_ERROR: Не удалось проверить {path}: {error}")
+            continue
+        checked += 1
+        if not ok:
+            mismatched.append(path)
+            logger.warning(f"EXPORT_VERIFY_MISMATCH: Файл {dest_path} не соответствует CID {cid}")
+    metrics.set_gauge('export_verify_mismatched', len(mismatched))
+    logger.info(f"EXPORT_VERIFY_END: Проверено {checked} файлов, не совпадают: {len(mismatched)}")
+    return mismatched
@@ -0,0 +1,282 @@
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+DEFAULT_METRICS_HOST = '127.0.0.1'
+DEFAULT_METRICS_PORT = 9464
+# Границы корзин гистограмм задержек, секунд
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+DEFAULT_SPAN_BUFFER = 1000
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    # Счётчики, гистограммы и датчики в памяти процесса. Датчики могут быть функциями,
+    # которые вызываются при каждом снятии метрик (глубина очереди, число пиров).
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._callbacks = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def register_gauge(self, name, func, help_text=None):
+        # func() возвращает число или словарь {кортеж пар меток: значение}
+        with self._lock:
+            self._callbacks[name] = func
+        if help_text:
+            self.describe(name, help_text)
+
+    def unregister_gauge(self, name):
+        with self._lock:
+            self._callbacks.pop(name, None)
+
+    def observe(self, name, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # Длительность блока в гистограмму name, ошибки — в счётчик name_errors_total
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f"{name}_errors_total", **labels)
+            raise
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - started, **labels)
+
+    def value(self, name, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            for table in (self._counters, self._gauges):
+                if key in table.get(name, {}):
+                    return table[name][key]
+            histogram = self._histograms.get(name, {}).get(key)
+            return histogram.count if histogram is not None else None
+
+    def render(self):
+        # Текстовый формат экспозиции Prometheus 0.0.4
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            gauges = {name: dict(series) for name, series in self._gauges.items()}
+            histograms = {name: {key: (list(h.counts), h.sum, h.count) for key, h in series.items()}
+                          for name, series in self._histograms.items()}
+            callbacks = dict(self._callbacks)
+        for name, func in callbacks.items():
+            try:
+                result = func()
+            except Exception:
+                continue
+            gauges[name] = result if isinstance(result, dict) else {(): result}
+
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name in sorted(counters):
+            header(name, 'counter')
+            for key, value in sorted(counters[name].items()):
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        for name in sorted(gauges):
+            header(name, 'gauge')
+            for key, value in sorted(gauges[name].items()):
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        for name in sorted(histograms):
+            header(name, 'histogram')
+            for key, (counts, total, count) in sorted(histograms[name].items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+class Tracer:
+    # Необязательная трассировка: вложенные спаны в пределах потока связываются
+    # через trace_id и parent_id, завершённые спаны хранятся в кольцевом буфере.
+    def __init__(self, logger=None, buffer_size=DEFAULT_SPAN_BUFFER):
+        self.logger = logger
+        self.enabled = False
+        self.spans = deque(maxlen=buffer_size)
+        self._local = threading.local()
+
+    def enable(self, logger=None, buffer_size=None):
+        if logger is not None:
+            self.logger = logger
+        if buffer_size is not None and buffer_size != self.spans.maxlen:
+            self.spans = deque(self.spans, maxlen=buffer_size)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    @contextmanager
+    def span(self, name, **attrs):
+        if not self.enabled:
+            yield attrs
+            return
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        parent = stack[-1] if stack else None
+        record = {
+            'name': name,
+            'trace_id': parent['trace_id'] if parent else uuid.uuid4().hex[:16],
+            'span_id': uuid.uuid4().hex[:16],
+            'parent_id': parent['span_id'] if parent else None,
+            'thread': threading.current_thread().name,
+            'start': time.time(),
+            'attrs': attrs,
+        }
+        stack.append(record)
+        started = time.perf_counter()
+        try:
+            yield attrs
+            record['status'] = 'ok'
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = str(e)
+            raise
+        finally:
+            stack.pop()
+            record['duration'] = time.perf_counter() - started
+            self.spans.append(record)
+            if self.logger is not None:
+                self.logger.debug(
+                    f"TRACE: {name} {record['duration'] * 1000:.1f} ms trace={record['trace_id']} "
+                    f"span={record['span_id']} parent={record['parent_id']} {record['status']} {attrs}")
+
+    def recent(self, limit=100):
+        return list(self.spans)[-limit:]
+
+
+registry = MetricsRegistry()
+tracer = Tracer()
+
+inc = registry.inc
+observe = registry.observe
+set_gauge = registry.set_gauge
+register_gauge = registry.register_gauge
+timer = registry.timer
+span = tracer.span
+
+
+# Дополнительные GET-маршруты эндпоинта: путь -> функция(параметры запроса) -> (код ответа, объект для JSON)
+_routes = {}
+
+
+def register_route(path, func):
+    _routes[path] = func
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+    tracer = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        status = 200
+        if path == '/metrics':
+            body = self.registry.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/traces':
+            body = json.dumps(self.tracer.recent(), ensure_ascii=False, indent=2).encode('utf-8')
+            content_type = 'application/json'
+        elif path in _routes:
+            try:
+                status, payload = _routes[path](parse_qs(query))
+            except Exception as e:
+                status, payload = 500, {'error': str(e)}
+            body = json.dumps(payload, ensure_ascii=False, indent=2).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(logger, host=DEFAULT_METRICS_HOST, port=DEFAULT_METRICS_PORT,
+                         metrics_registry=None, span_tracer=None):
+    # Локальный HTTP-эндпоинт: /metrics для Prometheus и /traces с последними спанами
+    handler = type('MetricsHandler', (_MetricsHandler,), {
+        'registry': metrics_registry or registry,
+        'tracer': span_tracer or tracer,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f"METRICS: Метрики доступны на http://{host}:{server.server_port}/metrics")
+    return server
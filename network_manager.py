@@ -1,78 +1,82 @@
-import subprocess
 import logging
 import asyncio
+from collections import Counter
+from ipfs_client import IpfsError
+from async_ipfs import AsyncIpfsClient
+from peer_manager import PeerManager
+from pin_index import get_pin_index
+import metrics
 
 # Версия модуля
 MODULE_VERSION = "2.1.5"
 
-async def manage_mdns_connections(ipfs_path, node_name, logger):
+# Таймауты сетевых вызовов, секунд
+SWARM_TIMEOUT = 30
+DHT_TIMEOUT = 60
+
+async def manage_mdns_connections(ipfs_path, node_name, logger, interval=30, peer_manager=None):
     logger.info(f"MODULE_VERSION: network_manager версия {MODULE_VERSION}")
+    client = AsyncIpfsClient(ipfs_path, logger)
+    if peer_manager is None:
+        peer_manager = PeerManager(
+            logger,
+            list_peers=lambda: client.swarm_peers(timeout=SWARM_TIMEOUT),
+            connect=lambda addr: client.swarm_connect(addr, timeout=SWARM_TIMEOUT),
+            find_peer=lambda peer_id: client.dht_findpeer(peer_id, timeout=DHT_TIMEOUT),
+        )
+    for key in ('known', 'connected', 'joined_total', 'left_total', 'dials_total', 'dial_failures_total',
+                'connect_latency_avg', 'connect_latency_max'):
+        metrics.register_gauge(f'peers_{key}', lambda key=key: peer_manager.metrics()[key])
     try:
-        # Периодическая проверка подключённых узлов
+        # Периодическая проверка подключённых узлов: дозваниваемся только до выпавших пиров
         while True:
             try:
-                # Получение списка подключённых узлов
-                result = subprocess.run(
-                    [ipfs_path, 'swarm', 'peers'],
-                    capture_output=True, text=True, check=True
-                )
-                peers = result.stdout.splitlines()
-                logger.info(f"MDNS_PEERS: Подключённые узлы: {len(peers)}")
-                for peer in peers:
-                    logger.info(f"MDNS_PEERS: Активное соединение: {peer}")
-
-                # Попытка обнаружения новых узлов через mDNS и DHT
-                for peer in peers:
-                    peer_id = peer.split('/')[-1]
-                    logger.info(f"MDNS_DISCOVERY: Обнаружен узел: {peer}")
-                    try:
-                        subprocess.run(
-                            [ipfs_path, 'swarm', 'connect', peer],
-                            capture_output=True, text=True, check=True
-                        )
-                        logger.info(f"MDNS_CONNECT: Успешно подключено к {peer}")
-                    except subprocess.CalledProcessError as e:
-                        logger.warning(f"MDNS_CONNECT_ERROR: Не удалось подключиться к {peer}: {e.stderr}")
-
-                # Проверка DHT (публичная сеть)
-                try:
-                    if peers:  # Проверяем, есть ли пиры
-                        result = subprocess.run(
-                            [ipfs_path, 'dht', 'findpeers', peers[0].split('/')[-1]],
-                            capture_output=True, text=True, check=True
-                        )
-                        logger.info(f"DHT_CHECK: Найдены пиры в публичной сети: {result.stdout}")
-                except subprocess.CalledProcessError as e:
-                    logger.warning(f"DHT_CHECK_ERROR: Ошибка при проверке DHT: {e.stderr}")
-
-                # Ожидание 30 секунд перед следующей проверкой
-                await asyncio.sleep(30)
-            except subprocess.CalledProcessError as e:
+                await peer_manager.run_cycle()
+            except IpfsError as e:
                 logger.error(f"MDNS_ERROR: Ошибка при управлении mDNS: {e.stderr}")
+
+            # Ожидание перед следующей проверкой
+            await asyncio.sleep(interval)
     except Exception as e:
         logger.error(f"MDNS_ERROR: Общая ошибка при управлении mDNS: {e}")
 
-def list_pinned_files(ipfs_path, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path):
-    logger.info(f"MODULE_VERSION: network_manager версия {MODULE_VERSION}")
+def _cid_counts(file_cid_mapping):
+    # Пары (cid, число путей); обычный словарь без cid_counts() тоже поддерживается
+    cid_counts = getattr(file_cid_mapping, 'cid_counts', None)
+    if cid_counts is not None:
+        return cid_counts()
+    return Counter(file_cid_mapping.values()).items()
+
+def list_pinned_files(ipfs_path, node_name, logger, file_cid_mapping, synced_dir, deleted_files_path, full_sync=False,
+                      sync=True):
+    logger.debug(f"MODULE_VERSION: network_manager version {MODULE_VERSION}")
     try:
-        result = subprocess.run(
-            [ipfs_path, 'pin', 'ls', '--type=all'],
-            capture_output=True, text=True, check=True
-        )
-        pinned_cids = {}
-        for line in result.stdout.splitlines():
-            parts = line.split()
-            if len(parts) >= 2:
-                cid, pin_type = parts[0], parts[1]
-                pinned_cids[cid] = pin_type
-        
-        logger.info(f"LIST_PINNED: Список запинненных файлов и каталогов на ноде {node_name}:")
-        for path, cid in file_cid_mapping.items():
-            pin_type = pinned_cids.get(cid, 'неизвестно')
-            logger.info(f"LIST_PINNED: CID: {cid}, Тип: {pin_type}, Путь: {path}")
-        
+        # Маппинг читается потоково по различным CID: без копии всех пар путь -> CID на каждый цикл
+        index = get_pin_index(ipfs_path, logger)
+        with metrics.timer('pin_check'):
+            index.refresh(cid for cid, _ in _cid_counts(file_cid_mapping))
+
+        counts = {}
+        mapped = unpinned = 0
+        for cid, files in _cid_counts(file_cid_mapping):
+            mapped += files
+            pin_type = index.get(cid)
+            if pin_type is None:
+                unpinned += files
+                logger.debug(f"LIST_PINNED: CID {cid} ({files} files) is not pinned")
+            else:
+                counts[pin_type] = counts.get(pin_type, 0) + files
+        metrics.set_gauge('pin_index_size', len(index))
+        metrics.set_gauge('mapping_files', mapped)
+        metrics.set_gauge('mapping_files_unpinned', unpinned)
+        by_type = ', '.join(f"{pin_type}: {count}" for pin_type, count in sorted(counts.items())) or 'нет'
+        logger.info(
+            f"LIST_PINNED: Нода {node_name}: файлов в маппинге {mapped}, пинов в индексе {len(index)}, "
+            f"запинено по типам ({by_type}), не запинено {unpinned}")
+
         # Синхронизация файлов в Synced_dir
-        from file_sync import sync_files_to_synced_dir
-        sync_files_to_synced_dir(ipfs_path, synced_dir, logger, file_cid_mapping, deleted_files_path)
-    except subprocess.CalledProcessError as e:
+        if sync:
+            from file_sync import sync_files_to_synced_dir
+            sync_files_to_synced_dir(ipfs_path, synced_dir, logger, file_cid_mapping, deleted_files_path, full=full_sync)
+    except IpfsError as e:
         logger.error(f"LIST_PINNED_ERROR: Ошибка при получении списка пинов: {e.stderr}")
@@ -0,0 +1,154 @@
+import time
+import random
+import asyncio
+import logging
+from ipfs_client import IpfsError
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+DEFAULT_MAX_CONCURRENT_DIALS = 4
+DEFAULT_BASE_BACKOFF = 5.0
+DEFAULT_MAX_BACKOFF = 600.0
+# Пир, которого не видно дольше этого срока, удаляется из таблицы
+DEFAULT_FORGET_AFTER = 24 * 3600
+# После стольких неудачных попыток адрес пира уточняется через DHT
+DHT_LOOKUP_AFTER_FAILURES = 3
+
+
+class PeerRecord:
+    __slots__ = ('peer_id', 'multiaddr', 'last_seen', 'latency', 'failures', 'next_attempt', 'connected')
+
+    def __init__(self, peer_id, multiaddr, now):
+        self.peer_id = peer_id
+        self.multiaddr = multiaddr
+        self.last_seen = now
+        self.latency = None
+        self.failures = 0
+        self.next_attempt = now
+        self.connected = True
+
+
+def peer_id_of(multiaddr):
+    return multiaddr.rstrip('/').split('/')[-1]
+
+
+class PeerManager:
+    # Таблица известных пиров. Переподключаются только пиры, выпавшие из swarm peers,
+    # с экспоненциальной задержкой со случайным разбросом и ограничением одновременных дозвонов.
+    # list_peers, connect и find_peer — корутины, что позволяет подставить фейковый источник пиров.
+    def __init__(self, logger, list_peers, connect, find_peer=None,
+                 max_concurrent_dials=DEFAULT_MAX_CONCURRENT_DIALS, base_backoff=DEFAULT_BASE_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, forget_after=DEFAULT_FORGET_AFTER, clock=time.monotonic):
+        self.logger = logger
+        self.list_peers = list_peers
+        self.connect = connect
+        self.find_peer = find_peer
+        self.max_concurrent_dials = max_concurrent_dials
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.forget_after = forget_after
+        self.clock = clock
+        self.peers = {}
+        self.joined_total = 0
+        self.left_total = 0
+        self.dials_total = 0
+        self.dial_failures_total = 0
+        self.connect_latency_total = 0.0
+        self.connect_latency_max = 0.0
+
+    async def refresh(self):
+        now = self.clock()
+        current = {peer_id_of(addr): addr for addr in await self.list_peers()}
+        joined = left = 0
+        for peer_id, addr in current.items():
+            record = self.peers.get(peer_id)
+            if record is None:
+                self.peers[peer_id] = PeerRecord(peer_id, addr, now)
+                joined += 1
+                continue
+            if not record.connected:
+                joined += 1
+            record.multiaddr = addr
+            record.last_seen = now
+            record.connected = True
+            record.failures = 0
+        for peer_id, record in list(self.peers.items()):
+            if peer_id in current:
+                continue
+            if record.connected:
+                # Пир только что пропал — первая попытка переподключения сразу
+                record.connected = False
+                record.next_attempt = now
+                left += 1
+            elif now - record.last_seen > self.forget_after:
+                del self.peers[peer_id]
+        self.joined_total += joined
+        self.left_total += left
+        return joined, left
+
+    def _backoff(self, failures):
+        delay = min(self.base_backoff * (2 ** (failures - 1)), self.max_backoff)
+        return delay * random.uniform(0.5, 1.5)
+
+    async def _dial(self, record, semaphore):
+        async with semaphore:
+            if record.failures >= DHT_LOOKUP_AFTER_FAILURES and self.find_peer is not None:
+                try:
+                    addrs = await self.find_peer(record.peer_id)
+                    if addrs:
+                        record.multiaddr = f"{addrs[0]}/p2p/{record.peer_id}"
+                except IpfsError as e:
+                    self.logger.debug(f"PEER_DHT: Lookup for {record.peer_id} failed: {e.stderr}")
+            started = self.clock()
+            self.dials_total += 1
+            try:
+                await self.connect(record.multiaddr)
+            except IpfsError as e:
+                record.failures += 1
+                self.dial_failures_total += 1
+                record.next_attempt = self.clock() + self._backoff(record.failures)
+                self.logger.debug(f"PEER_DIAL: {record.multiaddr} failed ({record.failures}): {e.stderr}")
+                return False
+            latency = self.clock() - started
+            record.latency = latency
+            record.connected = True
+            record.failures = 0
+            record.last_seen = self.clock()
+            self.connect_latency_total += latency
+            self.connect_latency_max = max(self.connect_latency_max, latency)
+            self.logger.debug(f"PEER_RECONNECT: Reconnected to {record.multiaddr} in {latency:.2f}s")
+            return True
+
+    async def redial(self):
+        now = self.clock()
+        due = [r for r in self.peers.values() if not r.connected and r.next_attempt <= now]
+        if not due:
+            return 0
+        semaphore = asyncio.Semaphore(self.max_concurrent_dials)
+        results = await asyncio.gather(*(self._dial(record, semaphore) for record in due))
+        return sum(results)
+
+    async def run_cycle(self):
+        joined, left = await self.refresh()
+        reconnected = await self.redial()
+        connected = sum(1 for r in self.peers.values() if r.connected)
+        if joined or left or reconnected:
+            self.logger.info(
+                f"PEER_MANAGER: Подключено {connected} из {len(self.peers)} известных пиров "
+                f"(+{joined}, -{left}, переподключено {reconnected})")
+        else:
+            self.logger.debug(f"PEER_MANAGER: {connected} of {len(self.peers)} known peers connected, no churn")
+
+    def metrics(self):
+        successes = self.dials_total - self.dial_failures_total
+        return {
+            'known': len(self.peers),
+            'connected': sum(1 for r in self.peers.values() if r.connected),
+            'joined_total': self.joined_total,
+            'left_total': self.left_total,
+            'dials_total': self.dials_total,
+            'dial_failures_total': self.dial_failures_total,
+            'connect_latency_avg': self.connect_latency_total / successes if successes else 0.0,
+            'connect_latency_max': self.connect_latency_max,
+        }
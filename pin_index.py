@@ -0,0 +1,121 @@
+import time
+import threading
+import logging
+from ipfs_client import get_client, IpfsError
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+DEFAULT_FULL_REFRESH_INTERVAL = 3600
+# Сколько неизвестных индексу CID проверять точечным pin ls за один цикл
+DEFAULT_TARGETED_LIMIT = 100
+INDEXED_PIN_TYPES = ('recursive', 'direct')
+
+
+class PinIndex:
+    # Индекс пинов ноды, живущий между циклами проверки. Полный список читается потоково
+    # (только recursive и direct, без миллионов indirect) раз в full_refresh_interval,
+    # а в промежутках индекс обновляется по пинам и анпинам, которые сделала сама нода.
+    def __init__(self, ipfs_path, logger, full_refresh_interval=DEFAULT_FULL_REFRESH_INTERVAL,
+                 targeted_limit=DEFAULT_TARGETED_LIMIT):
+        self.ipfs_path = ipfs_path
+        self.logger = logger
+        self.full_refresh_interval = full_refresh_interval
+        self.targeted_limit = targeted_limit
+        self._pins = {}
+        self._not_pinned = set()
+        self._last_full_refresh = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, cid):
+        with self._lock:
+            return cid in self._pins
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pins)
+
+    def get(self, cid, default=None):
+        with self._lock:
+            return self._pins.get(cid, default)
+
+    def pins(self):
+        # Копия индекса {cid: тип пина}
+        with self._lock:
+            return dict(self._pins)
+
+    def note_pinned(self, cids, pin_type='recursive'):
+        with self._lock:
+            for cid in cids:
+                self._pins[cid] = pin_type
+                self._not_pinned.discard(cid)
+
+    def note_unpinned(self, cids):
+        with self._lock:
+            for cid in cids:
+                self._pins.pop(cid, None)
+                self._not_pinned.add(cid)
+
+    def is_unpinned(self, cid):
+        # Нода сама отпинила CID или точечная проверка не нашла пин
+        with self._lock:
+            return cid in self._not_pinned
+
+    def needs_full_refresh(self):
+        return (self._last_full_refresh is None
+                or time.monotonic() - self._last_full_refresh >= self.full_refresh_interval)
+
+    def full_refresh(self):
+        client = get_client(self.ipfs_path, self.logger)
+        pins = {}
+        started = time.monotonic()
+        for pin_type in INDEXED_PIN_TYPES:
+            for cid, listed_type in client.pin_ls(pin_type):
+                pins[cid] = listed_type or pin_type
+        with self._lock:
+            self._pins = pins
+            self._not_pinned.clear()
+            self._last_full_refresh = time.monotonic()
+        self.logger.debug(f"PIN_INDEX: Full refresh loaded {len(pins)} pins in {time.monotonic() - started:.2f}s")
+
+    def check_cids(self, cids):
+        # Точечная проверка CID из маппинга, о которых индекс ничего не знает
+        # (например, запиненных как indirect внутри другого DAG). cids читаются потоково,
+        # до первых targeted_limit неизвестных
+        unknown = {}
+        for cid in cids:
+            with self._lock:
+                known = cid in self._pins or cid in self._not_pinned
+            if not known:
+                unknown[cid] = None
+                if len(unknown) >= self.targeted_limit:
+                    break
+        client = get_client(self.ipfs_path, self.logger)
+        for cid in unknown:
+            try:
+                pin_type = next((t for _, t in client.pin_ls('all', [cid])), None)
+            except IpfsError:
+                pin_type = None
+            with self._lock:
+                if pin_type:
+                    self._pins[cid] = pin_type.split()[0]
+                else:
+                    self._not_pinned.add(cid)
+
+    def refresh(self, mapped_cids=()):
+        if self.needs_full_refresh():
+            self.full_refresh()
+        self.check_cids(mapped_cids)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_pin_index(ipfs_path, logger):
+    with _indexes_lock:
+        index = _indexes.get(ipfs_path)
+        if index is None:
+            index = PinIndex(ipfs_path, logger)
+            _indexes[ipfs_path] = index
+        return index
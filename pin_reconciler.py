@@ -0,0 +1,284 @@
+import time
+import threading
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from ipfs_client import get_client, IpfsError
+from pin_index import get_pin_index
+import metrics
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+DEFAULT_RECONCILE_INTERVAL = 600
+DEFAULT_RECONCILE_BATCH = 100
+DEFAULT_PIN_TIMEOUT = 300
+# Таймаут повторов после неудачной пачки: доля pin_timeout по размеру части, но не меньше этого
+DEFAULT_RETRY_PIN_TIMEOUT = 60
+# GC запускается только после стольких секунд без добавлений и загрузок в Synced_dir
+DEFAULT_GC_IDLE_SECONDS = 300
+# При превышении бюджета хранилища хватает короткого простоя
+DEFAULT_GC_OVER_BUDGET_IDLE = 30
+# Минимальный промежуток между GC, если бюджет хранилища не превышен
+DEFAULT_GC_MIN_INTERVAL = 6 * 3600
+DEFAULT_GC_TIMEOUT = 3600
+# Доля бюджета, начиная с которой GC запускается без учёта окна часов и минимального промежутка
+DEFAULT_GC_WATERMARK = 0.9
+# Сколько CID показывать в отчёте сухого прогона
+REPORT_SAMPLE = 10
+MIB = 1024 * 1024
+
+
+class ActivityTracker:
+    # Учёт выполняющихся добавлений и проходов синхронизации: по нему определяется окно простоя для GC.
+    # Пока операция выполняется, GC не запускается; окно простоя отсчитывается от последней операции,
+    # которая что-то сделала. Проход синхронизации без загрузок (record=False и без touch()) его не сдвигает
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = 0
+        self._last = time.monotonic()
+
+    @contextmanager
+    def busy(self, record=True):
+        with self._lock:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+                if record:
+                    self._last = time.monotonic()
+
+    def touch(self):
+        with self._lock:
+            self._last = time.monotonic()
+
+    def idle_for(self):
+        # Секунд без активности; 0, пока что-то выполняется
+        with self._lock:
+            return 0.0 if self._active else time.monotonic() - self._last
+
+
+activity = ActivityTracker()
+
+
+def _in_hours(hours, now=None):
+    # hours — (начало, конец) в часах местного времени, окно может переходить через полночь
+    start, end = hours
+    hour = (now or datetime.now()).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+class PinReconciler:
+    # Сверка желаемого набора пинов (CID маппинга, кроме путей, удалённых из Synced_dir) с пинами ноды:
+    # недостающие CID пинятся, лишние отпиниваются пачками, после чего в окне простоя запускается repo gc.
+    # Отпиниваются только CID, которые пинила сама нода (есть в маппинге или в таблице пинов базы
+    # состояния) — пины, поставленные вручную или другими программами, не трогаются.
+    def __init__(self, ipfs_path, logger, file_cid_mapping, deleted_files_path, storage_budget=None,
+                 batch_size=DEFAULT_RECONCILE_BATCH, pin_timeout=DEFAULT_PIN_TIMEOUT,
+                 retry_pin_timeout=DEFAULT_RETRY_PIN_TIMEOUT,
+                 gc_idle_seconds=DEFAULT_GC_IDLE_SECONDS, gc_over_budget_idle=DEFAULT_GC_OVER_BUDGET_IDLE,
+                 gc_min_interval=DEFAULT_GC_MIN_INTERVAL, gc_hours=None,
+                 gc_watermark=DEFAULT_GC_WATERMARK, gc_timeout=DEFAULT_GC_TIMEOUT, dry_run=False, dedup_cache=None):
+        self.ipfs_path = ipfs_path
+        self.logger = logger
+        self.file_cid_mapping = file_cid_mapping
+        self.deleted_files_path = deleted_files_path
+        self.storage_budget = storage_budget
+        self.batch_size = batch_size
+        self.pin_timeout = pin_timeout
+        self.retry_pin_timeout = retry_pin_timeout
+        self.gc_idle_seconds = gc_idle_seconds
+        self.gc_over_budget_idle = gc_over_budget_idle
+        self.gc_min_interval = gc_min_interval
+        self.gc_hours = gc_hours
+        self.gc_watermark = gc_watermark
+        self.gc_timeout = gc_timeout
+        self.dry_run = dry_run
+        self.dedup_cache = dedup_cache
+        self._unpinned_since_gc = 0
+        self._last_gc = None
+
+    def _desired_and_managed(self):
+        # Ленивый импорт: file_sync сам импортирует activity из этого модуля
+        from file_sync import load_deleted_files
+        store = getattr(self.file_cid_mapping, 'store', None)
+        if store is not None:
+            deleted = set(store.deleted_paths())
+            items = store.iter_items()
+        else:
+            deleted = set(load_deleted_files(self.deleted_files_path, self.logger))
+            items = list(self.file_cid_mapping.items())
+        # В ленивом режиме заглушки и загруженные кэшем файлы не пинятся: их держат другие узлы.
+        # Исключение — файлы, добавленные самой нодой: их CID остаются желаемыми
+        lazy_cache = getattr(self.file_cid_mapping, 'lazy_cache', None)
+        lazy = lazy_cache.paths() if lazy_cache is not None else ()
+        local = lazy_cache.local_files() if lazy_cache is not None else {}
+        desired, managed = set(), set()
+        for path, cid in items:
+            managed.add(cid)
+            relative_path = path.replace("Upload/", "", 1)
+            if relative_path not in deleted and (relative_path not in lazy or local.get(relative_path) == cid):
+                desired.add(cid)
+        if store is not None:
+            managed.update(store.cids_with_status('pinned'))
+        return desired, managed
+
+    def plan(self):
+        # (к пину, к анпину, число желаемых, число пинов ноды) по свежему списку пинов
+        index = get_pin_index(self.ipfs_path, self.logger)
+        with metrics.timer('pin_reconcile_scan'):
+            index.full_refresh()
+            pinned = index.pins()
+            desired, managed = self._desired_and_managed()
+        to_pin = sorted(desired - pinned.keys())
+        to_unpin = sorted((managed - desired) & pinned.keys())
+        metrics.set_gauge('pins_desired', len(desired))
+        metrics.set_gauge('pins_missing', len(to_pin))
+        metrics.set_gauge('pins_orphaned', len(to_unpin))
+        return to_pin, to_unpin, len(desired), len(pinned)
+
+    def _apply_part(self, call, action, cids, timeout):
+        # Неудавшаяся пачка делится пополам, пока не останется CID, на котором она падает:
+        # один недоступный CID стоит log2(batch_size) повторов, а не batch_size
+        try:
+            call(*cids, timeout=timeout)
+            return list(cids)
+        except IpfsError as e:
+            if len(cids) == 1:
+                if action == 'unpin' and 'not pinned' in (e.stderr or ''):
+                    return list(cids)
+                self.logger.error(f"PIN_RECONCILE_ERROR: Не удалось выполнить {action} для {cids[0]}: {e.stderr}")
+                return []
+            self.logger.debug(f"PIN_RECONCILE: {action} of {len(cids)} CIDs failed, splitting: {e.stderr}")
+        applied = []
+        middle = len(cids) // 2
+        for part in (cids[:middle], cids[middle:]):
+            part_timeout = max(self.retry_pin_timeout, self.pin_timeout * len(part) / self.batch_size)
+            applied.extend(self._apply_part(call, action, part, part_timeout))
+        return applied
+
+    def _apply(self, client, cids, pin):
+        # Пачками; CID, которые индекс пинов уже видит в нужном состоянии, пропускаются
+        index = get_pin_index(self.ipfs_path, self.logger)
+        store = getattr(self.file_cid_mapping, 'store', None)
+        call = client.pin_add if pin else client.pin_rm
+        action = 'pin' if pin else 'unpin'
+        cids = [cid for cid in cids if (cid not in index if pin else not index.is_unpinned(cid))]
+        done = 0
+        for start in range(0, len(cids), self.batch_size):
+            chunk = cids[start:start + self.batch_size]
+            applied = self._apply_part(call, action, chunk, self.pin_timeout)
+            if pin:
+                index.note_pinned(applied)
+            else:
+                index.note_unpinned(applied)
+                # Блоки отпиненных CID уйдут при GC: повторный файл с тем же содержимым должен пройти ipfs add
+                if self.dedup_cache is not None:
+                    self.dedup_cache.forget_cids(applied)
+            if store is not None and applied:
+                store.set_pin_status(applied, 'pinned' if pin else 'unpinned')
+            metrics.inc('pin_reconcile_total', len(applied), action=action)
+            done += len(applied)
+        return done
+
+    def _repo_stat(self, client):
+        try:
+            return client.repo_stat(timeout=60)
+        except IpfsError as e:
+            self.logger.warning(f"PIN_RECONCILE: Не удалось получить размер репозитория: {e.stderr}")
+            return {}
+
+    def _gc_decision(self, repo, unpinned):
+        # (запускать ли GC, причина)
+        budget = self.storage_budget or repo.get('StorageMax')
+        size = repo.get('RepoSize')
+        over_budget = bool(budget and size is not None and size >= budget * self.gc_watermark)
+        if not over_budget and not unpinned:
+            return False, 'нечего собирать'
+        idle = activity.idle_for()
+        required = min(self.gc_idle_seconds, self.gc_over_budget_idle) if over_budget else self.gc_idle_seconds
+        if idle < required:
+            return False, f'нода занята (простой {idle:.0f} из {required} с)'
+        if over_budget:
+            return True, f'репозиторий занимает {size / budget:.0%} бюджета'
+        if self.gc_hours and not _in_hours(self.gc_hours):
+            return False, f'вне окна GC {self.gc_hours[0]}:00–{self.gc_hours[1]}:00'
+        if self._last_gc is not None and time.monotonic() - self._last_gc < self.gc_min_interval:
+            return False, f'с прошлого GC прошло меньше {self.gc_min_interval} с'
+        return True, f'отпинено {unpinned} CID'
+
+    def _run_gc(self, client, repo_before):
+        self.logger.info("REPO_GC_START: Запуск сборки мусора репозитория")
+        started = time.monotonic()
+        with metrics.span('repo_gc'), metrics.timer('repo_gc'):
+            removed = client.repo_gc(timeout=self.gc_timeout)
+        self._last_gc = time.monotonic()
+        self._unpinned_since_gc = 0
+        metrics.inc('repo_gc_removed_blocks_total', removed)
+        repo_after = self._repo_stat(client)
+        freed = (repo_before.get('RepoSize') or 0) - (repo_after.get('RepoSize') or 0)
+        self.logger.info(f"REPO_GC_END: Удалено блоков: {removed}, освобождено {max(freed, 0) / MIB:.1f} МиБ "
+                         f"за {time.monotonic() - started:.1f} с")
+        return repo_after
+
+    def reconcile(self, dry_run=None):
+        # Возвращает отчёт; в сухом прогоне ничего не пинится, не отпинивается и GC не запускается
+        dry_run = self.dry_run if dry_run is None else dry_run
+        client = get_client(self.ipfs_path, self.logger)
+        with metrics.span('pin_reconcile', dry_run=dry_run):
+            to_pin, to_unpin, desired, pinned = self.plan()
+            report = {'desired': desired, 'pinned': pinned, 'to_pin': to_pin, 'to_unpin': to_unpin,
+                      'pinned_now': 0, 'unpinned_now': 0, 'gc': False}
+            if not dry_run:
+                report['pinned_now'] = self._apply(client, to_pin, pin=True)
+                if to_unpin:
+                    # Путь мог вернуться в маппинг, пока шла сверка
+                    desired_now, _ = self._desired_and_managed()
+                    to_unpin = [cid for cid in to_unpin if cid not in desired_now]
+                    report['unpinned_now'] = self._apply(client, to_unpin, pin=False)
+                    self._unpinned_since_gc += report['unpinned_now']
+
+            repo = self._repo_stat(client)
+            unpinned = len(to_unpin) if dry_run else self._unpinned_since_gc
+            run_gc, reason = self._gc_decision(repo, unpinned)
+            report['gc_reason'] = reason
+            if run_gc and not dry_run:
+                try:
+                    repo = self._run_gc(client, repo)
+                    report['gc'] = True
+                except IpfsError as e:
+                    self.logger.error(f"REPO_GC_ERROR: Ошибка сборки мусора: {e.stderr}")
+            report['repo_size'] = repo.get('RepoSize')
+            report['budget'] = self.storage_budget or repo.get('StorageMax')
+        self._log_report(report, dry_run, run_gc)
+        return report
+
+    def _log_report(self, report, dry_run, run_gc):
+        size, budget = report['repo_size'], report['budget']
+        if size is not None:
+            metrics.set_gauge('repo_size_bytes', size)
+        if budget:
+            metrics.set_gauge('repo_storage_budget_bytes', budget)
+        storage = f"{size / MIB:.1f} МиБ" if size is not None else 'неизвестно'
+        if budget:
+            storage += f" из {budget / MIB:.1f} МиБ бюджета"
+        if dry_run:
+            self.logger.info(
+                f"PIN_RECONCILE_DRY_RUN: Желаемых CID {report['desired']}, пинов ноды {report['pinned']}; "
+                f"будет запинено {len(report['to_pin'])}, отпинено {len(report['to_unpin'])}; репозиторий {storage}; "
+                f"GC: {'будет запущен' if run_gc else 'не нужен'} ({report['gc_reason']})")
+            for label, cids in (('pin', report['to_pin']), ('unpin', report['to_unpin'])):
+                if cids:
+                    sample = ', '.join(cids[:REPORT_SAMPLE])
+                    more = f" и ещё {len(cids) - REPORT_SAMPLE}" if len(cids) > REPORT_SAMPLE else ''
+                    self.logger.info(f"PIN_RECONCILE_DRY_RUN: {label}: {sample}{more}")
+            return
+        self.logger.info(
+            f"PIN_RECONCILE: Желаемых CID {report['desired']}, запинено {report['pinned_now']} из "
+            f"{len(report['to_pin'])} недостающих, отпинено {report['unpinned_now']} из {len(report['to_unpin'])} "
+            f"лишних; репозиторий {storage}; GC: {'выполнен' if report['gc'] else report['gc_reason']}")
+        if report['gc'] and budget and size is not None and size > budget:
+            self.logger.warning(f"PIN_RECONCILE: Репозиторий ({size / MIB:.1f} МиБ) превышает бюджет "
+                                f"({budget / MIB:.1f} МиБ) даже после сборки мусора: запиненные данные не помещаются")
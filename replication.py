@@ -0,0 +1,564 @@
+import os
+import json
+import time
+import posixpath
+import sqlite3
+import threading
+import logging
+from collections import deque
+from ipfs_client import get_client, IpfsError
+from file_sync import load_deleted_files, save_deleted_files, remove_quietly
+import metrics
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+DEFAULT_TOPIC = 'ipfs-back/mapping/v1'
+DEFAULT_PUBLISH_INTERVAL = 10
+DEFAULT_CATCH_UP_INTERVAL = 600
+PROTOCOL_VERSION = 1
+# Записей в одном сообщении: pubsub Kubo не пропускает сообщения больше 1 МиБ
+MESSAGE_ENTRIES = 500
+# Сколько путей проверять по таблице версий одним запросом
+LOOKUP_CHUNK = 500
+# Версия записи — миллисекунды в SQLite INTEGER; записи из будущего дальше MAX_CLOCK_SKEW
+# не принимаются: гибридные часы подтянулись бы к ним, и все следующие локальные версии тоже
+MAX_TS = 2 ** 63
+MAX_CLOCK_SKEW = 3600
+# Переподписка после разрыва потока pubsub (перезапуск демона): пауза растёт до предела
+RESUBSCRIBE_BACKOFF = 1.0
+MAX_RESUBSCRIBE_BACKOFF = 30.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS replica (
+    path TEXT PRIMARY KEY,
+    cid TEXT,
+    ts INTEGER NOT NULL,
+    node TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS replica_node_ts ON replica (node, ts);
+CREATE TABLE IF NOT EXISTS replica_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class ReplicaStore:
+    # Версии записей маппинга кластера: путь -> (CID или None для надгробия, ts, узел-автор).
+    # Хранится в SQLite (по умолчанию в той же базе, что и состояние узла).
+    def __init__(self, db_path, logger):
+        self.db_path = db_path
+        self.logger = logger
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, func):
+        with self._write_lock:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    def get_meta(self, key, default=None):
+        row = self._conn().execute("SELECT value FROM replica_meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self._write(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO replica_meta (key, value) VALUES (?, ?)", (key, json.dumps(value))))
+
+    def lookup(self, paths):
+        # {путь: (cid, ts, узел)} для путей, у которых есть версия
+        result = {}
+        paths = list(paths)
+        conn = self._conn()
+        for start in range(0, len(paths), LOOKUP_CHUNK):
+            chunk = paths[start:start + LOOKUP_CHUNK]
+            rows = conn.execute(
+                f"SELECT path, cid, ts, node FROM replica WHERE path IN ({','.join('?' * len(chunk))})", chunk)
+            for path, cid, ts, node in rows:
+                result[path] = (cid, ts, node)
+        return result
+
+    def record(self, entries):
+        # entries: [(путь, cid или None, ts, узел)]
+        entries = list(entries)
+        if entries:
+            self._write(lambda conn: conn.executemany(
+                "INSERT OR REPLACE INTO replica (path, cid, ts, node) VALUES (?, ?, ?, ?)", entries))
+
+    def max_ts(self):
+        return self._conn().execute("SELECT MAX(ts) FROM replica").fetchone()[0] or 0
+
+    def version_vector(self):
+        # {узел: последний известный ts его записей}
+        return dict(self._conn().execute("SELECT node, MAX(ts) FROM replica GROUP BY node"))
+
+    def entries_since(self, vector):
+        # Генератор записей, которых нет у узла с данным вектором версий
+        conn = self._conn()
+        nodes = [row[0] for row in conn.execute("SELECT DISTINCT node FROM replica")]
+        for node in nodes:
+            cursor = conn.execute("SELECT path, cid, ts, node FROM replica WHERE node = ? AND ts > ? ORDER BY ts",
+                                  (node, vector.get(node, 0)))
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                yield from rows
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM replica").fetchone()[0]
+
+
+class MemoryHub:
+    # Шина для нескольких узлов в одном процессе (тесты, бенчмарки): сообщение получают все
+    # подключённые транспорты, кроме отправителя, в порядке публикации. Публикация из обработчика
+    # только ставит сообщение в очередь, поэтому доставка не уходит в рекурсию.
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._transports = []
+        self._queue = deque()
+        self._delivering = False
+
+    def attach(self, transport):
+        with self._lock:
+            self._transports.append(transport)
+
+    def detach(self, transport):
+        with self._lock:
+            if transport in self._transports:
+                self._transports.remove(transport)
+
+    def publish(self, sender, data):
+        with self._lock:
+            self._queue.append((sender, data))
+            if self._delivering:
+                return
+            self._delivering = True
+            try:
+                while self._queue:
+                    sender, data = self._queue.popleft()
+                    for transport in list(self._transports):
+                        if transport is not sender:
+                            transport.handler(sender.peer_id, data)
+            finally:
+                self._delivering = False
+
+
+class MemoryTransport:
+    # Транспорт поверх MemoryHub; stop() и повторный start() имитируют отключение узла от сети
+    def __init__(self, hub, peer_id):
+        self.hub = hub
+        self.peer_id = peer_id
+        self.handler = None
+
+    def start(self, handler):
+        self.handler = handler
+        self.hub.attach(self)
+
+    def publish(self, data):
+        self.hub.publish(self, data)
+
+    def stop(self):
+        self.hub.detach(self)
+
+
+class PubsubTransport:
+    # Транспорт поверх pubsub демона IPFS. Подписка читается в отдельном потоке и после разрыва
+    # (перезапуск демона) восстанавливается; собственные сообщения узла отбрасываются.
+    def __init__(self, ipfs_path, topic, peer_id, logger):
+        self.ipfs_path = ipfs_path
+        self.topic = topic
+        self.peer_id = peer_id
+        self.logger = logger
+        self.handler = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self, handler):
+        self.handler = handler
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='replication-sub', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        client = get_client(self.ipfs_path, self.logger)
+        backoff = RESUBSCRIBE_BACKOFF
+        while not self._stopping.is_set():
+            try:
+                for sender, data in client.pubsub_sub(self.topic):
+                    backoff = RESUBSCRIBE_BACKOFF
+                    if self._stopping.is_set():
+                        return
+                    if sender != self.peer_id:
+                        self.handler(sender, data)
+                self.logger.debug(f"REPLICATION: Subscription to {self.topic} ended, resubscribing")
+            except (IpfsError, OSError, ValueError) as e:
+                self.logger.warning(f"REPLICATION: Подписка на {self.topic} прервана: {e}, повтор через {backoff:.0f} с")
+            except Exception as e:
+                self.logger.error(f"REPLICATION_ERROR: Ошибка обработки сообщения из {self.topic}: {e}")
+            if self._stopping.wait(backoff):
+                return
+            backoff = min(backoff * 2, MAX_RESUBSCRIBE_BACKOFF)
+
+    def publish(self, data):
+        get_client(self.ipfs_path, self.logger).pubsub_pub(self.topic, data, timeout=30)
+
+    def stop(self):
+        # Поток, ждущий следующего сообщения, завершится вместе с процессом
+        self._stopping.set()
+
+
+class MappingReplicator:
+    # Репликация маппинга путь -> CID между узлами кластера. Локальные изменения (журнал маппинга
+    # и удаления из Synced_dir) получают версию (ts, узел) и рассылаются дельтами; входящие записи
+    # сливаются по правилу «последний писатель побеждает», удаление передаётся надгробием (CID None).
+    # ts — гибридные часы: миллисекунды времени, но не меньше последнего увиденного ts плюс один,
+    # поэтому версия, созданная после получения чужой, всегда новее её. Потерянные сообщения
+    # добираются обменом векторами версий: узел рассылает {узел: последний ts}, остальные отвечают
+    # недостающими записями. Загрузку недостающих CID выполняет обычная синхронизация Synced_dir.
+    def __init__(self, node_id, file_cid_mapping, synced_dir, deleted_files_path, transport, replica_store, logger,
+                 allowed_peers=None, message_entries=MESSAGE_ENTRIES):
+        self.node_id = node_id
+        self.file_cid_mapping = file_cid_mapping
+        self.synced_dir = synced_dir
+        self.deleted_files_path = deleted_files_path
+        self.transport = transport
+        self.replica_store = replica_store
+        self.logger = logger
+        self.allowed_peers = set(allowed_peers) if allowed_peers is not None else None
+        self.message_entries = message_entries
+        # Применены чужие записи, которые ещё не выгружены в Synced_dir
+        self.pending_sync = threading.Event()
+        self._lock = threading.RLock()
+        self._clock = replica_store.max_ts()
+        # Без базы состояния: множество из deleted_files.json перечитывается только при изменении файла,
+        # новые удаления — разница с множеством, уже просмотренным при версионировании
+        self._deleted_set = set()
+        self._deleted_key = None
+        self._seen_deleted = set()
+        self._seen_deleted_key = None
+
+    def start(self):
+        self.transport.start(self._on_message)
+        self.logger.info(f"REPLICATION: Репликация маппинга запущена, узел {self.node_id}, "
+                         f"версий записей: {self.replica_store.count()}")
+        self.request_catch_up()
+
+    def stop(self):
+        self.transport.stop()
+
+    # --- пути и удалённые файлы ---
+
+    @staticmethod
+    def _wire_path(path):
+        # В сообщениях путь относительно Synced_dir с разделителем '/'
+        return path.replace("Upload/", "", 1).replace(os.sep, '/')
+
+    @staticmethod
+    def _local_path(path):
+        return path.replace('/', os.sep)
+
+    @staticmethod
+    def _valid_wire_path(path):
+        # Путь от другого узла: только относительный, без '..' и в нормализованной форме,
+        # иначе запись указывала бы за пределы Synced_dir
+        return (bool(path) and '\\' not in path and '\0' not in path and not path.startswith('/')
+                and not os.path.isabs(path) and not os.path.splitdrive(path)[0]
+                and '..' not in path.split('/') and posixpath.normpath(path) == path)
+
+    def _inside_synced(self, path):
+        # Симлинк внутри Synced_dir тоже не должен выводить удаление или загрузку наружу
+        root = os.path.realpath(self.synced_dir)
+        real_path = os.path.realpath(os.path.join(self.synced_dir, path))
+        return real_path.startswith(root + os.sep)
+
+    def _json_deleted(self):
+        try:
+            st = os.stat(self.deleted_files_path)
+            key = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            key = None
+        if key != self._deleted_key:
+            self._deleted_set = set(load_deleted_files(self.deleted_files_path, self.logger))
+            self._deleted_key = key
+        return self._deleted_set
+
+    def _is_deleted(self, path):
+        store = getattr(self.file_cid_mapping, 'store', None)
+        if store is not None:
+            return store.is_deleted(path)
+        return path in self._json_deleted()
+
+    def _new_deletions(self):
+        # Пути, отмеченные удалёнными с прошлого версионирования, и новый курсор журнала удалений
+        store = getattr(self.file_cid_mapping, 'store', None)
+        if store is not None:
+            cursor = self.replica_store.get_meta('deleted_seq', 0)
+            if cursor > store.deleted_seq:
+                self.logger.warning(f"REPLICATION: Курсор журнала удалений {cursor} опережает базу "
+                                    f"({store.deleted_seq}), сброшен")
+                cursor = 0
+            rows = store.deleted_since(cursor)
+            return [path for path, _ in rows], (rows[-1][1] if rows else cursor)
+        deleted = self._json_deleted()
+        if self._deleted_key == self._seen_deleted_key:
+            return [], None
+        added = deleted - self._seen_deleted
+        self._seen_deleted, self._seen_deleted_key = deleted, self._deleted_key
+        return sorted(added), None
+
+    def _update_deleted(self, add, remove):
+        store = getattr(self.file_cid_mapping, 'store', None)
+        if store is not None:
+            for path in add:
+                store.mark_deleted(path)
+            for path in remove:
+                store.unmark_deleted(path)
+            return
+        deleted = load_deleted_files(self.deleted_files_path, self.logger)
+        known, remove = set(deleted), set(remove)
+        updated = [path for path in deleted if path not in remove] + [path for path in add if path not in known]
+        if updated != deleted:
+            save_deleted_files(self.deleted_files_path, updated, self.logger)
+            self._deleted_key = None
+
+    def _tick(self):
+        self._clock = max(int(time.time() * 1000), self._clock + 1)
+        return self._clock
+
+    # --- исходящие изменения ---
+
+    def publish_local_changes(self):
+        # Версионирует изменения маппинга с прошлого вызова и удаления из Synced_dir, рассылает их.
+        # Возвращает число разосланных записей
+        with self._lock:
+            entries = self._version_local_changes()
+        self._publish_entries(entries)
+        return len(entries)
+
+    def _version_local_changes(self):
+        # Пути, чья текущая версия уже совпадает с локальным состоянием (в том числе пришедшие
+        # от других узлов), повторно не версионируются
+        with metrics.timer('replication_version'):
+            mapping = self.file_cid_mapping
+            cursor = self.replica_store.get_meta('mapping_seq', 0)
+            target_seq = mapping.seq
+            if cursor > target_seq:
+                # Журнал маппинга восстановлен с меньшим seq: пересматривается весь журнал,
+                # совпадающие с таблицей версий пути повторно не рассылаются
+                self.logger.warning(f"REPLICATION: Курсор журнала {cursor} опережает маппинг ({target_seq}), сброшен")
+                cursor = 0
+            changed = {self._wire_path(path): path for path, _ in mapping.changes_since(cursor)}
+            new_deleted, deleted_cursor = self._new_deletions()
+            deleted = {self._wire_path(path): path for path in new_deleted}
+            # Удалённые из Synced_dir с прошлого раза пути, которые в кластере ещё живы, становятся надгробиями
+            candidates = dict(changed)
+            candidates.update((path, deleted[path]) for path, (cid, _, _) in self.replica_store.lookup(deleted).items()
+                              if cid is not None and path not in candidates)
+            versions = self.replica_store.lookup(candidates)
+            entries = []
+            for path in sorted(candidates):
+                local_path = candidates[path]
+                cid = None if path in deleted or self._is_deleted(local_path) else mapping.get(local_path)
+                current = versions.get(path)
+                if (current[0] if current else None) == cid:
+                    continue
+                entries.append((path, cid, self._tick(), self.node_id))
+            self.replica_store.record(entries)
+            self.replica_store.set_meta('mapping_seq', target_seq)
+            if deleted_cursor is not None:
+                self.replica_store.set_meta('deleted_seq', deleted_cursor)
+            return entries
+
+    def _publish_entries(self, entries):
+        if not entries:
+            return
+        tombstones = sum(1 for entry in entries if entry[1] is None)
+        metrics.inc('replication_entries_published_total', len(entries))
+        self.logger.info(f"REPLICATION_PUBLISH: Разослано {len(entries)} изменений маппинга (удалений: {tombstones})")
+        self._send_entries(entries)
+
+    def _send(self, message):
+        try:
+            self.transport.publish(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+            metrics.inc('replication_messages_sent_total', type=message['type'])
+        except (IpfsError, OSError) as e:
+            # Записи уже версионированы и дойдут до узлов при следующем обмене векторами версий
+            metrics.inc('replication_send_errors_total')
+            self.logger.error(f"REPLICATION_ERROR: Не удалось отправить сообщение {message['type']}: {e}")
+
+    def _send_entries(self, entries):
+        for start in range(0, len(entries), self.message_entries):
+            chunk = entries[start:start + self.message_entries]
+            self._send({'v': PROTOCOL_VERSION, 'type': 'delta', 'node': self.node_id,
+                        'entries': [list(entry) for entry in chunk]})
+
+    def request_catch_up(self):
+        # Рассылает вектор версий; узлы отвечают записями, которых у нас нет
+        vector = self.replica_store.version_vector()
+        self.logger.debug(f"REPLICATION: Requesting catch-up, version vector covers {len(vector)} nodes")
+        self._send({'v': PROTOCOL_VERSION, 'type': 'hello', 'node': self.node_id, 'since': vector})
+
+    # --- входящие сообщения ---
+
+    def _on_message(self, peer, data):
+        if self.allowed_peers is not None and peer not in self.allowed_peers:
+            metrics.inc('replication_messages_rejected_total', reason='peer')
+            self.logger.debug(f"REPLICATION: Dropped message from {peer}, not in cluster_peers")
+            return
+        try:
+            message = json.loads(data)
+            if message.get('v') != PROTOCOL_VERSION or message.get('node') != peer:
+                raise ValueError(f"версия {message.get('v')}, узел {message.get('node')}")
+            kind = message['type']
+            if kind == 'delta':
+                entries = [(str(path), cid if cid is None else str(cid), int(ts), str(node))
+                           for path, cid, ts, node in message['entries']]
+                horizon = int((time.time() + MAX_CLOCK_SKEW) * 1000)
+                for path, _, ts, _ in entries:
+                    if not self._valid_wire_path(path):
+                        raise ValueError(f"недопустимый путь {path!r}")
+                    if not 0 <= ts <= horizon:
+                        raise ValueError(f"версия {ts} вне допустимого диапазона для {path!r}")
+            elif kind == 'hello':
+                since = {str(node): int(ts) for node, ts in message['since'].items()}
+                if any(not 0 <= ts < MAX_TS for ts in since.values()):
+                    raise ValueError("версия в векторе вне допустимого диапазона")
+            else:
+                raise ValueError(f"тип {kind}")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            metrics.inc('replication_messages_rejected_total', reason='format')
+            self.logger.warning(f"REPLICATION: Отброшено некорректное сообщение от {peer}: {e}")
+            return
+        metrics.inc('replication_messages_received_total', type=kind)
+        if kind == 'delta':
+            self.apply_entries(entries, peer)
+        else:
+            self._answer_catch_up(peer, since)
+
+    def _answer_catch_up(self, peer, since):
+        # Отвечает каждый узел: автор записей может быть недоступен; лишние копии отсеет слияние
+        entries, sent = [], 0
+        for entry in self.replica_store.entries_since(since):
+            entries.append(entry)
+            if len(entries) >= self.message_entries:
+                self._send_entries(entries)
+                sent += len(entries)
+                entries = []
+        if entries:
+            self._send_entries(entries)
+            sent += len(entries)
+        if sent:
+            self.logger.info(f"REPLICATION_CATCH_UP: Узлу {peer} отправлено {sent} недостающих записей")
+
+    def apply_entries(self, entries, peer=None):
+        # Слияние входящих записей: применяются только версии новее известных.
+        # Ещё не разосланные локальные изменения сначала получают версию, иначе пришедшая
+        # запись молча затёрла бы их. Возвращает число принятых записей
+        inside, outside = [], []
+        for entry in entries:
+            (inside if self._inside_synced(self._local_path(entry[0])) else outside).append(entry)
+        if outside:
+            metrics.inc('replication_entries_applied_total', len(outside), result='outside')
+            self.logger.warning(f"REPLICATION: Пропущено {len(outside)} записей от {peer or 'кластера'}: путь ведёт "
+                                f"за пределы Synced_dir ({outside[0][0]})")
+        entries = inside
+        with self._lock, metrics.timer('replication_apply'):
+            local_entries = self._version_local_changes()
+            versions = self.replica_store.lookup({path for path, _, _, _ in entries})
+            accepted = {}
+            for path, cid, ts, node in entries:
+                self._clock = max(self._clock, ts)
+                current = versions.get(path)
+                if current is not None and (current[1], current[2]) >= (ts, node):
+                    continue
+                versions[path] = (cid, ts, node)
+                accepted[path] = (path, cid, ts, node)
+            stale = len(entries) - len(accepted)
+            if accepted:
+                # Версии фиксируются до изменения маппинга: следующий обход журнала увидит
+                # совпадение и не разошлёт принятые записи обратно
+                self.replica_store.record(accepted.values())
+                self._apply_to_mapping(accepted.values())
+        self._publish_entries(local_entries)
+        if stale:
+            metrics.inc('replication_entries_applied_total', stale, result='stale')
+        if not accepted:
+            return 0
+        metrics.inc('replication_entries_applied_total', len(accepted), result='applied')
+        self.logger.info(f"REPLICATION_APPLY: Принято {len(accepted)} изменений маппинга от {peer or 'кластера'} "
+                         f"(устаревших: {stale})")
+        return len(accepted)
+
+    def _apply_to_mapping(self, entries):
+        mapping = self.file_cid_mapping
+        live, tombstones = {}, []
+        for path, cid, _, _ in entries:
+            local_path = self._local_path(path)
+            if cid is None:
+                tombstones.append(local_path)
+            else:
+                live[local_path] = cid
+        # Отметки удаления проверяются только для путей из пришедших записей
+        deleted = {path for path in list(live) + tombstones if self._is_deleted(path)}
+        revived = [path for path in live if path in deleted]
+        unchanged = []
+        for path, cid in live.items():
+            current = mapping.get(path)
+            if current == cid:
+                if path in deleted:
+                    unchanged.append(path)
+            elif current is not None:
+                # Содержимое изменилось: старый файл убирается, синхронизация выгрузит новый
+                self._discard_synced(path, rename=True)
+        self._update_deleted([path for path in tombstones if path not in deleted], revived)
+        if live:
+            mapping.update(live)
+        # Восстановленный путь с прежним CID должен снова попасть в инкрементальную синхронизацию
+        for path in unchanged:
+            mapping.touch(path)
+        removed = sum(1 for path in tombstones if self._discard_synced(path))
+        lazy_cache = getattr(mapping, 'lazy_cache', None)
+        if lazy_cache is not None:
+            for path in tombstones:
+                lazy_cache.forget(path)
+        if live or unchanged:
+            self.pending_sync.set()
+        if removed:
+            self.logger.info(f"REPLICATION_APPLY: Удалено из Synced_dir {removed} файлов по удалениям на других узлах")
+
+    def _discard_synced(self, path, rename=False):
+        # Замена идёт через переименование в служебное имя: наблюдатель не примет её
+        # за удаление пользователем. Надгробие удаляет файл напрямую — путь уже отмечен удалённым
+        dest_path = os.path.join(self.synced_dir, path)
+        if not self._inside_synced(path) or not os.path.isfile(dest_path):
+            return False
+        try:
+            if rename:
+                remove_quietly(dest_path)
+            else:
+                os.remove(dest_path)
+            return True
+        except OSError as e:
+            self.logger.error(f"REPLICATION_ERROR: Не удалось удалить {dest_path}: {e}")
+            return False
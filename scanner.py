@@ -0,0 +1,275 @@
+import os
+import gc
+import sys
+import time
+import ctypes
+import sqlite3
+import threading
+import logging
+import metrics
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+DEFAULT_SCAN_BATCH = 50
+DEFAULT_PROGRESS_INTERVAL = 10
+DEFAULT_MEMORY_LIMIT_MB = 512
+# Пачка снова растёт вдвое, когда RSS опускается ниже этой доли порога
+MEMORY_RECOVER_RATIO = 0.8
+# Сколько путей проверять по индексу сканирования одним запросом
+LOOKUP_CHUNK = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scan_index (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+"""
+
+
+class _ProcessMemoryCounters(ctypes.Structure):
+    _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong),
+                ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+
+def _windows_rss():
+    counters = _ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    kernel32 = ctypes.windll.kernel32
+    kernel32.GetCurrentProcess.restype = ctypes.c_void_p
+    psapi = ctypes.windll.psapi
+    psapi.GetProcessMemoryInfo.argtypes = [ctypes.c_void_p, ctypes.POINTER(_ProcessMemoryCounters), ctypes.c_ulong]
+    if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.WorkingSetSize
+
+
+def current_rss_mb():
+    # Текущий RSS процесса: /proc на Linux, рабочее множество через GetProcessMemoryInfo на Windows,
+    # иначе psutil, если установлен. Пиковый RSS (ru_maxrss) не годится: он никогда не уменьшается,
+    # и после одного всплеска пачки сжимались бы до 1 до конца работы. None — измерить нечем
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        pass
+    if sys.platform == 'win32':
+        try:
+            rss = _windows_rss()
+            return rss / (1024 * 1024) if rss is not None else None
+        except (OSError, AttributeError):
+            pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / (1024 * 1024)
+
+
+class ScanIndex:
+    # Персистентный индекс сканирования Upload: путь -> (размер, mtime_ns) на момент добавления.
+    # Хранится в SQLite (по умолчанию в той же базе, что и состояние узла).
+    def __init__(self, db_path, logger):
+        self.db_path = db_path
+        self.logger = logger
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def lookup(self, paths):
+        # {путь: (размер, mtime_ns)} для путей, которые есть в индексе
+        result = {}
+        paths = list(paths)
+        conn = self._conn()
+        for start in range(0, len(paths), LOOKUP_CHUNK):
+            chunk = paths[start:start + LOOKUP_CHUNK]
+            rows = conn.execute(
+                f"SELECT path, size, mtime_ns FROM scan_index WHERE path IN ({','.join('?' * len(chunk))})", chunk)
+            for path, size, mtime_ns in rows:
+                result[path] = (size, mtime_ns)
+        return result
+
+    def record(self, items):
+        # items: [(путь, размер, mtime_ns)]
+        items = list(items)
+        if not items:
+            return
+        with self._write_lock:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO scan_index (path, size, mtime_ns) VALUES (?, ?, ?)", items)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def record_files(self, files):
+        # files: [(относительный путь, полный путь)] — сохраняет текущие размер и mtime
+        items = []
+        for relative_path, file_path in files:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            items.append((relative_path, st.st_size, st.st_mtime_ns))
+        self.record(items)
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM scan_index").fetchone()[0]
+
+
+class UploadScanner:
+    # Потоковый обход Upload на os.scandir: в памяти только стек каталогов и текущая пачка.
+    # Файлы, чьи размер и mtime совпадают с индексом сканирования, пропускаются без обращения
+    # к маппингу; файлы из маппинга без записи в индексе (добавленные до появления индекса)
+    # заносятся в индекс и тоже пропускаются. Если RSS превышает memory_limit_mb,
+    # размер пачки уменьшается вдвое и растёт обратно, когда RSS опускается. roots ограничивает обход подкаталогами Upload
+    # (пути в результатах по-прежнему относительно upload_dir).
+    def __init__(self, upload_dir, logger, scan_index=None, batch_size=DEFAULT_SCAN_BATCH,
+                 memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB, progress_interval=DEFAULT_PROGRESS_INTERVAL, roots=None):
+        self.upload_dir = upload_dir
+        self.roots = list(roots) if roots else [upload_dir]
+        self.logger = logger
+        self.scan_index = scan_index
+        self.batch_size = batch_size
+        self.max_batch_size = batch_size
+        self.memory_limit_mb = memory_limit_mb
+        self.progress_interval = progress_interval
+        self.dirs_seen = 0
+        self.files_seen = 0
+        self.skipped_indexed = 0
+        self.skipped_mapped = 0
+        self.candidates = 0
+        self._started = None
+        self._last_progress = None
+
+    def _walk(self):
+        # (относительный путь, полный путь, размер, mtime_ns) для каждого файла; порядок — как в каталоге
+        stack = list(self.roots)
+        while stack:
+            directory = stack.pop()
+            self.dirs_seen += 1
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                                continue
+                            if not entry.is_file():
+                                continue
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        self.files_seen += 1
+                        yield os.path.relpath(entry.path, self.upload_dir), entry.path, st.st_size, st.st_mtime_ns
+            except OSError as e:
+                self.logger.warning(f"SCAN_ERROR: Не удалось прочитать каталог {directory}: {e}")
+
+    def _filter(self, chunk, is_mapped):
+        indexed = self.scan_index.lookup(path for path, _, _, _ in chunk) if self.scan_index is not None else {}
+        candidates, adopt = [], []
+        for relative_path, file_path, size, mtime_ns in chunk:
+            known = indexed.get(relative_path)
+            if known is not None:
+                if known == (size, mtime_ns):
+                    self.skipped_indexed += 1
+                    continue
+                # Файл изменился после добавления — добавляется заново
+                candidates.append(file_path)
+            elif is_mapped(relative_path):
+                self.skipped_mapped += 1
+                adopt.append((relative_path, size, mtime_ns))
+            else:
+                candidates.append(file_path)
+        if adopt and self.scan_index is not None:
+            self.scan_index.record(adopt)
+        self.candidates += len(candidates)
+        return candidates
+
+    def _report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        elapsed = now - self._started
+        rss = current_rss_mb()
+        rss_text = f", RSS {rss:.0f} МиБ" if rss is not None else ''
+        self.logger.info(
+            f"SCAN_PROGRESS: Просмотрено {self.files_seen} файлов в {self.dirs_seen} каталогах за {elapsed:.1f} с "
+            f"({self.files_seen / elapsed if elapsed else 0:.0f} файлов/с): новых {self.candidates}, "
+            f"без изменений {self.skipped_indexed + self.skipped_mapped}{rss_text}")
+        metrics.set_gauge('scan_files_seen', self.files_seen)
+        metrics.set_gauge('scan_candidates', self.candidates)
+
+    def _check_memory(self):
+        if not self.memory_limit_mb:
+            return
+        rss = current_rss_mb()
+        if rss is None:
+            return
+        if rss <= self.memory_limit_mb:
+            if rss < self.memory_limit_mb * MEMORY_RECOVER_RATIO and self.batch_size < self.max_batch_size:
+                self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+                self.logger.debug(f"SCAN_MEMORY: RSS {rss:.0f} MiB, batch size back to {self.batch_size}")
+            return
+        gc.collect()
+        if self.batch_size > 1:
+            self.batch_size = max(1, self.batch_size // 2)
+            self.logger.warning(
+                f"SCAN_MEMORY: RSS {rss:.0f} МиБ выше порога {self.memory_limit_mb} МиБ, "
+                f"размер пачки уменьшен до {self.batch_size}")
+
+    def batches(self, is_mapped=lambda path: False, stop_event=None):
+        # Генератор пачек полных путей новых или изменённых файлов. stop_event (threading.Event)
+        # проверяется между пачками: после остановки обход завершается без новых пачек
+        self._started = self._last_progress = time.monotonic()
+        chunk = []
+        pending = []
+        for item in self._walk():
+            chunk.append(item)
+            if len(chunk) < LOOKUP_CHUNK:
+                continue
+            if self._stopped(stop_event):
+                return
+            pending.extend(self._filter(chunk, is_mapped))
+            chunk = []
+            while len(pending) >= self.batch_size:
+                if self._stopped(stop_event):
+                    return
+                batch, pending = pending[:self.batch_size], pending[self.batch_size:]
+                yield batch
+                self._check_memory()
+            self._report()
+        if chunk:
+            pending.extend(self._filter(chunk, is_mapped))
+        while pending:
+            if self._stopped(stop_event):
+                return
+            batch, pending = pending[:self.batch_size], pending[self.batch_size:]
+            yield batch
+            self._check_memory()
+        self._report(force=True)
+
+    def _stopped(self, stop_event):
+        if stop_event is None or not stop_event.is_set():
+            return False
+        self._report(force=True)
+        self.logger.info("SCAN_STOPPED: Обход Upload прерван остановкой")
+        return True
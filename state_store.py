@@ -0,0 +1,326 @@
+import os
+import json
+import sqlite3
+import threading
+import logging
+from collections.abc import MutableMapping
+from datetime import datetime
+from cid_mapping import write_json_atomic
+import metrics
+
+# Версия модуля
+MODULE_VERSION = "2.1.7"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mapping (
+    path TEXT PRIMARY KEY,
+    cid TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mapping_cid ON mapping (cid);
+CREATE TABLE IF NOT EXISTS changes (
+    path TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changes_seq ON changes (seq);
+CREATE TABLE IF NOT EXISTS deleted (
+    path TEXT PRIMARY KEY,
+    deleted_at TEXT NOT NULL,
+    seq INTEGER
+);
+CREATE TABLE IF NOT EXISTS pins (
+    cid TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class StateStore:
+    # Транзакционное хранилище состояния узла (SQLite, WAL): маппинг путь -> CID
+    # с журналом изменений, множество удалённых файлов, статусы пинов и служебные значения.
+    def __init__(self, db_path, logger):
+        self.db_path = db_path
+        self.logger = logger
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        self._migrate_deleted_seq(conn)
+
+    def _migrate_deleted_seq(self, conn):
+        # Базы прежних версий: у удалённых файлов не было seq, он выдаётся по порядку вставки
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(deleted)")]
+        if 'seq' not in columns:
+            def apply(conn):
+                conn.execute("ALTER TABLE deleted ADD COLUMN seq INTEGER")
+                conn.execute("UPDATE deleted SET seq = rowid")
+                row = conn.execute("SELECT MAX(seq) FROM deleted").fetchone()
+                self._set_meta(conn, 'deleted_seq', row[0] or 0)
+            self._write(apply)
+        conn.execute("CREATE INDEX IF NOT EXISTS deleted_seq ON deleted (seq)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _write(self, func):
+        with self._write_lock, metrics.timer('state_store_write'):
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    # --- meta ---
+
+    def get_meta(self, key, default=None):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self._write(lambda conn: self._set_meta(conn, key, value))
+
+    @staticmethod
+    def _set_meta(conn, key, value):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    # --- маппинг и журнал изменений ---
+
+    @property
+    def seq(self):
+        return self.get_meta('seq', 0)
+
+    def _next_seq(self, conn, key='seq'):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        seq = (json.loads(row[0]) if row else 0) + 1
+        self._set_meta(conn, key, seq)
+        return seq
+
+    def get_cid(self, path):
+        row = self._conn().execute("SELECT cid FROM mapping WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def set_cids(self, items):
+        # items: пары (путь, cid); cid None означает удаление записи. Возвращает число изменений
+        def apply(conn):
+            changed = 0
+            for path, cid in items:
+                row = conn.execute("SELECT cid FROM mapping WHERE path = ?", (path,)).fetchone()
+                current = row[0] if row else None
+                if current == cid:
+                    continue
+                if cid is None:
+                    conn.execute("DELETE FROM mapping WHERE path = ?", (path,))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO mapping (path, cid) VALUES (?, ?)", (path, cid))
+                conn.execute("INSERT OR REPLACE INTO changes (path, seq) VALUES (?, ?)",
+                             (path, self._next_seq(conn)))
+                changed += 1
+            return changed
+        return self._write(apply)
+
+    def touch(self, paths):
+        # Новый seq в журнале для путей без изменения CID: инкрементальная синхронизация их увидит
+        def apply(conn):
+            for path in paths:
+                conn.execute("INSERT OR REPLACE INTO changes (path, seq) VALUES (?, ?)", (path, self._next_seq(conn)))
+        self._write(apply)
+
+    def paths_for_cid(self, cid):
+        return [row[0] for row in self._conn().execute("SELECT path FROM mapping WHERE cid = ?", (cid,))]
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM mapping").fetchone()[0]
+
+    def iter_items(self):
+        cursor = self._conn().execute("SELECT path, cid FROM mapping ORDER BY path")
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            yield from rows
+
+    def iter_cid_counts(self):
+        # (cid, число путей) по различным CID маппинга, потоково
+        cursor = self._conn().execute("SELECT cid, COUNT(*) FROM mapping GROUP BY cid")
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            yield from rows
+
+    def changes_since(self, seq):
+        return [(path, cid) for path, cid in self._conn().execute(
+            "SELECT c.path, m.cid FROM changes c LEFT JOIN mapping m ON m.path = c.path "
+            "WHERE c.seq > ? ORDER BY c.seq", (seq,))]
+
+    def compact(self, seq):
+        self._write(lambda conn: conn.execute(
+            "DELETE FROM changes WHERE seq <= ? AND path NOT IN (SELECT path FROM mapping)", (seq,)))
+
+    def mapping(self):
+        return StoreMapping(self)
+
+    # --- удалённые файлы ---
+
+    def is_deleted(self, path):
+        return self._conn().execute("SELECT 1 FROM deleted WHERE path = ?", (path,)).fetchone() is not None
+
+    def mark_deleted(self, path):
+        # True, если путь отмечен впервые
+        return self._write(lambda conn: conn.execute(
+            "INSERT OR IGNORE INTO deleted (path, deleted_at, seq) VALUES (?, ?, ?)",
+            (path, _now(), self._next_seq(conn, 'deleted_seq'))).rowcount == 1)
+
+    def unmark_deleted(self, path):
+        # True, если путь был отмечен удалённым
+        return self._write(lambda conn: conn.execute("DELETE FROM deleted WHERE path = ?", (path,)).rowcount == 1)
+
+    def deleted_paths(self):
+        return [row[0] for row in self._conn().execute("SELECT path FROM deleted ORDER BY deleted_at, path")]
+
+    @property
+    def deleted_seq(self):
+        return self.get_meta('deleted_seq', 0)
+
+    def deleted_since(self, seq):
+        # Пути, отмеченные удалёнными после seq, с их seq — по порядку отметки
+        return [(path, row_seq) for path, row_seq in self._conn().execute(
+            "SELECT path, seq FROM deleted WHERE seq > ? ORDER BY seq", (seq,))]
+
+    # --- статусы пинов ---
+
+    def set_pin_status(self, cids, status):
+        now = _now()
+        self._write(lambda conn: conn.executemany(
+            "INSERT OR REPLACE INTO pins (cid, status, updated_at) VALUES (?, ?, ?)",
+            [(cid, status, now) for cid in cids]))
+
+    def pin_status(self, cid):
+        row = self._conn().execute("SELECT status FROM pins WHERE cid = ?", (cid,)).fetchone()
+        return row[0] if row else None
+
+    def cids_with_status(self, status):
+        return [row[0] for row in self._conn().execute("SELECT cid FROM pins WHERE status = ?", (status,))]
+
+    # --- миграция, экспорт, резервные копии ---
+
+    def migrate_from_json(self, mapping_file, deleted_files_path):
+        # Однократный перенос file_cid_mapping.json и deleted_files.json в базу
+        if self.get_meta('migrated_from_json'):
+            return False
+        entries, deleted = {}, []
+        if os.path.exists(mapping_file):
+            with open(mapping_file, 'r') as f:
+                entries = json.load(f)
+        if os.path.exists(deleted_files_path):
+            with open(deleted_files_path, 'r') as f:
+                deleted = json.load(f)
+
+        def apply(conn):
+            seq = self.get_meta('seq', 0)
+            for path, cid in entries.items():
+                seq += 1
+                conn.execute("INSERT OR REPLACE INTO mapping (path, cid) VALUES (?, ?)", (path, cid))
+                conn.execute("INSERT OR REPLACE INTO changes (path, seq) VALUES (?, ?)", (path, seq))
+            now = _now()
+            for path in deleted:
+                conn.execute("INSERT OR IGNORE INTO deleted (path, deleted_at, seq) VALUES (?, ?, ?)",
+                             (path, now, self._next_seq(conn, 'deleted_seq')))
+            self._set_meta(conn, 'seq', seq)
+            self._set_meta(conn, 'migrated_from_json', _now())
+        self._write(apply)
+        self.logger.info(
+            f"STATE_STORE_MIGRATE: Перенесено {len(entries)} записей маппинга и {len(deleted)} удалённых файлов в {self.db_path}")
+        return True
+
+    def export_json(self, mapping_file, deleted_files_path):
+        # Экспорт в прежний JSON-формат для совместимости со старыми версиями
+        for path, data in ((mapping_file, dict(self.iter_items())), (deleted_files_path, self.deleted_paths())):
+            write_json_atomic(path, data, indent=2)
+        self.logger.info(f"STATE_STORE_EXPORT: Состояние выгружено в {mapping_file} и {deleted_files_path}")
+
+    def backup(self, backup_path):
+        # Онлайн-снимок базы средствами SQLite, без остановки записи
+        target = sqlite3.connect(backup_path)
+        try:
+            self._conn().backup(target)
+        finally:
+            target.close()
+
+
+class StoreMapping(MutableMapping):
+    # Представление таблицы mapping как словаря: file_cid_mapping[path] = cid пишет сразу в базу
+    def __init__(self, store):
+        self.store = store
+        # LazyCache ленивого режима Synced_dir, если он включён
+        self.lazy_cache = None
+
+    def __getitem__(self, path):
+        cid = self.store.get_cid(path)
+        if cid is None:
+            raise KeyError(path)
+        return cid
+
+    def __setitem__(self, path, cid):
+        self.store.set_cids([(path, cid)])
+
+    def __delitem__(self, path):
+        if not self.store.set_cids([(path, None)]):
+            raise KeyError(path)
+
+    def __contains__(self, path):
+        return self.store.get_cid(path) is not None
+
+    def __iter__(self):
+        for path, _ in self.store.iter_items():
+            yield path
+
+    def __len__(self):
+        return self.store.count()
+
+    def items(self):
+        return list(self.store.iter_items())
+
+    def update(self, *args, **kwargs):
+        self.store.set_cids(list(dict(*args, **kwargs).items()))
+
+    def cid_counts(self):
+        return self.store.iter_cid_counts()
+
+    @property
+    def seq(self):
+        return self.store.seq
+
+    def changes_since(self, seq):
+        return self.store.changes_since(seq)
+
+    def compact(self, seq):
+        self.store.compact(seq)
+
+    def touch(self, path):
+        self.store.touch([path])
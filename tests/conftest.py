@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Модули лежат в корне репозитория, фейковый Kubo — в benchmarks/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
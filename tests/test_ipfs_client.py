@@ -0,0 +1,132 @@
+import os
+import time
+import socket
+import hashlib
+
+import pytest
+
+import ipfs_client
+from ipfs_client import IpfsClient
+from fake_kubo import FakeKuboState, fake_cid, start_fake_kubo
+
+FAKE_IPFS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'fake_ipfs.py')
+
+
+@pytest.fixture
+def kubo():
+    # Фейковый RPC API, считающий принятые TCP-соединения; простаивающие закрываются через 0.3 с
+    state = FakeKuboState()
+    server = start_fake_kubo(state, idle_timeout=0.3)
+    state.connections = []
+    original = server.process_request
+
+    def counting(request, address):
+        state.connections.append(address)
+        original(request, address)
+    server.process_request = counting
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cli_state(tmp_path, monkeypatch):
+    state_dir = tmp_path / 'fake_cli_state'
+    monkeypatch.setenv('FAKE_IPFS_STATE', str(state_dir))
+    monkeypatch.setenv('FAKE_IPFS_LATENCY_MS', '0')
+    return state_dir
+
+
+def _closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_pooled_connection_is_reused(kubo):
+    client = IpfsClient(FAKE_IPFS, host='127.0.0.1', port=kubo.server_port)
+    for _ in range(5):
+        client.id()
+    assert len(kubo.RequestHandlerClass.state.connections) == 1
+    assert client._pool.qsize() == 1
+
+
+def test_idle_connection_closed_by_daemon_is_reopened(kubo, tmp_path):
+    # Потоковое тело add повторить нельзя: закрытое демоном соединение отбрасывается до запроса
+    client = IpfsClient(FAKE_IPFS, host='127.0.0.1', port=kubo.server_port)
+    path = _write(tmp_path / 'a.bin', b'first')
+    assert [e['Hash'] for e in client.add([('a.bin', path)])] == [fake_cid(hashlib.sha256(b'first').hexdigest())]
+    time.sleep(0.6)
+    entries = list(client.add([('a.bin', path)]))
+    assert entries[0]['Hash'] == fake_cid(hashlib.sha256(b'first').hexdigest())
+    assert len(kubo.RequestHandlerClass.state.connections) == 2
+
+
+def test_request_retried_on_stale_connection(kubo, monkeypatch):
+    # Закрытие ещё не видно через select: запрос без тела повторяется на новом соединении
+    client = IpfsClient(FAKE_IPFS, host='127.0.0.1', port=kubo.server_port)
+    client.id()
+    time.sleep(0.6)
+    monkeypatch.setattr(ipfs_client.select, 'select', lambda r, w, x, timeout=None: ([], [], []))
+    assert client.id()['ID'] == '12D3KooWFakeSelf'
+    assert len(kubo.RequestHandlerClass.state.connections) == 2
+    assert client._http_available()
+
+
+def test_cli_fallback_when_api_unavailable(cli_state, tmp_path):
+    client = IpfsClient(FAKE_IPFS, host='127.0.0.1', port=_closed_port())
+    path = _write(tmp_path / 'doc.txt', b'hello')
+    entries = list(client.add([('docs/doc.txt', path)]))
+    assert entries == [{'Name': 'docs/doc.txt', 'Hash': fake_cid(hashlib.sha256(b'hello').hexdigest()), 'Size': None}]
+    assert not client._http_available()
+    assert list(client.pin_ls(cids=[entries[0]['Hash']])) == [(entries[0]['Hash'], 'recursive')]
+    assert [line.split()[0] for line in (cli_state / 'calls.log').read_text().splitlines()] == ['add', 'pin']
+
+
+def test_http_retried_after_retry_interval(cli_state, tmp_path, monkeypatch):
+    client = IpfsClient(FAKE_IPFS, host='127.0.0.1', port=_closed_port())
+    client.id()
+    assert (cli_state / 'calls.log').read_text().splitlines() == ['id']
+    state = FakeKuboState()
+    server = start_fake_kubo(state)
+    try:
+        client.port = server.server_port
+        client.id()
+        assert state.requests == {}
+        monkeypatch.setattr(ipfs_client, 'HTTP_RETRY_INTERVAL', 0)
+        client._http_down_until = 0.0
+        client.id()
+        assert state.requests == {'id': 1}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize('mode', ['rpc', 'cli'])
+def test_add_maps_names_to_cids_in_order(mode, kubo, cli_state, tmp_path):
+    port = kubo.server_port if mode == 'rpc' else _closed_port()
+    client = IpfsClient(FAKE_IPFS, host='127.0.0.1', port=port)
+    contents = {'a/one.bin': b'one', 'b/one.bin': b'two', 'c/same.bin': b'one', 'three.bin': b'3' * 70000}
+    files = [(name, _write(tmp_path / 'src' / name, data)) for name, data in contents.items()]
+    progress = []
+    entries = list(client.add(files, progress=lambda name, sent: progress.append(name)))
+    assert [e['Name'] for e in entries] == list(contents)
+    assert [e['Hash'] for e in entries] == [fake_cid(hashlib.sha256(data).hexdigest()) for data in contents.values()]
+    if mode == 'rpc':
+        assert progress
+        assert all(e['Size'] == str(len(data)) for e, data in zip(entries, contents.values()))
+
+
+def test_add_only_hash_does_not_pin(kubo, tmp_path):
+    client = IpfsClient(FAKE_IPFS, host='127.0.0.1', port=kubo.server_port)
+    path = _write(tmp_path / 'x.bin', b'x')
+    [entry] = client.add([('x.bin', path)], only_hash=True)
+    assert entry['Hash'] not in kubo.RequestHandlerClass.state.pins
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+
+import pytest
+
+import peer_manager
+from ipfs_client import IpfsError
+from peer_manager import PeerManager, DHT_LOOKUP_AFTER_FAILURES
+
+
+def addr(i, ip=None):
+    return f"/ip4/{ip or f'10.0.0.{i}'}/tcp/4001/p2p/12D3KooWPeer{i:04d}"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeSwarm:
+    # Источник swarm peers: успешный дозвон возвращает адрес в список подключённых
+    def __init__(self, peers=()):
+        self.connected = {peer_manager.peer_id_of(a): a for a in peers}
+        self.unreachable = set()
+        self.dials = []
+        self.lookups = []
+        self.dht = {}
+        self.dial_delay = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def list_peers(self):
+        return list(self.connected.values())
+
+    async def connect(self, multiaddr):
+        self.dials.append(multiaddr)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.dial_delay)
+        finally:
+            self.in_flight -= 1
+        if multiaddr in self.unreachable:
+            raise IpfsError(f"swarm connect {multiaddr}: failure: dial backoff")
+        self.connected[peer_manager.peer_id_of(multiaddr)] = multiaddr
+
+    async def find_peer(self, peer_id):
+        self.lookups.append(peer_id)
+        return self.dht.get(peer_id, [])
+
+    def drop(self, *multiaddrs):
+        for multiaddr in multiaddrs:
+            del self.connected[peer_manager.peer_id_of(multiaddr)]
+
+
+@pytest.fixture
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(peer_manager.random, 'uniform', lambda a, b: 1.0)
+
+
+def make_manager(swarm, clock, **kwargs):
+    kwargs.setdefault('find_peer', swarm.find_peer)
+    return PeerManager(logging.getLogger('test'), swarm.list_peers, swarm.connect, clock=clock, **kwargs)
+
+
+def test_only_dropped_peers_are_redialed():
+    swarm = FakeSwarm([addr(i) for i in range(5)])
+    manager = make_manager(swarm, FakeClock())
+    asyncio.run(manager.run_cycle())
+    assert swarm.dials == []
+    assert manager.metrics()['joined_total'] == 5
+
+    swarm.drop(addr(1), addr(3))
+    asyncio.run(manager.run_cycle())
+    assert sorted(swarm.dials) == [addr(1), addr(3)]
+    metrics = manager.metrics()
+    assert metrics['left_total'] == 2
+    assert metrics['connected'] == 5
+
+    asyncio.run(manager.run_cycle())
+    assert len(swarm.dials) == 2
+
+
+def test_backoff_schedule_doubles_up_to_max(no_jitter):
+    swarm = FakeSwarm([addr(1)])
+    clock = FakeClock()
+    manager = make_manager(swarm, clock, find_peer=None, base_backoff=5.0, max_backoff=30.0)
+    asyncio.run(manager.run_cycle())
+    swarm.drop(addr(1))
+    swarm.unreachable.add(addr(1))
+
+    delays = []
+    for _ in range(6):
+        asyncio.run(manager.run_cycle())
+        record = manager.peers['12D3KooWPeer0001']
+        delays.append(record.next_attempt - clock.now)
+        # До истечения задержки пир не дозванивается
+        dials = len(swarm.dials)
+        clock.now = record.next_attempt - 0.1
+        asyncio.run(manager.run_cycle())
+        assert len(swarm.dials) == dials
+        clock.now = record.next_attempt
+    assert delays == [5.0, 10.0, 20.0, 30.0, 30.0, 30.0]
+    assert manager.metrics()['dial_failures_total'] == 6
+
+
+def test_backoff_jitter_stays_within_bounds():
+    manager = make_manager(FakeSwarm(), FakeClock(), base_backoff=8.0)
+    for failures in (1, 2, 3):
+        for _ in range(50):
+            delay = manager._backoff(failures)
+            assert 0.5 * 8.0 * 2 ** (failures - 1) <= delay <= 1.5 * 8.0 * 2 ** (failures - 1)
+
+
+def test_concurrent_dials_are_capped():
+    peers = [addr(i) for i in range(10)]
+    swarm = FakeSwarm(peers)
+    manager = make_manager(swarm, FakeClock(), max_concurrent_dials=3)
+    asyncio.run(manager.run_cycle())
+    swarm.drop(*peers)
+    swarm.dial_delay = 0.01
+    asyncio.run(manager.run_cycle())
+    assert sorted(swarm.dials) == sorted(peers)
+    assert swarm.max_in_flight == 3
+    assert manager.metrics()['connected'] == 10
+
+
+def test_dht_lookup_after_repeated_failures(no_jitter):
+    old, new = addr(7), addr(7, ip='10.9.9.9')
+    swarm = FakeSwarm([old])
+    swarm.dht['12D3KooWPeer0007'] = ['/ip4/10.9.9.9/tcp/4001']
+    clock = FakeClock()
+    manager = make_manager(swarm, clock)
+    asyncio.run(manager.run_cycle())
+    swarm.drop(old)
+    swarm.unreachable.add(old)
+
+    for _ in range(DHT_LOOKUP_AFTER_FAILURES):
+        asyncio.run(manager.run_cycle())
+        clock.now = manager.peers['12D3KooWPeer0007'].next_attempt
+    assert swarm.dials == [old] * DHT_LOOKUP_AFTER_FAILURES
+    assert swarm.lookups == []
+
+    asyncio.run(manager.run_cycle())
+    assert swarm.lookups == ['12D3KooWPeer0007']
+    assert swarm.dials[-1] == new
+    record = manager.peers['12D3KooWPeer0007']
+    assert record.connected and record.failures == 0 and record.multiaddr == new
+
+
+def test_dht_lookup_failure_keeps_old_address(no_jitter):
+    swarm = FakeSwarm([addr(2)])
+    clock = FakeClock()
+    manager = make_manager(swarm, clock)
+    asyncio.run(manager.run_cycle())
+    swarm.drop(addr(2))
+    swarm.unreachable.add(addr(2))
+    for _ in range(DHT_LOOKUP_AFTER_FAILURES + 1):
+        asyncio.run(manager.run_cycle())
+        clock.now = manager.peers['12D3KooWPeer0002'].next_attempt
+    assert swarm.lookups == ['12D3KooWPeer0002']
+    assert swarm.dials == [addr(2)] * (DHT_LOOKUP_AFTER_FAILURES + 1)
+    assert manager.peers['12D3KooWPeer0002'].failures == DHT_LOOKUP_AFTER_FAILURES + 1
+
+
+def test_unseen_peers_are_forgotten():
+    swarm = FakeSwarm([addr(1)])
+    clock = FakeClock()
+    manager = make_manager(swarm, clock, forget_after=60)
+    asyncio.run(manager.run_cycle())
+    swarm.drop(addr(1))
+    swarm.unreachable.add(addr(1))
+    asyncio.run(manager.refresh())
+    clock.now += 61
+    asyncio.run(manager.refresh())
+    assert manager.peers == {}
@@ -0,0 +1,246 @@
+import os
+import json
+import logging
+
+import pytest
+
+import replication
+from cid_mapping import FileCidMapping
+from file_sync import load_deleted_files, save_deleted_files
+from replication import MappingReplicator, MemoryHub, MemoryTransport, ReplicaStore, PROTOCOL_VERSION, MAX_CLOCK_SKEW
+
+logger = logging.getLogger('test')
+
+
+class Node:
+    # Узел кластера в одном процессе: маппинг в памяти, версии в SQLite, транспорт через MemoryHub
+    def __init__(self, root, hub, node_id):
+        self.node_id = node_id
+        self.synced_dir = os.path.join(root, node_id, 'Synced_dir')
+        self.deleted_files_path = os.path.join(root, node_id, 'data', 'deleted_files.json')
+        os.makedirs(self.synced_dir)
+        self.mapping = FileCidMapping()
+        self.store = ReplicaStore(os.path.join(root, node_id, 'data', 'replica.db'), logger)
+        self.transport = MemoryTransport(hub, node_id)
+        self.replicator = MappingReplicator(node_id, self.mapping, self.synced_dir, self.deleted_files_path,
+                                            self.transport, self.store, logger)
+
+    def start(self):
+        self.replicator.start()
+        return self
+
+    def delete(self, path):
+        save_deleted_files(self.deleted_files_path, load_deleted_files(self.deleted_files_path, logger) + [path],
+                           logger)
+
+    def deleted(self):
+        return load_deleted_files(self.deleted_files_path, logger)
+
+    def publish(self):
+        return self.replicator.publish_local_changes()
+
+
+class Clock:
+    # Подменяет time.time: версии записей детерминированы
+    def __init__(self, monkeypatch, now=1_700_000_000.0):
+        self.now = now
+        monkeypatch.setattr(replication.time, 'time', lambda: self.now)
+
+
+@pytest.fixture
+def hub():
+    return MemoryHub()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    return Clock(monkeypatch)
+
+
+def delta(node, entries):
+    return json.dumps({'v': PROTOCOL_VERSION, 'type': 'delta', 'node': node,
+                       'entries': [list(entry) for entry in entries]}).encode('utf-8')
+
+
+def test_changes_propagate_to_all_nodes(tmp_path, hub, clock):
+    a, b, c = (Node(str(tmp_path), hub, name).start() for name in ('a', 'b', 'c'))
+    a.mapping['docs/one.txt'] = 'bafyone'
+    b.mapping['two.txt'] = 'bafytwo'
+    # b версионирует и рассылает своё изменение, когда сливает пришедшую от a запись
+    assert a.publish() == 1
+    assert b.publish() == 0
+    for node in (a, b, c):
+        assert dict(node.mapping) == {'docs/one.txt': 'bafyone', 'two.txt': 'bafytwo'}
+    # Принятые записи не рассылаются обратно
+    assert a.publish() == b.publish() == c.publish() == 0
+    assert c.replicator.pending_sync.is_set()
+
+
+def test_last_writer_wins_with_later_timestamp(tmp_path, hub, clock):
+    a, b = Node(str(tmp_path), hub, 'a').start(), Node(str(tmp_path), hub, 'b').start()
+    # Оба узла меняют путь, пока a отключён; версия b раньше по времени
+    a.transport.stop()
+    b.mapping['x.bin'] = 'bafyold'
+    b.publish()
+    clock.now += 5
+    a.mapping['x.bin'] = 'bafynew'
+    a.transport.start(a.replicator._on_message)
+    a.publish()
+    # Версия b приходит к a при догонке и отбрасывается как устаревшая
+    a.replicator.request_catch_up()
+    assert a.mapping['x.bin'] == b.mapping['x.bin'] == 'bafynew'
+    assert a.store.lookup(['x.bin']) == b.store.lookup(['x.bin'])
+    assert a.store.lookup(['x.bin'])['x.bin'][2] == 'a'
+
+
+def test_later_local_edit_beats_received_version(tmp_path, hub, clock):
+    a, b = Node(str(tmp_path), hub, 'a').start(), Node(str(tmp_path), hub, 'b').start()
+    a.mapping['x.bin'] = 'bafyfirst'
+    a.publish()
+    # Гибридные часы: правка после приёма новее принятой версии, даже если время не сдвинулось
+    b.mapping['x.bin'] = 'bafysecond'
+    b.publish()
+    assert a.mapping['x.bin'] == b.mapping['x.bin'] == 'bafysecond'
+    a_ts, b_ts = a.store.lookup(['x.bin'])['x.bin'][1], b.store.lookup(['x.bin'])['x.bin'][1]
+    assert a_ts == b_ts
+
+
+def test_equal_timestamps_break_ties_by_node_id(tmp_path, hub, clock):
+    a, b = Node(str(tmp_path), hub, 'a'), Node(str(tmp_path), hub, 'b')
+    ts = int(clock.now * 1000)
+    assert a.replicator.apply_entries([('t.bin', 'bafyfromb', ts, 'b')]) == 1
+    assert a.replicator.apply_entries([('t.bin', 'bafyfroma', ts, 'a')]) == 0
+    assert b.replicator.apply_entries([('t.bin', 'bafyfroma', ts, 'a')]) == 1
+    assert b.replicator.apply_entries([('t.bin', 'bafyfromb', ts, 'b')]) == 1
+    assert a.mapping['t.bin'] == b.mapping['t.bin'] == 'bafyfromb'
+
+
+def test_tombstone_removes_file_on_other_nodes(tmp_path, hub, clock):
+    a, b, c = (Node(str(tmp_path), hub, name).start() for name in ('a', 'b', 'c'))
+    a.mapping['dir/gone.txt'] = 'bafygone'
+    a.publish()
+    synced_copy = os.path.join(b.synced_dir, 'dir', 'gone.txt')
+    os.makedirs(os.path.dirname(synced_copy))
+    with open(synced_copy, 'w') as f:
+        f.write('content')
+
+    clock.now += 1
+    a.delete('dir/gone.txt')
+    assert a.publish() == 1
+    for node in (b, c):
+        assert node.store.lookup(['dir/gone.txt'])['dir/gone.txt'][0] is None
+        assert node.deleted() == ['dir/gone.txt']
+    assert not os.path.exists(synced_copy)
+    # Надгробие не превращается обратно в живую запись на узлах, получивших его
+    assert b.publish() == c.publish() == 0
+
+
+def test_newer_write_revives_deleted_path(tmp_path, hub, clock):
+    a, b = Node(str(tmp_path), hub, 'a').start(), Node(str(tmp_path), hub, 'b').start()
+    a.mapping['r.txt'] = 'bafyv1'
+    a.publish()
+    a.delete('r.txt')
+    a.publish()
+    assert b.deleted() == ['r.txt']
+    b.replicator.apply_entries([('r.txt', 'bafyv2', b.replicator._tick() + 1, 'c')])
+    assert b.deleted() == []
+    assert b.mapping['r.txt'] == 'bafyv2'
+
+
+def test_offline_node_catches_up_with_version_vector(tmp_path, hub, clock):
+    a, b = Node(str(tmp_path), hub, 'a').start(), Node(str(tmp_path), hub, 'b').start()
+    c = Node(str(tmp_path), hub, 'c')
+    a.mapping['early.txt'] = 'bafyearly'
+    a.publish()
+    c.start()
+    assert dict(c.mapping) == {'early.txt': 'bafyearly'}
+
+    c.transport.stop()
+    clock.now += 1
+    a.mapping['late.txt'] = 'bafylate'
+    a.publish()
+    b.mapping['other.txt'] = 'bafyother'
+    a.delete('early.txt')
+    a.publish()
+    b.publish()
+    assert c.store.count() == 1
+
+    sent = []
+    original = a.transport.publish
+    a.transport.publish = lambda data: (sent.append(json.loads(data)), original(data))
+    vector = c.store.version_vector()
+    c.transport.start(c.replicator._on_message)
+    c.replicator.request_catch_up()
+    assert dict(c.mapping) == {'early.txt': 'bafyearly', 'late.txt': 'bafylate', 'other.txt': 'bafyother'}
+    assert c.deleted() == ['early.txt']
+    assert c.store.version_vector() == a.store.version_vector() == b.store.version_vector()
+    # Отвечающий узел шлёт только записи новее вектора запросившего
+    answered = [tuple(entry) for message in sent for entry in message['entries']]
+    assert sorted(answered) == sorted(a.store.entries_since(vector))
+    assert all(ts > vector.get(node, 0) for _, _, ts, node in answered)
+
+
+def test_catch_up_answers_are_split_into_messages(tmp_path, hub, clock):
+    a = Node(str(tmp_path), hub, 'a').start()
+    a.replicator.message_entries = 3
+    a.mapping.update({f'f{i}.bin': f'bafy{i}' for i in range(10)})
+    a.publish()
+    b = Node(str(tmp_path), hub, 'b')
+    received = []
+    original = b.replicator._on_message
+    b.transport.start(lambda peer, data: (received.append(json.loads(data)['type']), original(peer, data)))
+    b.replicator.request_catch_up()
+    assert received == ['delta'] * 4
+    assert len(b.mapping) == 10
+
+
+@pytest.mark.parametrize('path', ['../escape.txt', 'a/../../escape.txt', '/etc/passwd', 'a/./b.txt', 'a//b.txt',
+                                  'a\\b.txt', '', 'dir/..', 'nul\0.txt'])
+def test_invalid_wire_paths_are_rejected(tmp_path, hub, clock, path):
+    a = Node(str(tmp_path), hub, 'a')
+    assert not MappingReplicator._valid_wire_path(path)
+    # Сообщение с одним недопустимым путём отбрасывается целиком
+    a.replicator._on_message('b', delta('b', [('ok.txt', 'bafyok', int(clock.now * 1000), 'b'),
+                                              (path, 'bafyevil', int(clock.now * 1000), 'b')]))
+    assert dict(a.mapping) == {}
+    assert a.store.count() == 0
+
+
+def test_valid_wire_paths_are_accepted():
+    for path in ('file.txt', 'dir/sub/file.txt', '..hidden', 'a..b/c'):
+        assert MappingReplicator._valid_wire_path(path)
+
+
+def test_versions_outside_clock_bounds_are_rejected(tmp_path, hub, clock):
+    a = Node(str(tmp_path), hub, 'a')
+    future = int((clock.now + MAX_CLOCK_SKEW + 60) * 1000)
+    for ts in (future, -1):
+        a.replicator._on_message('b', delta('b', [('x.txt', 'bafyx', ts, 'b')]))
+    hello = {'v': PROTOCOL_VERSION, 'type': 'hello', 'node': 'b', 'since': {'a': 2 ** 63}}
+    a.replicator._on_message('b', json.dumps(hello).encode('utf-8'))
+    assert a.store.count() == 0
+    a.replicator._on_message('b', delta('b', [('x.txt', 'bafyx', int(clock.now * 1000), 'b')]))
+    assert a.mapping['x.txt'] == 'bafyx'
+
+
+def test_message_from_other_sender_or_unknown_peer_is_rejected(tmp_path, hub, clock):
+    a = Node(str(tmp_path), hub, 'a')
+    a.replicator.allowed_peers = {'b'}
+    entry = ('x.txt', 'bafyx', int(clock.now * 1000), 'b')
+    a.replicator._on_message('c', delta('c', [entry]))
+    a.replicator._on_message('b', delta('c', [entry]))
+    assert a.store.count() == 0
+    a.replicator._on_message('b', delta('b', [entry]))
+    assert a.store.count() == 1
+
+
+def test_entries_through_symlink_outside_synced_dir_are_skipped(tmp_path, hub, clock):
+    a = Node(str(tmp_path), hub, 'a')
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    (outside / 'victim.txt').write_text('keep')
+    os.symlink(str(outside), os.path.join(a.synced_dir, 'link'))
+    ts = int(clock.now * 1000)
+    assert a.replicator.apply_entries([('link/victim.txt', None, ts, 'b'), ('fine.txt', 'bafyfine', ts, 'b')]) == 1
+    assert (outside / 'victim.txt').read_text() == 'keep'
+    assert dict(a.mapping) == {'fine.txt': 'bafyfine'}